@@ -0,0 +1,280 @@
+'''
+Simulated discovery storm against WGZeroconf and WGServiceListener.
+
+Every peer announces itself at once with a correctly signed WGServiceInfo.
+The announcements go through the real resolve pipeline, authentication, peer
+table, reconciler, `wg` backend and DNS records. A fake Zeroconf answers
+resolves from memory, and `wg` is replaced by a recording fake that keeps
+the kernel's peer table. The fake netlink reports a single carrier link.
+
+Each peer count runs in its own forked process, so the peak RSS of one size
+does not carry over into the next. For each count the benchmark reports:
+  - the time from the first announcement until the kernel and DNS both hold
+    every peer
+  - the `wg` invocations by subcommand
+  - the growth in peak RSS
+
+Usage:
+  discovery_storm [options]
+
+Options:
+  -h --help                     Show this help.
+  -n <peers> --peers=<peers>    Comma separated peer counts.
+                                [default: 10,100,1000,10000].
+  -t <secs> --timeout=<secs>    Give up on convergence after. [default: 120].
+'''
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+import os
+import base64
+import asyncio
+import ipaddress
+import resource
+import subprocess
+import multiprocessing
+import time
+from collections import Counter
+from dataclasses import replace
+from multiprocessing.connection import Connection
+from threading import Lock
+from unittest.mock import patch
+
+from docopt import docopt
+from zeroconf import ServiceInfo
+
+from zerowire import wgzero
+from zerowire.config import IfaceConfig
+from zerowire.dns import LocalDNSServer
+from zerowire.probe import Prober
+from zerowire.wg import WGProcBackend
+
+IFNAME = 'wg-storm'
+CARRIER = ipaddress.ip_address('192.0.2.1')
+
+
+def key() -> str:
+    return base64.b64encode(os.urandom(32)).decode('ascii')
+
+
+class FakeLink(dict):  # type: ignore
+    '''Just enough of a pyroute2 message for WGZeroconf.scan.'''
+    def get_attr(self, name: str) -> Any:
+        return self[name]
+
+
+class FakeIPRoute:
+    def get_links(self) -> List[FakeLink]:
+        return [
+            FakeLink(index=1, IFLA_IFNAME='lo'),
+            FakeLink(index=2, IFLA_IFNAME='eth0'),
+        ]
+
+    def get_addr(self, label: str) -> List[FakeLink]:
+        return [FakeLink(IFA_ADDRESS=CARRIER.compressed)]
+
+    def link_lookup(self, ifname: str) -> List[int]:
+        return [3]
+
+    def close(self) -> None:
+        pass
+
+
+class FakeZeroconf:
+    '''Resolves from a table, as if every peer answered at once.'''
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        self.infos: Dict[str, ServiceInfo] = {}
+        self.resolves = 0
+
+    def get_service_info(
+        self,
+        type: str,
+        name: str,
+        timeout: int = 3000,
+    ) -> Optional[ServiceInfo]:
+        self.resolves += 1
+        return self.infos.get(name)
+
+    def register_service(self, info: ServiceInfo) -> None:
+        pass
+
+    def unregister_service(self, info: ServiceInfo) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class RecordingWG:
+    '''Stands in for subprocess.run of `wg`, like tests.util.ProcTest, and
+    applies `set` and `addconf` to an in memory peer table so `show dump`
+    reflects what was programmed.'''
+    def __init__(self, pubkey: str, port: int):
+        self.interface = f'(hidden)\t{pubkey}\t{port}\toff'
+        self.peers: Dict[str, str] = {}
+        self.calls: Counter[str] = Counter()
+        self.lock = Lock()
+
+    def __call__(
+        self,
+        args: List[str],
+        input: Optional[str] = None,
+        **kwargs: Any,
+    ) -> subprocess.CompletedProcess[str]:
+        assert args[0] == 'wg', args
+        command = args[1]
+        stdout = ''
+        with self.lock:
+            self.calls[command] += 1
+            if command == 'show':
+                stdout = '\n'.join([self.interface, *self.peers.values()])
+            elif command == 'set':
+                for i, arg in enumerate(args):
+                    if arg == 'remove':
+                        self.peers.pop(args[i - 1], None)
+            elif command == 'addconf':
+                assert input is not None
+                for section in input.split('[Peer]\n')[1:]:
+                    self.addconf(section)
+        return subprocess.CompletedProcess(args, 0, stdout=stdout)
+
+    def addconf(self, section: str) -> None:
+        conf = dict(
+            line.split(' = ', 1) for line in section.splitlines() if line)
+        self.peers[conf['PublicKey']] = '\t'.join([
+            conf['PublicKey'],
+            conf.get('PresharedKey', '(none)'),
+            conf.get('Endpoint', '(none)'),
+            conf.get('AllowedIPs', '(none)').replace(', ', ','),
+            '0', '0', '0',
+            conf.get('PersistentKeepalive', 'off'),
+        ])
+
+
+def make_config() -> IfaceConfig:
+    return IfaceConfig(
+        name=IFNAME,
+        addr=ipaddress.ip_interface('fd00::1/64'),
+        privkey=key(),
+        pubkey=key(),
+        psk=key(),
+        port=51820,
+    )
+
+
+def make_infos(
+    config: IfaceConfig,
+    count: int,
+) -> List[wgzero.WGServiceInfo]:
+    infos = []
+    for i in range(count):
+        remote = replace(
+            config,
+            addr=ipaddress.ip_interface(f'fd00::{i + 2:x}/64'),
+            pubkey=key(),
+        )
+        infos.append(wgzero.WGServiceInfo.new(
+            f'{i:032x}',
+            addresses=[ipaddress.ip_address(
+                f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}').packed],
+            hostname=f'peer{i}',
+            config=remote,
+        ))
+    return infos
+
+
+def max_rss() -> int:
+    '''Peak RSS of this process in KiB.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+async def storm(
+    engine: wgzero.WGZeroconf,
+    iface: wgzero.WGInterface,
+    dns: LocalDNSServer,
+    wg: RecordingWG,
+    names: List[str],
+    timeout: float,
+) -> float:
+    await engine.pipeline.start()
+    await iface.reconciler.start()
+    # The reconciler's startup pass is not part of the storm
+    await asyncio.sleep(iface.reconciler.debounce * 2)
+    wg.calls.clear()
+    expected = len(names)
+    start = time.perf_counter()
+    for name in names:
+        # As called from the ServiceBrowser thread
+        engine.add_service(engine.zeroconf, wgzero.WG_TYPE, name)
+    while len(wg.peers) < expected or len(dns.records) < expected:
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(
+                f'{len(wg.peers)} peers in the kernel and {len(dns.records)} '
+                f'in DNS of {expected}')
+        await asyncio.sleep(0.001)
+    return time.perf_counter() - start
+
+
+def run(conn: Connection, count: int, timeout: float) -> None:
+    '''One storm of `count` peers, in its own process.'''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    config = make_config()
+    assert config.port is not None
+    wg = RecordingWG(config.pubkey, config.port)
+    with patch('pyroute2.IPRoute', FakeIPRoute), \
+            patch('zerowire.wgzero.Zeroconf', FakeZeroconf), \
+            patch('subprocess.run', wg):
+        engine = wgzero.WGZeroconf()
+        dns = LocalDNSServer(ipaddress.ip_address('127.0.0.53'), 53)
+        prober = Prober()
+        iface = wgzero.WGInterface(
+            IFNAME, config, dns, WGProcBackend(), prober, engine)
+        zeroconf: FakeZeroconf = engine.zeroconf  # type: ignore
+        infos = make_infos(config, count)
+        zeroconf.infos = {info.name: info for info in infos}
+        before = max_rss()
+        elapsed = loop.run_until_complete(storm(
+            engine, iface, dns, wg, list(zeroconf.infos), timeout))
+        peak = max_rss() - before
+        iface.close()
+        engine.close()
+        prober.close()
+        dns.close()
+    conn.send((elapsed, dict(wg.calls), zeroconf.resolves, peak))
+
+
+def main() -> None:
+    args = docopt(__doc__)
+    timeout = float(args['--timeout'])
+    print(f'{"peers":>7} {"converge ms":>12} {"ms/peer":>8} {"resolves":>9} '
+          f'{"wg calls":>9} {"calls by subcommand":<28} {"peak KiB":>9}')
+    context = multiprocessing.get_context('fork')
+    for count in map(int, args['--peers'].split(',')):
+        recv_conn, send_conn = context.Pipe(duplex=False)
+        process = context.Process(
+            target=run, args=(send_conn, count, timeout))
+        process.start()
+        send_conn.close()
+        try:
+            result: Tuple[float, Dict[str, int], int, int] = recv_conn.recv()
+        except EOFError:
+            print(f'{count:>7} failed')
+            continue
+        finally:
+            process.join()
+        elapsed, calls, resolves, peak = result
+        by_command = ' '.join(
+            f'{command}={n}' for command, n in sorted(calls.items()))
+        print(f'{count:>7} {elapsed * 1e3:>12.1f} '
+              f'{elapsed * 1e3 / count:>8.3f} {resolves:>9} '
+              f'{sum(calls.values()):>9} {by_command:<28} {peak:>9}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+'''
+Load test LocalDNSServer and InterfaceDNSServer on loopback.
+
+The servers run in their own process with synthetic zones. A closed loop
+UDP load generator keeps <concurrency> queries in flight from this process.
+The queries mix local names, names forwarded to a peer, NXDOMAIN and
+DNS-SD browsing straight against the peer.
+
+Usage:
+  dns_load [options]
+
+Options:
+  -h --help                          Show this help.
+  -n <names> --names=<names>         Hosts and services in the zones.
+                                     [default: 1000].
+  -q <queries> --queries=<queries>   Queries to send. [default: 50000].
+  -c <count> --concurrency=<count>   Queries in flight. [default: 64].
+  -w <count> --workers=<count>       Extra DNS worker processes. [default: 0].
+  -m <mix> --mix=<mix>               Query mix weights.
+                               [default: local=4,forward=2,nxdomain=2,dnssd=2].
+'''
+from __future__ import annotations
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
+import time
+import random
+import socket
+import asyncio
+import ipaddress
+import multiprocessing
+from multiprocessing.connection import Connection
+
+from docopt import docopt
+from dnslib import DNSRecord
+
+from zerowire.dns import InterfaceDNSServer, LocalDNSServer
+from zerowire.config import ServiceConfig
+from zerowire.dnsworkers import DNSWorkers
+
+LOCAL = ipaddress.ip_address('127.0.0.1')
+PEER = ipaddress.ip_interface('127.0.0.2/8')
+TIMEOUT = 1.0
+
+TQuery = Tuple[str, Tuple[str, int], bytes]
+
+
+def free_port(host: str) -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind((host, 0))
+        return cast(int, sock.getsockname()[1])
+
+
+def serve(
+    conn: Connection,
+    names: int,
+    workers: int,
+    local_port: int,
+    peer_port: int,
+) -> None:
+    '''Server process, builds the zones and answers until killed.'''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    dns_workers = DNSWorkers(workers) if workers else None
+    if dns_workers is not None:
+        dns_workers.start()
+    local = LocalDNSServer(LOCAL, local_port, remote_port=peer_port)
+    peer = InterfaceDNSServer('peer', PEER, peer_port)
+    local.add_addr_record('peer.zerowire.', PEER.ip)
+    for i in range(names):
+        local.add_addr_record(
+            f'host{i}.zerowire.',
+            ipaddress.ip_address(f'fd00::{i + 1:x}'))
+        peer.add_service(ServiceConfig.from_dict({
+            'type': f'_svc{i % 50}._tcp',
+            'name': f'instance{i}',
+            'port': 1024 + i,
+            'properties': {'path': f'/{i}'},
+        }))
+    if dns_workers is not None:
+        dns_workers.add_server(local)
+        dns_workers.add_server(peer)
+    loop.run_until_complete(local.start())
+    loop.run_until_complete(peer.start())
+    conn.send('ready')
+    loop.run_forever()
+
+
+def make_queries(
+    names: int,
+    count: int,
+    mix: Dict[str, int],
+    local_port: int,
+    peer_port: int,
+) -> List[TQuery]:
+    local = (LOCAL.compressed, local_port)
+    peer = (PEER.ip.compressed, peer_port)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    queries: List[TQuery] = []
+    for kind in random.choices(kinds, weights, k=count):
+        i = random.randrange(names)
+        if kind == 'local':
+            target, question = local, DNSRecord.question(
+                f'host{i}.zerowire.', 'AAAA')
+        elif kind == 'forward':
+            target, question = local, DNSRecord.question(
+                f'instance{i}._svc{i % 50}._tcp.peer.zerowire.', 'SRV')
+        elif kind == 'nxdomain':
+            target, question = local, DNSRecord.question(
+                f'missing{i}.zerowire.', 'A')
+        elif kind == 'dnssd':
+            target, question = peer, random.choice([
+                DNSRecord.question(
+                    '_services._dns-sd._udp.peer.zerowire.', 'PTR'),
+                DNSRecord.question(f'_svc{i % 50}._tcp.peer.zerowire.', 'PTR'),
+                DNSRecord.question(
+                    f'instance{i}._svc{i % 50}._tcp.peer.zerowire.', 'TXT'),
+            ])
+        else:
+            raise ValueError(f'Unknown query kind {kind}')
+        queries.append((kind, target, bytes(question.pack())))
+    return queries
+
+
+class LoadProtocol(asyncio.DatagramProtocol):
+    '''One query in flight at a time, the next is sent on each reply.'''
+    transport: asyncio.DatagramTransport
+
+    def __init__(self, generator: LoadGenerator) -> None:
+        self.generator = generator
+        self.current: Optional[TQuery] = None
+        self.sent = 0.0
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = cast(asyncio.DatagramTransport, transport)
+        self.next()
+
+    def next(self) -> None:
+        self.current = self.generator.take()
+        if self.current is None:
+            self.generator.idle()
+            return
+        _kind, target, data = self.current
+        self.sent = time.perf_counter()
+        self.transport.sendto(data, target)
+        self.timer = self.generator.loop.call_later(TIMEOUT, self.timeout)
+
+    def timeout(self) -> None:
+        assert self.current is not None
+        self.generator.timeouts[self.current[0]] += 1
+        self.next()
+
+    def datagram_received(
+        self,
+        data: Union[bytes, str],
+        src: Tuple[str, int],
+    ) -> None:
+        if self.current is None or data[:2] != self.current[2][:2]:
+            return
+        assert self.timer is not None
+        self.timer.cancel()
+        self.generator.latencies[self.current[0]].append(
+            time.perf_counter() - self.sent)
+        self.next()
+
+
+class LoadGenerator:
+    def __init__(self, queries: List[TQuery], concurrency: int):
+        self.queries = queries
+        self.concurrency = concurrency
+        self.loop = asyncio.get_event_loop()
+        self.position = 0
+        self.running = concurrency
+        self.done = self.loop.create_future()
+        kinds = {kind for kind, _, _ in queries}
+        self.latencies: Dict[str, List[float]] = {kind: [] for kind in kinds}
+        self.timeouts: Dict[str, int] = {kind: 0 for kind in kinds}
+
+    def take(self) -> Optional[TQuery]:
+        if self.position >= len(self.queries):
+            return None
+        query = self.queries[self.position]
+        self.position += 1
+        return query
+
+    def idle(self) -> None:
+        self.running -= 1
+        if not self.running:
+            self.done.set_result(None)
+
+    async def run(self) -> float:
+        start = time.perf_counter()
+        transports = [
+            (await self.loop.create_datagram_endpoint(
+                lambda: LoadProtocol(self), family=socket.AF_INET))[0]
+            for _ in range(self.concurrency)
+        ]
+        await self.done
+        elapsed = time.perf_counter() - start
+        for transport in transports:
+            transport.close()
+        return elapsed
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    if not ordered:
+        return float('nan')
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(generator: LoadGenerator, elapsed: float) -> None:
+    print(f'{"kind":>10} {"answered":>9} {"timeouts":>9} {"qps":>9} '
+          f'{"p50 us":>9} {"p99 us":>9} {"p999 us":>9}')
+    rows = dict(generator.latencies)
+    rows['total'] = [
+        latency
+        for latencies in generator.latencies.values()
+        for latency in latencies
+    ]
+    timeouts = dict(generator.timeouts)
+    timeouts['total'] = sum(generator.timeouts.values())
+    for kind, latencies in rows.items():
+        ordered = sorted(latencies)
+        print(f'{kind:>10} {len(ordered):>9} {timeouts[kind]:>9} '
+              f'{len(ordered) / elapsed:>9.0f} '
+              f'{percentile(ordered, 0.5) * 1e6:>9.0f} '
+              f'{percentile(ordered, 0.99) * 1e6:>9.0f} '
+              f'{percentile(ordered, 0.999) * 1e6:>9.0f}')
+
+
+def main() -> None:
+    args = docopt(__doc__)
+    names = int(args['--names'])
+    mix = {
+        kind: int(weight)
+        for kind, weight in (
+            part.split('=') for part in args['--mix'].split(','))
+    }
+    local_port = free_port(LOCAL.compressed)
+    peer_port = free_port(PEER.ip.compressed)
+    queries = make_queries(
+        names, int(args['--queries']), mix, local_port, peer_port)
+
+    context = multiprocessing.get_context('fork')
+    recv_conn, send_conn = context.Pipe(duplex=False)
+    server = context.Process(
+        target=serve,
+        args=(send_conn, names, int(args['--workers']), local_port, peer_port),
+    )
+    server.start()
+    try:
+        recv_conn.recv()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        generator = LoadGenerator(queries, int(args['--concurrency']))
+        elapsed = loop.run_until_complete(generator.run())
+        report(generator, elapsed)
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
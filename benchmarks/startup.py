@@ -0,0 +1,142 @@
+'''
+Time the daemon from exec to its "Init done" log line.
+
+Each run starts a fresh interpreter, `python -m zerowire` or a built zipapp,
+waits for "Init done" on stderr and stops it with SIGTERM. Without a config
+one with no interfaces is used, which still imports everything and starts
+the DNS server, Zeroconf and the prober; like the daemon it needs root.
+`--version` is timed as well, the floor set by the interpreter itself.
+
+Usage:
+  startup [options]
+
+Options:
+  -h --help                     Show this help.
+  -r <runs> --runs=<runs>       Starts to time. [default: 10].
+  -c <config> --config=<config> Daemon config, default none.
+  --pyz=<path>                  Run this zipapp instead of the package.
+  -t <secs> --timeout=<secs>    Give up on a start after. [default: 30].
+  --profile                     Print the --startup-profile of the last run.
+'''
+from __future__ import annotations
+from typing import (
+    List,
+    Optional,
+    Tuple,
+)
+import os
+import sys
+import time
+import select
+import signal
+import statistics
+import subprocess
+import tempfile
+
+from docopt import docopt
+
+READY = 'Init done'
+PROFILE_WAIT = 0.5
+
+
+def command(pyz: Optional[str]) -> List[str]:
+    if pyz is not None:
+        return [sys.executable, pyz]
+    return [sys.executable, '-m', 'zerowire']
+
+
+def time_version(cmd: List[str]) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [*cmd, '--version'], check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def time_start(
+    cmd: List[str],
+    config: str,
+    timeout: float,
+    profile: bool,
+) -> Tuple[float, List[str]]:
+    '''Seconds until READY, and what the daemon logged by then.'''
+    args = [*cmd, '-c', config, '--peer-cache=', '-l', 'info']
+    if profile:
+        args.append('--startup-profile')
+    start = time.perf_counter()
+    # Unbuffered, so select() sees every line not yet read
+    proc = subprocess.Popen(args, stderr=subprocess.PIPE, bufsize=0)
+    assert proc.stderr is not None
+    lines: List[str] = []
+    ready: Optional[float] = None
+    deadline = start + timeout
+    try:
+        while ready is None or profile:
+            # Once up, the profile follows at once
+            remaining = PROFILE_WAIT
+            if ready is None:
+                remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise TimeoutError(f'No "{READY}" after {timeout}s')
+            if not select.select([proc.stderr], [], [], remaining)[0]:
+                if ready is not None:
+                    break
+                continue
+            line = proc.stderr.readline().decode('utf-8', 'replace')
+            if not line:
+                raise RuntimeError(
+                    f'Exited {proc.wait()} before "{READY}"\n'
+                    + ''.join(lines))
+            lines.append(line)
+            if ready is None and READY in line:
+                ready = time.perf_counter() - start
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    assert ready is not None
+    return ready, lines
+
+
+def report(name: str, samples: List[float]) -> None:
+    ms = sorted(sample * 1000 for sample in samples)
+    print(f'{name:>10} {ms[0]:10.1f} {statistics.median(ms):10.1f} '
+          f'{ms[-1]:10.1f}')
+
+
+def main() -> None:
+    args = docopt(__doc__)
+    runs = int(args['--runs'])
+    timeout = float(args['--timeout'])
+    cmd = command(args['--pyz'])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config = args['--config']
+        if config is None:
+            config = os.path.join(tmp, 'zerowire.conf')
+            with open(config, 'w') as file:
+                file.write('interfaces: {}\n')
+
+        versions = [time_version(cmd) for _ in range(runs)]
+        starts: List[float] = []
+        lines: List[str] = []
+        for run in range(runs):
+            profile = args['--profile'] and run == runs - 1
+            seconds, lines = time_start(cmd, config, timeout, profile)
+            starts.append(seconds)
+
+    print(f'{"":>10} {"min ms":>10} {"median ms":>10} {"max ms":>10}')
+    report('--version', versions)
+    report('init done', starts)
+    if args['--profile']:
+        print()
+        print(''.join(
+            line for line in lines
+            if line.startswith((' ', 'Started'))
+        ), end='')
+
+
+if __name__ == '__main__':
+    main()
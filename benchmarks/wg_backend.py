@@ -0,0 +1,114 @@
+'''
+Compare WireGuard peer programming through the `wg` binary and netlink.
+
+Needs root and the wireguard kernel module, creates a scratch interface.
+
+Usage:
+  wg_backend [options]
+
+Options:
+  -h --help                     Show this help.
+  -i <ifname> --iface=<ifname>  Scratch interface name. [default: wg-bench].
+  -n <peers> --peers=<peers>    Comma separated peer counts.
+                                [default: 10,100,1000].
+'''
+from __future__ import annotations
+from typing import (
+    Callable,
+    List,
+)
+import os
+import base64
+import ipaddress
+import time
+
+from docopt import docopt
+from pyroute2 import IPRoute
+
+from zerowire.wg import (
+    WGBackend,
+    WGPeer,
+    WGProc,
+    WGProcBackend,
+    format_endpoint,
+)
+
+
+def key() -> str:
+    return base64.b64encode(os.urandom(32)).decode('ascii')
+
+
+def make_peers(count: int) -> List[WGPeer]:
+    psk = key()
+    return [
+        WGPeer(
+            pubkey=key(),
+            psk=psk,
+            endpoint=(ipaddress.ip_address(f'10.{i >> 8 & 255}.{i & 255}.1'),
+                      51820),
+            keepalive=5,
+            allowed_ips=(ipaddress.ip_network(f'fd00::{i + 1:x}/128'),),
+        )
+        for i in range(count)
+    ]
+
+
+def legacy(ifname: str, peers: List[WGPeer]) -> None:
+    '''What add_service did before the backends, one fork per peer.'''
+    for peer in peers:
+        assert peer.endpoint is not None and peer.psk is not None
+        (WGProc('set', ifname)
+            .args([
+                'peer', peer.pubkey,
+                'preshared-key', '/dev/stdin',
+                'endpoint', format_endpoint(peer.endpoint),
+                'persistent-keepalive', '5',
+                'allowed-ips', peer.allowed_ips[0].compressed,
+            ])
+            .input(peer.psk)
+            .run())
+
+
+def recreate(ip: IPRoute, ifname: str) -> None:
+    if ip.link_lookup(ifname=ifname):
+        ip.link('del', ifname=ifname)
+    ip.link('add', ifname=ifname, kind='wireguard')
+
+
+def timed(
+    ip: IPRoute,
+    ifname: str,
+    peers: List[WGPeer],
+    fn: Callable[[str, List[WGPeer]], None],
+) -> float:
+    recreate(ip, ifname)
+    start = time.perf_counter()
+    fn(ifname, peers)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    args = docopt(__doc__)
+    ifname = args['--iface']
+    counts = [int(count) for count in args['--peers'].split(',')]
+    backends = {
+        'wg set per peer': legacy,
+        'wg addconf': WGProcBackend().set_peers,
+        'netlink': WGBackend.create('netlink').set_peers,
+    }
+    print(f'{"peers":>8} {"backend":>16} {"total s":>10} {"per peer us":>12}')
+    with IPRoute() as ip:
+        try:
+            for count in counts:
+                peers = make_peers(count)
+                for name, fn in backends.items():
+                    elapsed = timed(ip, ifname, peers, fn)
+                    print(f'{count:>8} {name:>16} {elapsed:>10.4f} '
+                          f'{elapsed / count * 1e6:>12.1f}')
+        finally:
+            if ip.link_lookup(ifname=ifname):
+                ip.link('del', ifname=ifname)
+
+
+if __name__ == '__main__':
+    main()
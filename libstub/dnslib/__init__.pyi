@@ -2,6 +2,8 @@ from typing import Any
 
 DNSRecord: Any
 DNSLabel: Any
+DNSBuffer: Any
+DNSHeader: Any
 QTYPE: Any
 RCODE: Any
 RD: Any
@@ -12,3 +14,4 @@ RR: Any
 PTR: Any
 SRV: Any
 TXT: Any
+EDNS0: Any
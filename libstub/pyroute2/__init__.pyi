@@ -3,6 +3,7 @@ from typing import (
     Any,
     Dict,
     List,
+    Optional,
 )
 
 
@@ -20,5 +21,25 @@ class IPRoute:
     def __exit__(self, *args: Any) -> None: ...
 
     def link_lookup(self, ifname: str) -> List[Any]: ...
-    def get_addr(self, label: str) -> List[Any]: ...
-    def get_links(self) -> List[Any]: ...
+    def get_addr(
+        self,
+        label: Optional[str] = None,
+        index: Optional[int] = None,
+    ) -> List[Any]: ...
+    def get_links(self, *index: int) -> List[Any]: ...
+    def link(self, command: str, **kwargs: Any) -> Any: ...
+    def addr(self, command: str, **kwargs: Any) -> Any: ...
+    def close(self) -> None: ...
+
+
+class WireGuard:
+    def info(self, interface: str) -> List[Any]: ...
+    def set(
+        self,
+        interface: str,
+        listen_port: Any = None,
+        fwmark: Any = None,
+        private_key: Any = None,
+        peer: Any = None,
+    ) -> Any: ...
+    def close(self) -> None: ...
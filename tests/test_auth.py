@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+from typing import Dict, Optional
+import unittest
+import base64
+import hashlib
+
+from zeroconf import ServiceInfo
+
+from zerowire import auth
+
+TYPE = '_wireguard._udp.local.'
+NAME = f'abc.{TYPE}'
+PSK = '1j75n1Zcwp9tUMuFH5H6C5Jn0PVjk66UXqSbY/OTjb8='
+OTHER_PSK = 'aKwoU/4zwKzc89RLS1/ioOGHqqcSQPgTeMNfiPMrbGc='
+
+
+def properties() -> Dict[bytes, Optional[bytes]]:
+    return {
+        b'addr': b'fd00::2',
+        b'hostname': b'remote',
+        b'pubkey': b'h+LAI3+61Va12APH9GXLEy7NZdCLAPIb/ndrj9rsFBI=',
+        b'salt': b'c2FsdA==',
+        b'probe': b'4321',
+    }
+
+
+def service(props: Dict[bytes, Optional[bytes]]) -> ServiceInfo:
+    return ServiceInfo(TYPE, NAME, port=1234, properties=props)
+
+
+def signed(psk: str = PSK, compat: bool = False) -> ServiceInfo:
+    props = properties()
+    props[b'hmac'] = auth.sign(NAME, 1234, props, psk)
+    if compat:
+        props[b'auth'] = auth.legacy_digest(NAME, 1234, props, psk)
+    return service(props)
+
+
+def legacy(psk: str = PSK) -> ServiceInfo:
+    '''As announced by releases before the HMAC.'''
+    props = properties()
+    digest = hashlib.sha256(NAME.encode() + b'1234' + b''.join(
+        props[key] or b''
+        for key in (b'addr', b'hostname', b'pubkey', b'salt')
+    ) + psk.encode())
+    props[b'auth'] = base64.b64encode(digest.digest())
+    return service(props)
+
+
+class Test_verify(unittest.TestCase):
+    def test_hmac(self) -> None:
+        self.assertTrue(auth.verify(signed(), PSK, compat=False))
+        self.assertFalse(auth.verify(signed(), OTHER_PSK))
+
+    def test_tampered(self) -> None:
+        info = signed()
+        props = dict(info.properties)
+        props[b'probe'] = b'1'
+
+        self.assertFalse(auth.verify(service(props), PSK))
+
+    def test_legacy(self) -> None:
+        self.assertTrue(auth.verify(legacy(), PSK))
+        self.assertFalse(auth.verify(legacy(), OTHER_PSK))
+        self.assertFalse(auth.verify(legacy(), PSK, compat=False))
+
+    def test_both(self) -> None:
+        info = signed(compat=True)
+
+        self.assertTrue(auth.verify(info, PSK, compat=False))
+        self.assertEqual(
+            info.properties[b'auth'], legacy().properties[b'auth'])
+
+    def test_no_downgrade(self) -> None:
+        props = dict(legacy().properties)
+        props[b'hmac'] = auth.sign(NAME, 1234, props, OTHER_PSK)
+
+        self.assertFalse(auth.verify(service(props), PSK))
+
+    def test_malformed(self) -> None:
+        props = properties()
+        props[b'hmac'] = b'not base64!'
+
+        self.assertFalse(auth.verify(service(props), PSK))
+        self.assertFalse(auth.verify(service(properties()), PSK))
+
+
+class Test_ServiceVerifier(unittest.TestCase):
+    def test_cached(self) -> None:
+        verifier = auth.ServiceVerifier(PSK)
+
+        self.assertTrue(verifier.verify(signed()))
+        self.assertFalse(verifier.verify(signed(OTHER_PSK)))
+        self.assertTrue(verifier.verify(signed()))
+        self.assertFalse(verifier.verify(signed(OTHER_PSK)))
+
+        self.assertEqual((verifier.hits, verifier.misses), (2, 2))
+
+    def test_changed(self) -> None:
+        verifier = auth.ServiceVerifier(PSK)
+        info = signed()
+        verifier.verify(info)
+        props = dict(info.properties)
+        props[b'addr'] = b'fd00::3'
+
+        self.assertFalse(verifier.verify(service(props)))
+        self.assertEqual(verifier.misses, 2)
+
+    def test_bounded(self) -> None:
+        verifier = auth.ServiceVerifier(PSK, max_entries=2)
+        first = signed()
+        verifier.verify(first)
+        verifier.verify(legacy())
+        verifier.verify(signed(compat=True))
+
+        self.assertEqual(len(verifier), 2)
+        verifier.verify(first)
+        self.assertEqual(verifier.hits, 0)
+
+    def test_compat(self) -> None:
+        self.assertFalse(
+            auth.ServiceVerifier(PSK, compat=False).verify(legacy()))
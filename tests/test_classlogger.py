@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+from typing import Any
+import unittest
+import logging
+from unittest.mock import patch
+
+from zerowire import classlogger
+from zerowire.classlogger import ClassLogger
+
+
+class Loud:
+    '''Counts how often it is formatted.'''
+    def __init__(self) -> None:
+        self.formatted = 0
+
+    def __str__(self) -> str:
+        self.formatted += 1
+        return 'loud value'
+
+
+class Emitter(ClassLogger):
+    def __init__(self, name: str) -> None:
+        self._setLoggerName(name)
+
+
+class Test_log_event(unittest.TestCase):
+    def setUp(self) -> None:
+        self.emitter = Emitter(self.id())
+        classlogger.LIMITS.clear()
+
+    def test_format(self) -> None:
+        with self.assertLogs(self.emitter.logger, logging.INFO) as logs:
+            self.emitter.log_event(
+                logging.INFO, 'peer_found', service='a', port=1234,
+                reason='no usable address', empty='')
+
+        record = logs.records[0]
+        self.assertEqual(
+            record.getMessage(),
+            'peer_found service=a port=1234 reason="no usable address" '
+            'empty=""')
+        self.assertEqual(getattr(record, 'event'), 'peer_found')
+        self.assertEqual(getattr(record, 'fields')['port'], 1234)
+
+    def test_level_off(self) -> None:
+        loud = Loud()
+        with self.assertLogs(self.emitter.logger, logging.INFO) as logs:
+            self.emitter.log_event(logging.DEBUG, 'reply', value=loud)
+            self.emitter.log_event(logging.INFO, 'other')
+
+        self.assertEqual(len(logs.records), 1)
+        self.assertEqual(loud.formatted, 0)
+        self.assertEqual(classlogger.LIMITS, {})
+
+    def test_rate(self) -> None:
+        clock = [100.0]
+
+        def monotonic() -> float:
+            return clock[0]
+
+        with patch('time.monotonic', monotonic), \
+                self.assertLogs(self.emitter.logger, logging.INFO) as logs:
+            for _ in range(5):
+                self.emitter.log_event(logging.INFO, 'query', rate=2)
+            clock[0] += 1
+            for _ in range(3):
+                self.emitter.log_event(logging.INFO, 'query', rate=2)
+
+        self.assertEqual([record.getMessage() for record in logs.records], [
+            'query',
+            'query',
+            'query suppressed=3',
+            'query',
+        ])
+
+    def test_sample(self) -> None:
+        def log(**fields: Any) -> None:
+            self.emitter.log_event(logging.INFO, 'service', sample=3, **fields)
+
+        with self.assertLogs(self.emitter.logger, logging.INFO) as logs:
+            for i in range(7):
+                log(n=i)
+
+        self.assertEqual([record.getMessage() for record in logs.records], [
+            'service n=2 sampled=3',
+            'service n=5 sampled=3',
+        ])
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 import unittest
-from unittest.mock import patch
+from unittest.mock import patch, call, MagicMock
 import io
 import ipaddress
 
@@ -134,17 +134,43 @@ class Test_Config(ProcTest, unittest.TestCase):
             self.assertIsInstance(service, config.ServiceConfig)
 
 
-class Test_IfaceConfig_BASIC(ProcTest, unittest.TestCase):
+PUBKEY = 'h+LAI3+61Va12APH9GXLEy7NZdCLAPIb/ndrj9rsFBI='
+ADDR = 'fd01:203:405:607:809:a0b:d0e:f10'
+
+
+def link(kind: str = 'wireguard', flags: int = config.IFF_UP) -> MagicMock:
+    linkinfo = MagicMock()
+    linkinfo.get_attr.return_value = kind
+    msg = MagicMock()
+    msg.get_attr.return_value = linkinfo
+    msg.__getitem__.side_effect = {'flags': flags}.__getitem__
+    return msg
+
+
+def addr(address: str = ADDR, prefixlen: int = 64) -> MagicMock:
+    msg = MagicMock()
+    msg.get_attr.return_value = address
+    msg.__getitem__.side_effect = {'prefixlen': prefixlen}.__getitem__
+    return msg
+
+
+class IfaceConfigTest(ProcTest):
+    CONFIG = BASIC_CONFIG
+
     def setUp(self) -> None:
         super().setUp()
-        file = io.StringIO(BASIC_CONFIG)
+        file = io.StringIO(self.CONFIG)
         self.ifconfig = config.Config.load(file)['wg-test']
-        self.__IPDB = patch('zerowire.config.IPDB')
-        self.IPDB = self.__IPDB.start()
+        self.__pool = patch('zerowire.config.IPRoutePool')
+        pool = self.__pool.start()
+        self.ip = pool.get.return_value.__enter__.return_value
+        self.ip.link_lookup.return_value = [7]
+        self.ip.get_links.return_value = [link()]
+        self.ip.get_addr.return_value = [addr()]
 
     def tearDown(self) -> None:
         super().tearDown()
-        self.__IPDB.stop()
+        self.__pool.stop()
 
     def test_prefix(self) -> None:
         prefix = self.ifconfig.prefix
@@ -152,53 +178,52 @@ class Test_IfaceConfig_BASIC(ProcTest, unittest.TestCase):
         self.assertIsInstance(prefix, ipaddress.IPv6Network)
         self.assertIn(self.ifconfig.addr, prefix)
 
-    def test_configure_iface_exists(self) -> None:
-        ctx = self.IPDB.return_value.__enter__.return_value
-        ctx.interfaces.__contains__.return_value = True
-        ctxiface = ctx.interfaces.__getitem__.return_value
+    def test_changed(self) -> None:
+        other = config.Config.load(io.StringIO(SERVICES_CONFIG))['wg-test']
 
-        self.setRunSideEffects('', 'test\trar\t1234\tnone')
+        self.assertEqual(self.ifconfig.changed(self.ifconfig), set())
+        self.assertEqual(
+            self.ifconfig.changed(other),
+            {'services'} if self.ifconfig.port else {'port', 'services'})
 
-        self.ifconfig.configure()
+        self.ifconfig.port = 1234
+        other.port = None
+        self.assertEqual(self.ifconfig.changed(other), {'services'})
 
-        self.IPDB.assert_called_once_with()
+    def assertRunCount(self, count: int) -> None:
+        assert self.run.call_count == count, self.run.call_args_list
 
-        # Remove current iface
-        ctx.interfaces.__contains__.assert_called_once_with('wg-test')
-        ctx.interfaces.__getitem__.assert_called_once_with('wg-test')
-        ctxiface.remove.assert_called_once_with()
-        ctxiface.remove.return_value.commit.assert_called_once_with()
+    def assertLinkUntouched(self) -> None:
+        self.ip.link.assert_not_called()
+        self.ip.addr.assert_not_called()
 
-        self.assertSubprocesses(
-            ([
-                'set',
-                'wg-test',
-                'private-key',
-                '/dev/stdin',
-            ], self.ifconfig.privkey),
-            (['show', 'wg-test', 'dump'], None)
-        )
-
-        self.assertEqual(self.ifconfig.port, 1234)
 
-    def test_configure_iface_not_exists(self) -> None:
-        ctx = self.IPDB.return_value.__enter__.return_value
-        ctx.interfaces.__contains__.return_value = False
-        ctxiface = ctx.interfaces.__getitem__.return_value
-
-        self.setRunSideEffects('', 'test\trar\t1234\tnone')
-
-        self.ifconfig.configure()
+class Test_IfaceConfig_BASIC(IfaceConfigTest, unittest.TestCase):
+    def test_configure_iface_exists(self) -> None:
+        self.setRunSideEffects(f'priv\t{PUBKEY}\t1234\toff')
 
-        self.IPDB.assert_called_once_with()
+        self.assertFalse(self.ifconfig.configure())
 
-        # Remove current iface
-        ctx.interfaces.__contains__.assert_called_once_with('wg-test')
-        ctx.interfaces.__getitem__.assert_not_called()
-        ctxiface.remove.assert_not_called()
-        ctxiface.remove.return_value.commit.assert_not_called()
+        self.assertLinkUntouched()
+        self.assertSubprocess(['show', 'wg-test', 'dump'])
+        self.assertRunCount(1)
+        self.assertEqual(self.ifconfig.port, 1234)
 
+    def test_configure_iface_not_exists(self) -> None:
+        self.ip.link_lookup.side_effect = [[], [7]]
+        self.ip.get_addr.return_value = []
+        self.setRunSideEffects('', '', 'test\trar\t1234\tnone')
+
+        self.assertTrue(self.ifconfig.configure())
+
+        self.ip.link.assert_has_calls([
+            call('add', ifname='wg-test', kind='wireguard'),
+            call('set', index=7, state='up'),
+        ])
+        self.ip.addr.assert_called_once_with(
+            'add', index=7, address=ADDR, prefixlen=64)
         self.assertSubprocesses(
+            (['show', 'wg-test', 'dump'], None),
             ([
                 'set',
                 'wg-test',
@@ -207,45 +232,54 @@ class Test_IfaceConfig_BASIC(ProcTest, unittest.TestCase):
             ], self.ifconfig.privkey),
             (['show', 'wg-test', 'dump'], None),
         )
-
         self.assertEqual(self.ifconfig.port, 1234)
 
+    def test_configure_other_kind(self) -> None:
+        self.ip.link_lookup.side_effect = [[7], [8]]
+        self.ip.get_links.return_value = [link('dummy')]
+        self.ip.get_addr.return_value = []
+        self.setRunSideEffects('', '', 'test\trar\t1234\tnone')
 
-class Test_IfaceConfig_PORT(ProcTest, unittest.TestCase):
-    def setUp(self) -> None:
-        super().setUp()
-        file = io.StringIO(PORT_CONFIG)
-        self.ifconfig = config.Config.load(file)['wg-test']
-        self.__IPDB = patch('zerowire.config.IPDB')
-        self.IPDB = self.__IPDB.start()
+        self.ifconfig.configure()
 
-    def tearDown(self) -> None:
-        super().tearDown()
-        self.__IPDB.stop()
+        self.ip.link.assert_has_calls([
+            call('del', index=7),
+            call('add', ifname='wg-test', kind='wireguard'),
+            call('set', index=8, state='up'),
+        ])
 
-    def test_prefix(self) -> None:
-        prefix = self.ifconfig.prefix
+    def test_configure_stale_addr(self) -> None:
+        self.ip.get_links.return_value = [link(flags=0)]
+        self.ip.get_addr.return_value = [
+            addr('fd00::1'), addr('fe80::1'), addr()]
+        self.setRunSideEffects(f'priv\t{PUBKEY}\t1234\toff')
 
-        self.assertIsInstance(prefix, ipaddress.IPv6Network)
-        self.assertIn(self.ifconfig.addr, prefix)
+        self.assertTrue(self.ifconfig.configure())
+
+        self.ip.addr.assert_called_once_with(
+            'del', index=7, address='fd00::1', prefixlen=64)
+        self.ip.link.assert_called_once_with('set', index=7, state='up')
+        self.assertRunCount(1)
+
+
+class Test_IfaceConfig_PORT(IfaceConfigTest, unittest.TestCase):
+    CONFIG = PORT_CONFIG
 
     def test_configure_iface_exists(self) -> None:
-        ctx = self.IPDB.return_value.__enter__.return_value
-        ctx.interfaces.__contains__.return_value = True
-        ctxiface = ctx.interfaces.__getitem__.return_value
+        self.setRunSideEffects(f'priv\t{PUBKEY}\t19920\toff')
 
-        self.setRunSideEffects('', 'test\trar\t1234\tnone')
+        self.assertFalse(self.ifconfig.configure())
 
-        self.ifconfig.configure()
+        self.assertLinkUntouched()
+        self.assertRunCount(1)
+        self.assertEqual(self.ifconfig.port, 19920)
 
-        self.IPDB.assert_called_once_with()
+    def test_configure_port_changed(self) -> None:
+        self.setRunSideEffects(f'priv\t{PUBKEY}\t1234\toff', '')
 
-        # Remove current iface
-        ctx.interfaces.__contains__.assert_called_once_with('wg-test')
-        ctx.interfaces.__getitem__.assert_called_once_with('wg-test')
-        ctxiface.remove.assert_called_once_with()
-        ctxiface.remove.return_value.commit.assert_called_once_with()
+        self.assertTrue(self.ifconfig.configure())
 
+        self.assertLinkUntouched()
         self.assertSubprocess(
             [
                 'set',
@@ -257,27 +291,18 @@ class Test_IfaceConfig_PORT(ProcTest, unittest.TestCase):
             ],
             input=self.ifconfig.privkey
         )
-
+        self.assertRunCount(2)
         self.assertEqual(self.ifconfig.port, 19920)
 
     def test_configure_iface_not_exists(self) -> None:
-        ctx = self.IPDB.return_value.__enter__.return_value
-        ctx.interfaces.__contains__.return_value = False
-        ctxiface = ctx.interfaces.__getitem__.return_value
+        self.ip.link_lookup.side_effect = [[], [7]]
+        self.ip.get_addr.return_value = []
+        self.setRunSideEffects('', '')
 
-        self.setRunSideEffects('', 'test\trar\t1234\tnone')
-
-        self.ifconfig.configure()
-
-        self.IPDB.assert_called_once_with()
-
-        # Remove current iface
-        ctx.interfaces.__contains__.assert_called_once_with('wg-test')
-        ctx.interfaces.__getitem__.assert_not_called()
-        ctxiface.remove.assert_not_called()
-        ctxiface.remove.return_value.commit.assert_not_called()
+        self.assertTrue(self.ifconfig.configure())
 
         self.assertSubprocesses(
+            (['show', 'wg-test', 'dump'], None),
             ([
                 'set',
                 'wg-test',
@@ -285,9 +310,9 @@ class Test_IfaceConfig_PORT(ProcTest, unittest.TestCase):
                 '19920',
                 'private-key',
                 '/dev/stdin'
-            ], self.ifconfig.privkey)
+            ], self.ifconfig.privkey),
         )
-
+        self.assertRunCount(2)
         self.assertEqual(self.ifconfig.port, 19920)
 
 
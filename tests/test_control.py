@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+from typing import Any, Dict, List
+import unittest
+import asyncio
+import ipaddress
+import os
+import stat
+import sys
+import tempfile
+from unittest.mock import patch
+
+from dnslib import A, QTYPE
+
+from zerowire import args, control, dnsclient, peers, records
+
+NOW = 10000.0
+
+
+def entry() -> peers.PeerEntry:
+    return peers.PeerEntry(
+        pubkey='a',
+        name='a._wireguard._udp.local.',
+        hostname='a.zerowire.',
+        internal_addr=ipaddress.ip_address('fd00::2'),
+        endpoint=(ipaddress.ip_address('fe80::2'), 1234),
+        last_seen=NOW - 30,
+        latest_handshake=NOW - 5,
+        withdrawn=True,
+    )
+
+
+def status() -> Dict[str, Any]:
+    return {
+        'version': '0.1.0',
+        'started': NOW - 600,
+        'interfaces': [{
+            'name': 'wg0',
+            'addr': 'fd00::1/64',
+            'listen_port': 51820,
+            'peers': [control.peer_status(entry(), None)],
+        }],
+        'zone': {'a.zerowire.': {'AAAA': ['fd00::2']}},
+        'dns_client': {
+            'sent': 12, 'timeouts': 3, 'hedges': 2, 'short_circuits': 1,
+            'hosts': [
+                {'host': 'fd00::2', 'srtt': 0.0125, 'rto': 0.2,
+                 'failures': 0, 'breaker': 'closed'},
+                {'host': 'fd00::3', 'srtt': None, 'rto': 2.0,
+                 'failures': 3, 'breaker': 'open'},
+            ],
+        },
+        'counters': {},
+    }
+
+
+class Test_format(unittest.TestCase):
+    def test_peer_status(self) -> None:
+        peer = control.peer_status(entry(), None)
+
+        self.assertEqual(peer['endpoint'], '[fe80::2]:1234')
+        self.assertEqual(peer['latest_handshake'], NOW - 5)
+        self.assertFalse(peer['kernel'])
+
+    def test_zone_status(self) -> None:
+        store = records.RecordStore()
+        store.add('a.zerowire', QTYPE.A, A('10.0.0.2'))
+
+        self.assertEqual(control.zone_status(store.snapshot()), {
+            'a.zerowire.': {'A': ['10.0.0.2']},
+        })
+
+    def test_dns_client_status(self) -> None:
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        pool = dnsclient.DNSClientPool()
+        up = ipaddress.ip_address('fd00::2')
+        down = ipaddress.ip_address('fd00::3')
+        pool.host_health(up).observe(0.01)
+        for _ in range(dnsclient.BREAKER_FAILURES):
+            pool.host_health(down).timed_out(loop.time())
+
+        client = control.dns_client_status(pool)
+
+        self.assertEqual(client['sent'], 0)
+        self.assertEqual(
+            [(host['host'], host['srtt'], host['breaker'])
+             for host in client['hosts']],
+            [('fd00::2', 0.01, 'closed'), ('fd00::3', None, 'open')])
+
+    def test_format_status(self) -> None:
+        self.assertEqual(control.format_status(status(), NOW).splitlines(), [
+            'ZeroWire 0.1.0, up 10m',
+            'wg0 fd00::1/64 port 51820, 1 peers',
+            '  a.zerowire. fd00::2 [fe80::2]:1234 handshake 5s ago, '
+            'seen 30s ago, withdrawn, not in kernel',
+            'dns 12 sent, 3 timeouts, 2 hedges, 1 short circuits',
+            '  fd00::2 rtt 12ms, rto 200ms, breaker closed',
+            '  fd00::3 no rtt, rto 2000ms, breaker open',
+            'zone 1 names, 1 records',
+        ])
+
+    def test_args(self) -> None:
+        argv = ['zerowire', 'status', '--watch', '--control=/tmp/sock']
+        with patch.object(sys, 'argv', argv):
+            parsed = args.parse()
+
+        self.assertEqual(parsed, args.StatusArgs('/tmp/sock', True, 2, False))
+
+
+class Test_ControlServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'run', 'control.sock')
+        self.status = status()
+        self.server = control.ControlServer(self.path, lambda: self.status)
+        self.loop.run_until_complete(self.server.start())
+
+    def tearDown(self) -> None:
+        self.server.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.dir.cleanup()
+
+    def request(self, command: str, count: int, **params: Any) -> List[Any]:
+        '''The first `count` replies, read by the blocking client.'''
+        def read() -> List[Any]:
+            replies = []
+            for reply in control.request(self.path, command, **params):
+                replies.append(reply)
+                if len(replies) == count:
+                    break
+            return replies
+        return self.loop.run_until_complete(
+            self.loop.run_in_executor(None, read))
+
+    def test_status(self) -> None:
+        self.assertEqual(self.request('status', 1), [self.status])
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+
+    def test_watch(self) -> None:
+        def change() -> None:
+            self.status = dict(self.status, started=0)
+        self.loop.call_later(0.15, change)
+
+        replies = self.request('watch', 2, interval=0.1)
+
+        self.assertEqual([reply['started'] for reply in replies],
+                         [NOW - 600, 0])
+        self.loop.run_until_complete(asyncio.sleep(0.2))
+        self.assertEqual(self.server.writers, set())
+
+    def test_unknown(self) -> None:
+        with self.assertRaises(ValueError):
+            self.request('reboot', 1)
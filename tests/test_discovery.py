@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import unittest
+import asyncio
+import time
+from threading import Lock
+from typing import List, Optional, Tuple
+from unittest.mock import Mock
+
+from zerowire import discovery
+
+
+class FakeZeroconf:
+    def __init__(self, delay: float) -> None:
+        self.delay = delay
+        self.lock = Lock()
+        self.resolved: List[str] = []
+
+    def get_service_info(self, type: str, name: str, timeout: int) -> Mock:
+        time.sleep(self.delay)
+        with self.lock:
+            self.resolved.append(name)
+        return Mock(name=name)
+
+
+class Test_DiscoveryPipeline(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.handled: List[Tuple[str, Optional[Mock]]] = []
+
+    def tearDown(self) -> None:
+        self.pipeline.close()
+        self.loop.run_until_complete(asyncio.gather(
+            *self.pipeline.workers, return_exceptions=True))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def handler(self, name: str, info: Optional[Mock]) -> None:
+        self.handled.append((name, info))
+
+    def run_pipeline(self, *names: str) -> None:
+        self.loop.run_until_complete(self.pipeline.start())
+        for name in names:
+            self.pipeline.push(name)
+
+        async def drain() -> None:
+            await asyncio.sleep(0)
+            await self.pipeline.queue.join()
+        self.loop.run_until_complete(drain())
+
+    def test_dedupe(self) -> None:
+        zeroconf = FakeZeroconf(0)
+        self.pipeline = discovery.DiscoveryPipeline(
+            zeroconf, 'type', self.handler)  # type: ignore
+
+        self.run_pipeline('a', 'a', 'b', 'a')
+
+        self.assertEqual(sorted(zeroconf.resolved), ['a', 'b'])
+        self.assertEqual(sorted(name for name, _ in self.handled), ['a', 'b'])
+
+    def test_concurrent(self) -> None:
+        zeroconf = FakeZeroconf(0.1)
+        self.pipeline = discovery.DiscoveryPipeline(
+            zeroconf, 'type', self.handler, concurrency=8)  # type: ignore
+
+        start = time.monotonic()
+        self.run_pipeline(*(str(i) for i in range(16)))
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(len(self.handled), 16)
+        self.assertLess(elapsed, 0.8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+from typing import Optional, Tuple, cast
+import unittest
+import asyncio
+import socket
+import ipaddress
+
+from dnslib import AAAA, DNSRecord, EDNS0, QTYPE, RCODE, RR
+
+from zerowire import dns, metrics
+from zerowire.config import ServiceConfig
+from zerowire.dnsclient import DNSClientPool
+
+SOURCE = (ipaddress.ip_address('fd00::2'), 5353)
+
+
+class Test_InterfaceDNSServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = dns.InterfaceDNSServer(
+            'host', ipaddress.ip_interface('fd00::1/64'))
+        self.server.add_service(ServiceConfig.from_dict(
+            {'type': '_http._tcp', 'name': 'web', 'port': 80}))
+
+    def tearDown(self) -> None:
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def query(
+        self,
+        data: bytes,
+        source: Tuple[ipaddress.IPv6Address, int] = SOURCE,
+    ) -> Optional[bytes]:
+        '''Answer like DNSServerProtocol, from the cache if possible.'''
+        packed = self.server.cached_reply(data, source)
+        if packed is not None:
+            return packed
+        return self.loop.run_until_complete(self.server.answer(data, source))
+
+    def test_question_key(self) -> None:
+        query = DNSRecord.question('Web._HTTP._tcp.host.zerowire.', 'SRV')
+        other = DNSRecord.question('web._http._tcp.HOST.zerowire.', 'SRV')
+
+        key = dns.question_key(query.pack())
+
+        self.assertIsNotNone(key)
+        self.assertEqual(key, dns.question_key(other.pack()))
+        self.assertNotEqual(key, dns.question_key(DNSRecord.question(
+            'web._http._tcp.host.zerowire.', 'TXT').pack()))
+        self.assertIsNone(dns.question_key(query.reply().pack()))
+        self.assertIsNone(dns.question_key(b'\0' * 12))
+
+    def test_question_key_edns(self) -> None:
+        def edns(udp_len: int, **kwargs: int) -> bytes:
+            query = DNSRecord.question('web._http._tcp.host.zerowire.', 'SRV')
+            query.add_ar(EDNS0(udp_len=udp_len, **kwargs))
+            return query.pack()
+
+        key = dns.question_key(edns(4096))
+
+        self.assertIsNotNone(key)
+        self.assertEqual(key, dns.question_key(edns(1400)))
+        self.assertEqual(key, dns.question_key(edns(4096, flags='do')))
+        self.assertNotEqual(key, dns.question_key(edns(600)))
+        self.assertNotEqual(key, dns.question_key(DNSRecord.question(
+            'web._http._tcp.host.zerowire.', 'SRV').pack()))
+        self.assertIsNone(dns.question_key(edns(4096, version=1)))
+        query = DNSRecord.parse(edns(4096))
+        query.add_ar(RR('x.', QTYPE.AAAA, rdata=AAAA('fd00::1')))
+        self.assertIsNone(dns.question_key(query.pack()))
+
+    def test_cached_reply(self) -> None:
+        first = DNSRecord.question('web._http._tcp.host.zerowire.', 'SRV')
+        second = DNSRecord.question('WEB._http._tcp.host.zerowire.', 'SRV')
+        second.header.rd = 0
+
+        self.query(first.pack())
+        packed = self.server.cached_reply(second.pack(), SOURCE)
+
+        assert packed is not None
+        reply = DNSRecord.parse(packed)
+        self.assertEqual(reply.header.id, second.header.id)
+        self.assertEqual(reply.header.rd, 0)
+        self.assertEqual(reply.header.qr, 1)
+        self.assertEqual(str(reply.q.qname), str(second.q.qname))
+        self.assertEqual(reply.rr[0].rtype, QTYPE.SRV)
+        self.assertEqual(reply.rr[0].rdata.port, 80)
+
+    def test_cached_edns(self) -> None:
+        first = DNSRecord.question('web._http._tcp.host.zerowire.', 'SRV')
+        first.add_ar(EDNS0(udp_len=4096))
+        second = DNSRecord.question('WEB._http._tcp.host.zerowire.', 'SRV')
+        second.add_ar(EDNS0(udp_len=1232))
+
+        self.query(first.pack())
+        packed = self.server.cached_reply(second.pack(), SOURCE)
+
+        assert packed is not None
+        reply = DNSRecord.parse(packed)
+        self.assertEqual(reply.header.id, second.header.id)
+        self.assertEqual(str(reply.q.qname), str(second.q.qname))
+        self.assertEqual(reply.rr[0].rdata.port, 80)
+        self.assertEqual(reply.ar[0].rtype, QTYPE.OPT)
+        self.assertEqual(reply.ar[0].rclass, dns.EDNS_UDP_SIZE)
+        # Without EDNS0 the client must not get an OPT record
+        self.assertIsNone(self.server.cached_reply(
+            DNSRecord.question(
+                'web._http._tcp.host.zerowire.', 'SRV').pack(),
+            SOURCE))
+
+    def test_negative_cached(self) -> None:
+        query = DNSRecord.question('nope.host.zerowire.', 'A').pack()
+
+        self.query(query)
+        packed = self.server.cached_reply(query, SOURCE)
+
+        assert packed is not None
+        self.assertEqual(DNSRecord.parse(packed).header.rcode, RCODE.NXDOMAIN)
+
+    def test_foreign_source_not_served(self) -> None:
+        query = DNSRecord.question('web._http._tcp.host.zerowire.', 'SRV')
+        self.query(query.pack())
+
+        self.assertIsNone(self.server.cached_reply(
+            query.pack(), (ipaddress.ip_address('fd01::2'), 53)))
+
+    def test_remove_service(self) -> None:
+        admin = ServiceConfig.from_dict(
+            {'type': '_http._tcp', 'name': 'admin', 'port': 8080})
+        self.server.add_service(admin)
+
+        self.server.remove_service(admin)
+
+        self.assertEqual(
+            len(self.server.get_records('_http._tcp', QTYPE.PTR)), 1)
+        self.assertFalse(self.server.has_name('admin._http._tcp'))
+        services = '_services._dns-sd._udp'
+        self.assertEqual(len(self.server.get_records(services, QTYPE.PTR)), 2)
+
+        self.server.remove_service(ServiceConfig.from_dict(
+            {'type': '_http._tcp', 'name': 'web', 'port': 80}))
+
+        self.assertEqual(len(self.server.get_records(services, QTYPE.PTR)), 1)
+        self.assertEqual(self.server.get_records('_http._tcp', QTYPE.PTR), ())
+
+    def test_invalidated_on_change(self) -> None:
+        query = DNSRecord.question('_http._tcp.host.zerowire.', 'PTR').pack()
+        self.query(query)
+        self.assertIsNotNone(self.server.cached_reply(query, SOURCE))
+
+        self.server.add_service(ServiceConfig.from_dict(
+            {'type': '_http._tcp', 'name': 'admin', 'port': 8080}))
+
+        self.assertIsNone(self.server.cached_reply(query, SOURCE))
+        packed = self.query(query)
+        assert packed is not None
+        self.assertEqual(len(DNSRecord.parse(packed).rr), 2)
+
+
+class Test_LargeResponses(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        self.server = dns.InterfaceDNSServer(
+            'host', ipaddress.ip_interface('127.0.0.1/8'), port)
+        # Each type adds a PTR of ~40 bytes to _services._dns-sd._udp
+        for i in range(40):
+            self.server.add_service(ServiceConfig.from_dict(
+                {'type': f'_svc{i}._tcp', 'name': 'web', 'port': 80}))
+        self.loop.run_until_complete(self.server.start())
+        self.source = (ipaddress.ip_address('127.0.0.1'), 5353)
+
+    def tearDown(self) -> None:
+        self.server.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def services(self, udp_len: Optional[int] = None) -> DNSRecord:
+        query = DNSRecord.question(
+            '_services._dns-sd._udp.host.zerowire.', 'PTR')
+        if udp_len is not None:
+            query.add_ar(EDNS0(udp_len=udp_len))
+        return query
+
+    def answer(self, query: DNSRecord) -> DNSRecord:
+        packed = self.loop.run_until_complete(
+            self.server.answer(query.pack(), self.source))
+        assert packed is not None
+        return DNSRecord.parse(packed)
+
+    def test_truncated_without_edns(self) -> None:
+        reply = self.answer(self.services())
+
+        self.assertEqual(reply.header.tc, 1)
+        self.assertEqual(reply.rr, [])
+        self.assertEqual(len(reply.questions), 1)
+
+    def test_metrics(self) -> None:
+        before = metrics.DNS_QUERIES.count(self.server.name, 'NOERROR')
+
+        self.answer(self.services())
+
+        self.assertEqual(
+            metrics.DNS_QUERIES.count(self.server.name, 'NOERROR'),
+            before + 1)
+
+    def test_edns_buffer(self) -> None:
+        reply = self.answer(self.services(4096))
+
+        self.assertEqual(reply.header.tc, 0)
+        self.assertEqual(len(reply.rr), 41)
+        self.assertEqual(reply.ar[0].rtype, QTYPE.OPT)
+        self.assertEqual(reply.ar[0].rclass, dns.EDNS_UDP_SIZE)
+
+        self.assertEqual(self.answer(self.services(600)).header.tc, 1)
+
+    def test_cached_per_size(self) -> None:
+        self.answer(self.services(600))
+        self.answer(self.services(4096))
+
+        for udp_len, tc in ((600, 1), (4096, 0)):
+            packed = self.server.cached_reply(
+                self.services(udp_len).pack(), self.source)
+            assert packed is not None
+            self.assertEqual(DNSRecord.parse(packed).header.tc, tc)
+
+    def test_tcp_fallback(self) -> None:
+        client = DNSClientPool(timeout=0.5)
+        try:
+            reply = self.loop.run_until_complete(client.query(
+                self.server.bind, self.server.port, self.services()))
+        finally:
+            client.close()
+
+        self.assertEqual(reply.header.tc, 0)
+        self.assertEqual(len(reply.rr), 41)
+        self.assertEqual(client.tcp_fallbacks, 1)
+
+    def test_tcp_connection_reuse(self) -> None:
+        async def exchange() -> Tuple[DNSRecord, DNSRecord]:
+            reader, writer = await asyncio.open_connection(
+                '127.0.0.1', self.server.port)
+            replies = []
+            for query in (self.services(), self.services()):
+                packed = query.pack()
+                writer.write(dns.TCP_LENGTH.pack(len(packed)) + packed)
+                length, = dns.TCP_LENGTH.unpack(await reader.readexactly(2))
+                replies.append(DNSRecord.parse(
+                    await reader.readexactly(length)))
+            writer.close()
+            return replies[0], replies[1]
+
+        first, second = self.loop.run_until_complete(exchange())
+
+        self.assertEqual(len(first.rr), 41)
+        self.assertEqual(len(second.rr), 41)
+
+
+class Upstream(asyncio.DatagramProtocol):
+    '''Answers every A question with 192.0.2.1.'''
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = cast(asyncio.DatagramTransport, transport)
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        request = DNSRecord.parse(data)
+        reply = request.reply()
+        reply.add_answer(*RR.fromZone(f'{request.q.qname} 60 A 192.0.2.1'))
+        self.transport.sendto(reply.pack(), addr)
+
+
+class Test_StubResolver(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        localhost = ipaddress.ip_address('127.0.0.1')
+        self.transport, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                Upstream, local_addr=('127.0.0.1', 0)))
+        port = self.transport.get_extra_info('sockname')[1]
+        self.server = dns.LocalDNSServer(
+            localhost, 0, upstreams=[(localhost, port)])
+        self.server.client.attempts = 1
+        self.server.add_record('host.zerowire', QTYPE.AAAA, AAAA('fd00::2'))
+        self.source = (localhost, 5353)
+
+    def tearDown(self) -> None:
+        self.server.client.close()
+        self.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def answer(self, query: DNSRecord) -> DNSRecord:
+        packed = self.loop.run_until_complete(
+            self.server.answer(query.pack(), self.source))
+        assert packed is not None
+        return DNSRecord.parse(packed)
+
+    def test_local(self) -> None:
+        reply = self.answer(DNSRecord.question('host.ZeroWire.', 'AAAA'))
+
+        self.assertEqual([str(rr.rdata) for rr in reply.rr], ['fd00::2'])
+
+    def test_forwarded(self) -> None:
+        query = DNSRecord.question('example.com.', 'A')
+        reply = self.answer(query)
+
+        self.assertEqual(reply.header.id, query.header.id)
+        self.assertEqual([str(rr.rdata) for rr in reply.rr], ['192.0.2.1'])
+
+    def test_upstream_down(self) -> None:
+        self.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        reply = self.answer(DNSRecord.question('example.com.', 'A'))
+
+        self.assertEqual(reply.header.rcode, RCODE.SERVFAIL)
+
+
+class Test_RemoteQuestion(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.transport, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                Upstream, local_addr=('127.0.0.1', 0)))
+        port = self.transport.get_extra_info('sockname')[1]
+        self.server = dns.LocalDNSServer(
+            ipaddress.ip_address('127.0.0.1'), 0, remote_port=port)
+        self.server.client.timeout = 0.05
+        self.server.add_addr_record(
+            'peer.zerowire', ipaddress.ip_address('127.0.0.1'))
+        self.source = (ipaddress.ip_address('127.0.0.1'), 5353)
+
+    def tearDown(self) -> None:
+        self.server.client.close()
+        self.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def answer(self) -> DNSRecord:
+        packed = self.loop.run_until_complete(self.server.answer(
+            DNSRecord.question('web.peer.zerowire.', 'A').pack(),
+            self.source))
+        assert packed is not None
+        return DNSRecord.parse(packed)
+
+    def test_answered(self) -> None:
+        reply = self.answer()
+
+        self.assertEqual([str(rr.rdata) for rr in reply.rr], ['192.0.2.1'])
+
+    def test_peer_down(self) -> None:
+        self.transport.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+        with self.assertLogs(level='WARNING'):
+            for _ in range(3):
+                self.assertEqual(self.answer().header.rcode, RCODE.SERVFAIL)
+
+        self.assertGreater(self.server.client.short_circuits, 0)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import unittest
+
+from dnslib import A, DNSLabel, DNSRecord, QTYPE, RCODE, RR, SOA
+
+from zerowire import dnscache, metrics
+
+QNAME = DNSLabel('_http._tcp.host.zerowire.')
+
+
+def answer(ttl: int = 30, rcode: int = RCODE.NOERROR) -> DNSRecord:
+    record = DNSRecord.question(str(QNAME), 'A').reply()
+    record.header.set_rcode(rcode)
+    if rcode == RCODE.NOERROR:
+        record.add_answer(RR(QNAME, QTYPE.A, rdata=A('10.0.0.1'), ttl=ttl))
+    return record
+
+
+class Test_AnswerCache(unittest.TestCase):
+
+    def test_hit_counts_ttl_down(self) -> None:
+        hits = metrics.DNS_ANSWER_CACHE.get('hit')
+        misses = metrics.DNS_ANSWER_CACHE.get('miss')
+        cache = dnscache.AnswerCache()
+        self.assertIsNone(cache.get(QNAME, QTYPE.A, now=0))
+        cache.put(QNAME, QTYPE.A, answer(ttl=30), now=0)
+
+        cached = cache.get(
+            DNSLabel('_HTTP._tcp.Host.zerowire.'), QTYPE.A, now=10)
+
+        assert cached is not None
+        rcode, rrs = cached
+        self.assertEqual(rcode, RCODE.NOERROR)
+        self.assertEqual([rr.ttl for rr in rrs], [20])
+        self.assertEqual(
+            (metrics.DNS_ANSWER_CACHE.get('hit'),
+             metrics.DNS_ANSWER_CACHE.get('miss')),
+            (hits + 1, misses + 1))
+
+    def test_expiry(self) -> None:
+        cache = dnscache.AnswerCache()
+        cache.put(QNAME, QTYPE.A, answer(ttl=30), now=0)
+
+        self.assertIsNone(cache.get(QNAME, QTYPE.A, now=30))
+        self.assertEqual(len(cache), 0)
+
+    def test_zero_ttl_not_cached(self) -> None:
+        cache = dnscache.AnswerCache()
+        cache.put(QNAME, QTYPE.A, answer(ttl=0), now=0)
+
+        self.assertEqual(len(cache), 0)
+
+    def test_negative(self) -> None:
+        cache = dnscache.AnswerCache(negative_ttl=5)
+        cache.put(QNAME, QTYPE.A, answer(rcode=RCODE.NXDOMAIN), now=0)
+
+        self.assertEqual(
+            cache.get(QNAME, QTYPE.A, now=4), (RCODE.NXDOMAIN, []))
+        self.assertIsNone(cache.get(QNAME, QTYPE.A, now=5))
+
+    def test_negative_soa_minimum(self) -> None:
+        cache = dnscache.AnswerCache(negative_ttl=5)
+        record = answer(rcode=RCODE.NXDOMAIN)
+        record.add_auth(RR(
+            'zerowire.', QTYPE.SOA, ttl=60,
+            rdata=SOA('ns.', 'root.', (1, 2, 3, 4, 20))))
+        cache.put(QNAME, QTYPE.A, record, now=0)
+
+        self.assertIsNotNone(cache.get(QNAME, QTYPE.A, now=19))
+        self.assertIsNone(cache.get(QNAME, QTYPE.A, now=20))
+
+    def test_servfail_not_cached(self) -> None:
+        cache = dnscache.AnswerCache()
+        cache.put(QNAME, QTYPE.A, answer(rcode=RCODE.SERVFAIL), now=0)
+
+        self.assertEqual(len(cache), 0)
+
+    def test_bounded(self) -> None:
+        cache = dnscache.AnswerCache(max_entries=2)
+        for qtype in (QTYPE.A, QTYPE.AAAA, QTYPE.TXT):
+            cache.put(QNAME, qtype, answer(), now=0)
+
+        self.assertEqual(
+            [qtype for _, qtype in cache.entries], [QTYPE.AAAA, QTYPE.TXT])
+
+    def test_invalidate(self) -> None:
+        cache = dnscache.AnswerCache()
+        cache.put(QNAME, QTYPE.A, answer(), now=0)
+        cache.put(DNSLabel('other.zerowire.'), QTYPE.A, answer(), now=0)
+
+        cache.invalidate(DNSLabel('host.zerowire.'))
+
+        self.assertEqual(
+            [str(qname) for qname, _ in cache.entries], ['other.zerowire.'])
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+from typing import List, Tuple, Union, cast
+import unittest
+import asyncio
+import ipaddress
+
+from dnslib import A, DNSRecord, QTYPE, RR
+
+from zerowire import dnsclient
+
+LOCALHOST = ipaddress.ip_address('127.0.0.1')
+
+
+class FakeServer(asyncio.DatagramProtocol):
+    '''Answers every A question with 10.0.0.<n>, after dropping the first
+    `drop` queries and holding back `hold` queries to answer in reverse.'''
+    transport: asyncio.DatagramTransport
+
+    def __init__(self, drop: int = 0, hold: int = 0) -> None:
+        self.drop = drop
+        self.hold = hold
+        self.held: List[Tuple[bytes, Tuple[str, int]]] = []
+        self.queries = 0
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = cast(asyncio.DatagramTransport, transport)
+
+    def answer(self, data: bytes, src: Tuple[str, int]) -> None:
+        query = DNSRecord.parse(data)
+        reply = query.reply()
+        n = int(str(query.q.qname).split('.')[0][1:])
+        reply.add_answer(RR(query.q.qname, QTYPE.A, rdata=A(f'10.0.0.{n}')))
+        self.transport.sendto(reply.pack(), src)
+
+    def datagram_received(
+        self,
+        data: Union[bytes, str],
+        src: Tuple[str, int],
+    ) -> None:
+        assert isinstance(data, bytes)
+        self.queries += 1
+        if self.drop:
+            self.drop -= 1
+            return
+        self.held.append((data, src))
+        if len(self.held) >= self.hold:
+            for held in reversed(self.held):
+                self.answer(*held)
+            self.held = []
+
+
+class TruncatingServer(FakeServer):
+    '''Answers over UDP with only the TC flag, and over TCP after
+    `delay`.'''
+    def __init__(self, delay: float) -> None:
+        super().__init__()
+        self.delay = delay
+
+    def answer(self, data: bytes, src: Tuple[str, int]) -> None:
+        reply = DNSRecord.parse(data).reply()
+        reply.header.tc = 1
+        self.transport.sendto(reply.pack(), src)
+
+    async def serve_tcp(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        length, = dnsclient.TCP_LENGTH.unpack(await reader.readexactly(2))
+        query = DNSRecord.parse(await reader.readexactly(length))
+        reply = query.reply()
+        reply.add_answer(RR(query.q.qname, QTYPE.A, rdata=A('10.0.0.1')))
+        packed = reply.pack()
+        await asyncio.sleep(self.delay)
+        writer.write(dnsclient.TCP_LENGTH.pack(len(packed)) + packed)
+        await writer.drain()
+        writer.close()
+
+
+class Test_DNSClientPool(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.pool = dnsclient.DNSClientPool(timeout=0.1, attempts=2)
+        self.servers: List[asyncio.BaseTransport] = []
+
+    def tearDown(self) -> None:
+        self.pool.close()
+        for server in self.servers:
+            server.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def serve(self, server: FakeServer) -> int:
+        transport, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                lambda: server, local_addr=('127.0.0.1', 0)))
+        self.servers.append(transport)
+        return cast(int, transport.get_extra_info('sockname')[1])
+
+    def test_multiplexed(self) -> None:
+        port = self.serve(FakeServer(hold=4))
+        queries = [DNSRecord.question(f'h{n}.zerowire.') for n in range(4)]
+
+        replies = self.loop.run_until_complete(asyncio.gather(*(
+            self.pool.query(LOCALHOST, port, query) for query in queries)))
+
+        for n, (query, reply) in enumerate(zip(queries, replies)):
+            self.assertEqual(reply.header.id, query.header.id)
+            self.assertEqual(str(reply.rr[0].rdata), f'10.0.0.{n}')
+        stats = self.pool.stats()
+        self.assertEqual(stats['sockets'], 1)
+        self.assertEqual(stats['sent'], 4)
+        self.assertEqual(stats['received'], 4)
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_retry(self) -> None:
+        server = FakeServer(drop=1)
+        port = self.serve(server)
+
+        reply = self.loop.run_until_complete(self.pool.query(
+            LOCALHOST, port, DNSRecord.question('h7.zerowire.')))
+
+        self.assertEqual(str(reply.rr[0].rdata), '10.0.0.7')
+        self.assertEqual(server.queries, 2)
+        self.assertEqual(self.pool.retries, 1)
+        self.assertEqual(self.pool.timeouts, 1)
+
+    def test_timeout(self) -> None:
+        port = self.serve(FakeServer(drop=2))
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.loop.run_until_complete(self.pool.query(
+                LOCALHOST, port, DNSRecord.question('h1.zerowire.')))
+
+        self.assertEqual(self.pool.timeouts, 2)
+        self.assertEqual(self.pool.waiting, {})
+
+    def test_wrong_source_ignored(self) -> None:
+        port = self.serve(FakeServer())
+        self.pool.waiting[(2, 1)] = (
+            (LOCALHOST, port), self.loop.create_future())
+
+        self.pool.reply(2, b'\x00\x01', ('127.0.0.2', port))
+
+        self.assertEqual(self.pool.unmatched, 1)
+        self.assertFalse(self.pool.waiting[(2, 1)][1].done())
+
+    def serve_at(self, server: FakeServer, host: str, port: int) -> None:
+        transport, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                lambda: server, local_addr=(host, port)))
+        self.servers.append(transport)
+
+    def test_hedged(self) -> None:
+        slow = FakeServer(drop=10)
+        port = self.serve(slow)
+        self.serve_at(FakeServer(), '127.0.0.2', port)
+        hosts = [LOCALHOST, ipaddress.ip_address('127.0.0.2')]
+
+        start = self.loop.time()
+        reply = self.loop.run_until_complete(self.pool.query_hedged(
+            hosts, port, DNSRecord.question('h3.zerowire.')))
+
+        self.assertEqual(str(reply.rr[0].rdata), '10.0.0.3')
+        # Sent on after one RTO, not after a whole timeout
+        self.assertLess(self.loop.time() - start, 0.2)
+        self.assertEqual(self.pool.hedges, 1)
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertEqual(self.pool.waiting, {})
+        # The answering host is measured and asked first from now on
+        fast = self.pool.health[hosts[1]]
+        self.assertIsNotNone(fast.srtt)
+        self.assertLess(fast.rto, self.pool.health[LOCALHOST].rto)
+
+        self.loop.run_until_complete(self.pool.query_hedged(
+            hosts, port, DNSRecord.question('h4.zerowire.')))
+        self.assertEqual(slow.queries, 1)
+
+    def test_circuit_breaker(self) -> None:
+        server = FakeServer(drop=10)
+        port = self.serve(server)
+
+        for _ in range(2):
+            with self.assertRaises(asyncio.TimeoutError):
+                self.loop.run_until_complete(self.pool.query_hedged(
+                    [LOCALHOST], port, DNSRecord.question('h1.zerowire.')))
+        queries = server.queries
+
+        with self.assertRaises(dnsclient.HostDown):
+            self.loop.run_until_complete(self.pool.query_hedged(
+                [LOCALHOST], port, DNSRecord.question('h1.zerowire.')))
+        self.assertEqual(server.queries, queries)
+        self.assertEqual(self.pool.short_circuits, 1)
+
+    def test_hedged_tcp_fallback(self) -> None:
+        server = TruncatingServer(delay=0.05)
+        port = self.serve(server)
+        tcp = self.loop.run_until_complete(
+            asyncio.start_server(server.serve_tcp, '127.0.0.1', port))
+        self.servers.append(cast(asyncio.BaseTransport, tcp))
+        # A LAN host answering in microseconds, its RTO is at the floor
+        health = self.pool.host_health(LOCALHOST)
+        for _ in range(20):
+            health.observe(0.0001)
+        self.assertEqual(health.rto, dnsclient.RTO_MIN)
+
+        reply = self.loop.run_until_complete(self.pool.query_hedged(
+            [LOCALHOST], port, DNSRecord.question('h1.zerowire.')))
+
+        self.assertEqual(str(reply.rr[0].rdata), '10.0.0.1')
+        self.assertEqual(self.pool.tcp_fallbacks, 1)
+
+
+class Test_HostHealth(unittest.TestCase):
+    def test_rto(self) -> None:
+        health = dnsclient.HostHealth(0.5)
+        health.observe(0.1)
+
+        self.assertAlmostEqual(health.rto, 0.3)
+        for _ in range(50):
+            health.observe(0.01)
+        self.assertLess(health.rto, 0.02)
+        self.assertGreaterEqual(health.rto, dnsclient.RTO_MIN)
+
+        health.timed_out(0)
+        self.assertLess(health.rto, 0.04)
+
+    def test_breaker(self) -> None:
+        health = dnsclient.HostHealth(0.5)
+        for _ in range(dnsclient.BREAKER_FAILURES):
+            self.assertTrue(health.available(0))
+            health.timed_out(0)
+
+        self.assertFalse(health.available(1))
+        # One trial once the cooldown is over
+        self.assertTrue(health.available(5))
+        self.assertFalse(health.available(5))
+        health.timed_out(5)
+        self.assertFalse(health.available(14))
+        self.assertTrue(health.available(15))
+        health.observe(0.1)
+        self.assertTrue(health.available(15))
+        self.assertIsNone(health.open_until)
+
+    def test_abandoned_trial(self) -> None:
+        health = dnsclient.HostHealth(0.5)
+        for _ in range(dnsclient.BREAKER_FAILURES):
+            health.timed_out(0)
+        self.assertTrue(health.available(5))
+
+        health.abandoned()
+        self.assertTrue(health.available(5))
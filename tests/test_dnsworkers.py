@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+from typing import List, Tuple, cast
+import unittest
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import ipaddress
+from multiprocessing.connection import Connection
+from unittest.mock import patch
+
+from dnslib import RR, DNSRecord
+
+from zerowire import dnsworkers, metrics
+from zerowire.dns import InterfaceDNSServer, LocalDNSServer
+from zerowire.config import ServiceConfig
+from zerowire.dnsclient import DNSClientPool
+
+LOCALHOST = ipaddress.ip_address('127.0.0.1')
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return int(sock.getsockname()[1])
+
+
+class Peer(asyncio.DatagramProtocol):
+    '''The DNS server of a peer, answers every A question with 192.0.2.1.'''
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = cast(asyncio.DatagramTransport, transport)
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]) -> None:
+        request = DNSRecord.parse(data)
+        reply = request.reply()
+        reply.add_answer(*RR.fromZone(f'{request.q.qname} 60 A 192.0.2.1'))
+        self.transport.sendto(reply.pack(), addr)
+
+
+def is_running(pid: int) -> bool:
+    '''Whether the process exists and has not exited, a zombie nobody
+    reaped yet has.'''
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            state = f.read().rsplit(')', 1)[1].split()[0]
+    except (FileNotFoundError, IndexError):
+        return False
+    return state not in ('Z', 'X')
+
+
+def daemon_main(conn: Connection) -> None:
+    '''Stands in for the daemon, reports the pids of its workers and
+    waits to be killed.'''
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    workers = dnsworkers.DNSWorkers(2)
+    workers.start()
+    conn.send([process.pid for process in workers.processes])
+    time.sleep(60)
+
+
+class Test_DNSWorkers(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.workers = dnsworkers.DNSWorkers(1)
+        with patch.object(dnsworkers, 'METRICS_INTERVAL', 0.05):
+            self.workers.start()
+        self.client = DNSClientPool(timeout=0.2, attempts=10)
+        self.port = free_port()
+        # Never started, every answer comes from the worker
+        self.server = InterfaceDNSServer(
+            'host', ipaddress.ip_interface('127.0.0.1/8'), self.port)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.workers.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def ptr(self) -> DNSRecord:
+        return self.loop.run_until_complete(self.client.query(
+            LOCALHOST, self.port,
+            DNSRecord.question('_http._tcp.host.zerowire.', 'PTR')))
+
+    def test_replicated(self) -> None:
+        self.server.add_service(ServiceConfig.from_dict(
+            {'type': '_http._tcp', 'name': 'web', 'port': 80}))
+        self.workers.add_server(self.server)
+
+        self.assertTrue(self.server.reuse_port)
+        self.assertEqual(len(self.ptr().rr), 1)
+
+        self.server.add_service(ServiceConfig.from_dict(
+            {'type': '_http._tcp', 'name': 'admin', 'port': 8080}))
+        self.assertEqual(len(self.ptr().rr), 2)
+
+        self.server.del_record(
+            '_http._tcp', record=self.server.get_records(
+                '_http._tcp', 12)[0])
+        self.assertEqual(len(self.ptr().rr), 1)
+
+    def test_metrics(self) -> None:
+        self.server.add_service(ServiceConfig.from_dict(
+            {'type': '_http._tcp', 'name': 'web', 'port': 80}))
+        self.workers.add_server(self.server)
+        before = metrics.DNS_QUERIES.count(self.server.name, 'NOERROR')
+
+        self.ptr()
+        for _ in range(100):
+            if metrics.DNS_QUERIES.count(self.server.name, 'NOERROR') > before:
+                break
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+
+        self.assertEqual(
+            metrics.DNS_QUERIES.count(self.server.name, 'NOERROR'),
+            before + 1)
+
+    def test_remote_port(self) -> None:
+        transport, _ = self.loop.run_until_complete(
+            self.loop.create_datagram_endpoint(
+                Peer, local_addr=('127.0.0.1', 0)))
+        # Never started either, the worker's copy forwards to the peer port
+        server = LocalDNSServer(
+            LOCALHOST, self.port,
+            remote_port=transport.get_extra_info('sockname')[1])
+        server.add_addr_record('peer.zerowire', LOCALHOST)
+        self.workers.add_server(server)
+
+        try:
+            reply = self.loop.run_until_complete(self.client.query(
+                LOCALHOST, self.port,
+                DNSRecord.question('web.peer.zerowire.', 'A')))
+        finally:
+            transport.close()
+
+        self.assertEqual([str(rr.rdata) for rr in reply.rr], ['192.0.2.1'])
+
+
+class Test_worker_main(unittest.TestCase):
+    def test_daemon_killed(self) -> None:
+        context = multiprocessing.get_context('fork')
+        recv_conn, send_conn = context.Pipe(duplex=False)
+        daemon = context.Process(target=daemon_main, args=(send_conn,))
+        daemon.start()
+        send_conn.close()
+        self.assertTrue(recv_conn.poll(10))
+        pids: List[int] = recv_conn.recv()
+        recv_conn.close()
+        self.assertEqual(len(pids), 2)
+        self.assertTrue(all(is_running(pid) for pid in pids))
+
+        os.kill(daemon.pid, signal.SIGKILL)
+        daemon.join()
+
+        for _ in range(100):
+            if not any(is_running(pid) for pid in pids):
+                break
+            time.sleep(0.05)
+        running = [pid for pid in pids if is_running(pid)]
+        for pid in running:
+            os.kill(pid, signal.SIGKILL)
+        self.assertEqual(running, [])
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+import unittest
+import asyncio
+import os
+import tempfile
+
+from zerowire import metrics
+
+
+class Test_Registry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = metrics.Registry()
+
+    def test_counter(self) -> None:
+        counter = self.registry.counter(
+            'test_total', 'Things.', ['kind'])
+        counter.inc('a')
+        counter.inc('a')
+        counter.inc('b"\n', amount=0.5)
+
+        self.assertEqual(counter.get('a'), 2)
+        self.assertEqual(self.registry.render(), (
+            '# HELP test_total Things.\n'
+            '# TYPE test_total counter\n'
+            'test_total{kind="a"} 2\n'
+            'test_total{kind="b\\"\\n"} 0.5\n'
+        ))
+
+    def test_histogram(self) -> None:
+        histogram = self.registry.histogram(
+            'test_seconds', 'Latency.', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(2)
+
+        self.assertEqual(histogram.count(), 4)
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            'test_seconds_sum 2.65',
+            'test_seconds_count 4',
+        ])
+
+    def test_duplicate(self) -> None:
+        self.registry.counter('test_total', 'Things.')
+        with self.assertRaises(AssertionError):
+            self.registry.counter('test_total', 'Things.')
+
+    def test_series(self) -> None:
+        self.registry.counter('test_total', 'Things.', ['kind']).inc('a')
+        self.registry.histogram(
+            'test_seconds', 'Latency.', buckets=(0.1, 1)).observe(0.5)
+
+        self.assertEqual(self.registry.series(), {
+            'test_total': [{'labels': {'kind': 'a'}, 'value': 1}],
+            'test_seconds': [{'labels': {}, 'count': 1, 'sum': 0.5}],
+        })
+
+    def test_drain_merge(self) -> None:
+        counter = self.registry.counter('test_total', 'Things.', ['kind'])
+        histogram = self.registry.histogram(
+            'test_seconds', 'Latency.', buckets=(0.1, 1))
+        self.registry.counter('test_idle_total', 'Nothing.')
+        counter.inc('a')
+        histogram.observe(0.5)
+        other = metrics.Registry()
+        other.counter('test_total', 'Things.', ['kind']).inc('a', amount=2)
+        other.histogram(
+            'test_seconds', 'Latency.', buckets=(0.1, 1)).observe(0.05)
+
+        drained = self.registry.drain()
+        other.merge(drained)
+
+        self.assertEqual(set(drained), {'test_total', 'test_seconds'})
+        self.assertEqual(self.registry.drain(), {})
+        self.assertEqual(counter.get('a'), 0)
+        self.assertEqual(other.series(), {
+            'test_total': [{'labels': {'kind': 'a'}, 'value': 3}],
+            'test_seconds': [{'labels': {}, 'count': 2, 'sum': 0.55}],
+        })
+
+
+class Test_MetricsServer(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'metrics.sock')
+        self.registry = metrics.Registry()
+        self.registry.counter('test_total', 'Things.').inc()
+        self.server = metrics.MetricsServer(
+            f'unix:{self.path}', self.registry)
+        self.loop.run_until_complete(self.server.start())
+
+    def tearDown(self) -> None:
+        self.server.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.dir.cleanup()
+
+    def get(self, target: str) -> bytes:
+        async def get() -> bytes:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            writer.write(f'GET {target} HTTP/1.1\r\nHost: x\r\n\r\n'.encode())
+            response = await reader.read()
+            writer.close()
+            return response
+        return self.loop.run_until_complete(get())
+
+    def test_scrape(self) -> None:
+        response = self.get('/metrics')
+
+        head, body = response.split(b'\r\n\r\n', 1)
+        self.assertTrue(head.startswith(b'HTTP/1.0 200 OK'))
+        self.assertIn(b'text/plain; version=0.0.4', head)
+        self.assertEqual(body, self.registry.render().encode())
+
+    def test_not_found(self) -> None:
+        self.assertTrue(self.get('/nope').startswith(b'HTTP/1.0 404'))
+
+    def test_loop_lag(self) -> None:
+        self.server.lag.interval = 0.01
+        self.server.lag.close()
+        before = metrics.LOOP_LAG.count()
+        self.loop.run_until_complete(self.server.lag.start())
+
+        self.loop.run_until_complete(asyncio.sleep(0.05))
+
+        self.assertGreater(metrics.LOOP_LAG.count(), before)
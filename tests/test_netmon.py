@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+import unittest
+import struct
+
+from zerowire import netmon
+
+
+def nlmsg(type: int, body: bytes) -> bytes:
+    length = netmon.NLMSGHDR.size + len(body)
+    padding = b'\0' * ((4 - length % 4) % 4)
+    return netmon.NLMSGHDR.pack(length, type, 0, 0, 0) + body + padding
+
+
+class Test_NetMon(unittest.TestCase):
+
+    def test_parse_events(self) -> None:
+        data = b''.join([
+            nlmsg(netmon.RTM_NEWLINK,
+                  struct.pack('=BxHiII', 0, 1, 3, 0, 0) + b'attrs'),
+            nlmsg(netmon.RTM_DELADDR,
+                  struct.pack('=BBBBI', 10, 64, 0, 0, 7) + b'more attrs'),
+            # Route changes are not ours
+            nlmsg(24, b'\0' * 12),
+            nlmsg(netmon.RTM_NEWADDR,
+                  struct.pack('=BBBBI', 2, 24, 0, 0, 3)),
+        ])
+
+        self.assertEqual(list(netmon.parse_events(data)), [
+            (netmon.RTM_NEWLINK, 3),
+            (netmon.RTM_DELADDR, 7),
+            (netmon.RTM_NEWADDR, 3),
+        ])
+
+    def test_parse_events_truncated(self) -> None:
+        data = nlmsg(netmon.RTM_NEWLINK, struct.pack('=BxHiII', 0, 1, 3, 0, 0))
+
+        self.assertEqual(list(netmon.parse_events(data[:10])), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
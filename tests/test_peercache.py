@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import unittest
+import asyncio
+import ipaddress
+import json
+import os
+import stat
+import tempfile
+
+from zerowire import peercache, peers
+
+PSK = '1j75n1Zcwp9tUMuFH5H6C5Jn0PVjk66UXqSbY/OTjb8='
+
+
+def entry(pubkey: str) -> peers.PeerEntry:
+    return peers.PeerEntry(
+        pubkey=pubkey,
+        name=f'{pubkey}._wireguard._udp.local.',
+        hostname=f'{pubkey}.zerowire.',
+        internal_addr=ipaddress.ip_address('fd00::2'),
+        endpoint=(ipaddress.ip_address('192.168.0.2'), 1234),
+        last_seen=1000,
+        latest_handshake=1500.4,
+        candidates=(
+            ipaddress.ip_address('10.0.0.2'),
+            ipaddress.ip_address('192.168.0.2'),
+        ),
+        probe_port=4321,
+    )
+
+
+class Test_PeerCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'state', 'peers.json')
+        self.table = peers.PeerTable()
+        self.table.touch(entry('a'))
+        withdrawn = entry('b')
+        withdrawn.withdrawn = True
+        self.table.touch(withdrawn)
+
+    def tearDown(self) -> None:
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.dir.cleanup()
+
+    def cache(self, interval: float = 30) -> peercache.PeerCache:
+        return peercache.PeerCache(self.path, interval)
+
+    def test_round_trip(self) -> None:
+        cache = self.cache()
+        cache.track('wg0', PSK, self.table)
+        cache.flush()
+
+        loaded = self.cache()
+        loaded.load()
+        entries = loaded.entries('wg0', PSK)
+
+        expected = entry('a')
+        expected.last_seen = 1500
+        expected.latest_handshake = 0
+        self.assertEqual(entries, [expected])
+        self.assertEqual(loaded.entries('wg1', PSK), [])
+
+    def test_psk_changed(self) -> None:
+        cache = self.cache()
+        cache.track('wg0', PSK, self.table)
+        cache.flush()
+
+        loaded = self.cache()
+        loaded.load()
+
+        self.assertEqual(loaded.entries('wg0', 'other'), [])
+        with open(self.path) as file:
+            self.assertNotIn(PSK, file.read())
+
+    def test_private(self) -> None:
+        cache = self.cache()
+        cache.track('wg0', PSK, self.table)
+        cache.flush()
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(os.path.dirname(self.path)).st_mode), 0o700)
+        self.assertEqual(
+            os.listdir(os.path.dirname(self.path)), ['peers.json'])
+
+    def test_unreadable(self) -> None:
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as file:
+            file.write('{"version": 1, "interfaces": {"wg0": ')
+        cache = self.cache()
+
+        with self.assertLogs(cache.logger, 'WARNING'):
+            cache.load()
+        self.assertEqual(cache.entries('wg0', PSK), [])
+
+    def test_throttled(self) -> None:
+        cache = self.cache(interval=0.05)
+        cache.track('wg0', PSK, self.table)
+        for _ in range(10):
+            cache.changed()
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.assertEqual(cache.writes, 1)
+
+        self.table.touch(entry('c'))
+        cache.changed()
+        cache.changed()
+        self.loop.run_until_complete(asyncio.sleep(0.02))
+        self.assertEqual(cache.writes, 1)
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+
+        self.assertEqual(cache.writes, 2)
+        with open(self.path) as file:
+            rows = json.load(file)['interfaces']['wg0']['peers']
+        self.assertEqual([row[0] for row in rows], ['a', 'c'])
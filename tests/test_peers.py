@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+import unittest
+import ipaddress
+
+from zerowire import peers
+
+
+def entry(pubkey: str, last_seen: float = 1000) -> peers.PeerEntry:
+    return peers.PeerEntry(
+        pubkey=pubkey,
+        name=f'{pubkey}._wireguard._udp.local.',
+        hostname=f'{pubkey}.zerowire.',
+        internal_addr=ipaddress.ip_address('fd00::1'),
+        endpoint=(ipaddress.ip_address('192.168.0.2'), 1234),
+        last_seen=last_seen,
+    )
+
+
+class Test_PeerTable(unittest.TestCase):
+
+    def test_lru_eviction(self) -> None:
+        table = peers.PeerTable(max_peers=2)
+
+        self.assertEqual(table.touch(entry('a')), [])
+        self.assertEqual(table.touch(entry('b')), [])
+        table.touch(entry('a'))
+        evicted = table.touch(entry('c'))
+
+        self.assertEqual([e.pubkey for e in evicted], ['b'])
+        self.assertEqual(list(table.entries), ['a', 'c'])
+
+    def test_handshake_refreshes_lru(self) -> None:
+        table = peers.PeerTable(max_peers=2)
+        table.touch(entry('a'))
+        table.touch(entry('b'))
+
+        table.update_handshakes({'a': 2000})
+        evicted = table.touch(entry('c'))
+
+        self.assertEqual([e.pubkey for e in evicted], ['b'])
+
+    def test_expire(self) -> None:
+        table = peers.PeerTable(ttl=100)
+        table.touch(entry('a', last_seen=1000))
+        table.touch(entry('b', last_seen=1000))
+        table.update_handshakes({'b': 1050})
+
+        expired = table.expire(now=1120)
+
+        self.assertEqual([e.pubkey for e in expired], ['a'])
+        self.assertNotIn('a', table)
+        self.assertIn('b', table)
+
+    def test_expire_withdrawn(self) -> None:
+        table = peers.PeerTable(ttl=600)
+        table.touch(entry('a', last_seen=1000))
+        table.touch(entry('b', last_seen=1000))
+        table.update_handshakes({'b': 1000})
+
+        table.withdraw('a._wireguard._udp.local.')
+        table.withdraw('b._wireguard._udp.local.')
+
+        self.assertEqual(
+            [e.pubkey for e in table.expire(now=1100)], ['a'])
+        self.assertEqual(
+            [e.pubkey for e in table.expire(now=1200)], ['b'])
+
+    def test_touch_keeps_handshake(self) -> None:
+        table = peers.PeerTable()
+        table.touch(entry('a'))
+        table.update_handshakes({'a': 1500})
+
+        table.touch(entry('a', last_seen=1200))
+
+        entry_a = table.get('a')
+        assert entry_a is not None
+        self.assertEqual(entry_a.latest_handshake, 1500)
+        self.assertEqual(entry_a.last_active, 1500)
+
+    def test_expire_unconfirmed(self) -> None:
+        table = peers.PeerTable(ttl=600)
+        for pubkey in 'abc':
+            restored = entry(pubkey, last_seen=1000)
+            restored.confirm_by = 1060
+            table.touch(restored)
+        table.update_handshakes({'b': 1050})
+        table.touch(entry('c', last_seen=1030))
+
+        self.assertEqual(table.expire(now=1059), [])
+        expired = table.expire(now=1100)
+
+        self.assertEqual([e.pubkey for e in expired], ['a'])
+        self.assertEqual(list(table.entries), ['b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import unittest
+import asyncio
+import ipaddress
+
+from zerowire import probe
+
+
+class Test_Prober(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.local = probe.Prober(timeout=0.1, attempts=2)
+        self.remote = probe.Prober()
+        self.loop.run_until_complete(self.local.start())
+        self.loop.run_until_complete(self.remote.start())
+
+    def tearDown(self) -> None:
+        self.local.close()
+        self.remote.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_rtt(self) -> None:
+        rtt = self.loop.run_until_complete(self.local.rtt(
+            ipaddress.ip_address('127.0.0.1'), self.remote.port))
+
+        assert rtt is not None
+        self.assertGreater(rtt, 0)
+        self.assertLess(rtt, 0.1)
+        self.assertEqual(self.local.waiting, {})
+
+    def test_rank_drops_silent(self) -> None:
+        ranked = self.loop.run_until_complete(self.local.rank([
+            ipaddress.ip_address('192.0.2.1'),
+            ipaddress.ip_address('127.0.0.1'),
+        ], self.remote.port))
+
+        self.assertEqual(
+            [addr for _, addr in ranked],
+            [ipaddress.ip_address('127.0.0.1')])
+
+
+if __name__ == '__main__':
+    unittest.main()
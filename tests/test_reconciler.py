@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+import unittest
+import asyncio
+import ipaddress
+from typing import Iterable, List, Optional
+
+from zerowire import wg, reconciler
+
+PUBKEY_A = 'h+LAI3+61Va12APH9GXLEy7NZdCLAPIb/ndrj9rsFBI='
+PUBKEY_B = '4T7IpKzwFODBZZruvNXawH7+Sr0bU5kYAslQ1LyS+FE='
+PUBKEY_C = 'aKwoU/4zwKzc89RLS1/ioOGHqqcSQPgTeMNfiPMrbGc='
+PSK = '1j75n1Zcwp9tUMuFH5H6C5Jn0PVjk66UXqSbY/OTjb8='
+
+
+def peer(pubkey: str, host: str = '192.168.0.2', **kwargs: int) -> wg.WGPeer:
+    return wg.WGPeer(
+        pubkey=pubkey,
+        psk=PSK,
+        endpoint=(ipaddress.ip_address(host), 1234),
+        keepalive=5,
+        allowed_ips=(ipaddress.ip_network('fd00::1/128'),),
+        **kwargs,
+    )
+
+
+class FakeBackend(wg.WGBackend):
+    def __init__(self, device: Optional[wg.WGDevice] = None) -> None:
+        self.device = device or wg.WGDevice()
+        self.dumps = 0
+        self.calls: List[List[wg.WGPeer]] = []
+
+    def set_device(
+        self,
+        ifname: str,
+        privkey: str,
+        port: Optional[int] = None,
+    ) -> None:
+        pass
+
+    def set_peers(self, ifname: str, peers: Iterable[wg.WGPeer]) -> None:
+        self.calls.append(list(peers))
+
+    def dump(self, ifname: str) -> wg.WGDevice:
+        self.dumps += 1
+        return self.device
+
+
+class Test_PeerReconciler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self) -> None:
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_diff(self) -> None:
+        actual = wg.WGDevice(peers={
+            PUBKEY_A: peer(PUBKEY_A),
+            PUBKEY_B: peer(PUBKEY_B, host='192.168.0.3'),
+            PUBKEY_C: peer(PUBKEY_C),
+        })
+        desired = {
+            PUBKEY_A: peer(PUBKEY_A),
+            PUBKEY_B: peer(PUBKEY_B),
+        }
+
+        changes = reconciler.PeerReconciler.diff(desired, actual, now=1000)
+
+        self.assertEqual(changes, [
+            peer(PUBKEY_B),
+            wg.WGPeer(pubkey=PUBKEY_C, remove=True),
+        ])
+
+    def test_diff_roamed(self) -> None:
+        actual = wg.WGDevice(peers={
+            PUBKEY_A: peer(
+                PUBKEY_A, host='192.168.0.3', latest_handshake=950),
+        })
+
+        changes = reconciler.PeerReconciler.diff(
+            {PUBKEY_A: peer(PUBKEY_A)}, actual, now=1000)
+
+        self.assertEqual(changes, [])
+
+    def test_diff_new_endpoint(self) -> None:
+        actual = wg.WGDevice(peers={
+            PUBKEY_A: peer(
+                PUBKEY_A, host='192.168.0.3', latest_handshake=950),
+        })
+        applied = {PUBKEY_A: peer(PUBKEY_A, host='192.168.0.3')}
+
+        changes = reconciler.PeerReconciler.diff(
+            {PUBKEY_A: peer(PUBKEY_A)}, actual, now=1000, applied=applied)
+
+        self.assertEqual(changes, [peer(PUBKEY_A)])
+
+    def test_reconcile_batches(self) -> None:
+        backend = FakeBackend()
+        rec = reconciler.PeerReconciler('wg-test', backend, debounce=0)
+
+        for pubkey in (PUBKEY_A, PUBKEY_B, PUBKEY_C):
+            rec.set_peer(peer(pubkey))
+        self.loop.run_until_complete(asyncio.sleep(0.1))
+
+        self.assertEqual(backend.dumps, 1)
+        self.assertEqual(len(backend.calls), 1)
+        self.assertEqual(
+            [p.pubkey for p in backend.calls[0]],
+            [PUBKEY_A, PUBKEY_B, PUBKEY_C])
+
+    def test_reconcile_in_sync(self) -> None:
+        backend = FakeBackend(wg.WGDevice(peers={PUBKEY_A: peer(PUBKEY_A)}))
+        rec = reconciler.PeerReconciler('wg-test', backend)
+        rec.desired[PUBKEY_A] = peer(PUBKEY_A)
+
+        self.assertEqual(rec.reconcile(), [])
+        self.assertEqual(backend.calls, [])
+
+    def test_reconcile_adopts(self) -> None:
+        backend = FakeBackend(wg.WGDevice(peers={
+            PUBKEY_A: peer(PUBKEY_A),
+            PUBKEY_B: peer(PUBKEY_B),
+        }))
+        rec = reconciler.PeerReconciler('wg-test', backend, adopt=60)
+        self.loop.run_until_complete(rec.start())
+        rec.desired[PUBKEY_A] = peer(PUBKEY_A, host='192.168.0.3')
+
+        self.assertEqual(rec.reconcile(), [peer(PUBKEY_A, host='192.168.0.3')])
+
+        rec.adopt_until = 0
+        self.assertEqual(rec.reconcile(), [
+            peer(PUBKEY_A, host='192.168.0.3'),
+            wg.WGPeer(pubkey=PUBKEY_B, remove=True),
+        ])
+        rec.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
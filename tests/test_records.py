@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+import unittest
+from unittest.mock import patch
+
+from dnslib import A, AAAA, DNSLabel, PTR, QTYPE
+
+from zerowire import records
+
+
+class Test_RecordStore(unittest.TestCase):
+
+    def test_case_insensitive(self) -> None:
+        store = records.RecordStore()
+        store.add('Host.ZeroWire.', QTYPE.A, A('10.0.0.1'))
+
+        self.assertIn(DNSLabel('host.zerowire'), store)
+        self.assertEqual(
+            store.get(DNSLabel('HOST.zerowire.'), QTYPE.A), (A('10.0.0.1'),))
+
+    def test_duplicates(self) -> None:
+        store = records.RecordStore()
+
+        self.assertTrue(store.add('host.zerowire.', QTYPE.A, A('10.0.0.1')))
+        self.assertFalse(store.add('HOST.zerowire.', QTYPE.A, A('10.0.0.1')))
+        self.assertTrue(store.add('host.zerowire.', QTYPE.A, A('10.0.0.2')))
+
+        self.assertEqual(len(store), 2)
+        self.assertEqual(
+            store.get('host.zerowire.', QTYPE.A),
+            (A('10.0.0.1'), A('10.0.0.2')))
+
+    def test_add_packs_once(self) -> None:
+        store = records.RecordStore()
+        for i in range(10):
+            store.add('host.zerowire.', QTYPE.A, A(f'10.0.0.{i}'))
+
+        with patch.object(
+                records, 'rdata_key', wraps=records.rdata_key) as packed:
+            store.add('host.zerowire.', QTYPE.A, A('10.0.0.10'))
+            store.add('host.zerowire.', QTYPE.A, A('10.0.0.1'))
+
+        # Only the record added is packed, not the set it joins
+        self.assertEqual(packed.call_count, 2)
+        self.assertEqual(len(store), 11)
+
+    def test_lookup_does_not_insert(self) -> None:
+        store = records.RecordStore()
+
+        self.assertEqual(store.get('missing.zerowire.', QTYPE.A), ())
+        self.assertNotIn('missing.zerowire.', store)
+        self.assertEqual(store.names, {})
+
+    def test_remove(self) -> None:
+        store = records.RecordStore()
+        store.add('host.zerowire.', QTYPE.A, A('10.0.0.1'))
+        store.add('host.zerowire.', QTYPE.A, A('10.0.0.2'))
+        store.add('host.zerowire.', QTYPE.AAAA, AAAA('fd00::1'))
+
+        name = 'host.zerowire.'
+        self.assertEqual(store.remove(name, QTYPE.A, A('10.0.0.1')), 1)
+        self.assertEqual(store.get(name, QTYPE.A), (A('10.0.0.2'),))
+        self.assertEqual(store.remove(name, QTYPE.A, A('10.0.0.1')), 0)
+        self.assertEqual(store.remove(name, QTYPE.A), 1)
+        self.assertEqual(store.remove(name), 1)
+
+        self.assertNotIn('host.zerowire.', store)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.names, {})
+        self.assertEqual(store.packed, {})
+        self.assertEqual(store.children, {})
+        self.assertEqual(store.first_labels, {})
+
+    def test_under(self) -> None:
+        store = records.RecordStore()
+        store.add('web._http._tcp.a.zerowire.', QTYPE.TXT, PTR('x.'))
+        store.add('_http._tcp.a.zerowire.', QTYPE.PTR, PTR('x.'))
+        store.add('b.zerowire.', QTYPE.A, A('10.0.0.1'))
+
+        self.assertEqual(
+            {str(DNSLabel(key)) for key in store.under('A.zerowire.')},
+            {'web._http._tcp.a.zerowire.', '_http._tcp.a.zerowire.'})
+        self.assertEqual(len(store.under('zerowire.')), 3)
+
+        store.remove('web._http._tcp.a.zerowire.')
+        store.remove('_http._tcp.a.zerowire.')
+
+        self.assertEqual(store.under('a.zerowire.'), frozenset())
+        self.assertEqual(set(store.children), {(b'zerowire',), ()})
+
+    def test_starting_with(self) -> None:
+        store = records.RecordStore()
+        store.add('b._dns-sd._udp', QTYPE.PTR, PTR('a.zerowire.'))
+        store.add('lb._dns-sd._udp', QTYPE.PTR, PTR('a.zerowire.'))
+
+        self.assertEqual(
+            store.starting_with('B'), {(b'b', b'_dns-sd', b'_udp')})
+
+    def test_snapshot(self) -> None:
+        store = records.RecordStore()
+        store.add('host.zerowire.', QTYPE.A, A('10.0.0.1'))
+        snapshot = store.snapshot()
+
+        self.assertIs(store.snapshot(), snapshot)
+        with self.assertRaises(TypeError):
+            snapshot['host.zerowire.'][QTYPE.A] = ()  # type: ignore
+
+        store.add('host.zerowire.', QTYPE.A, A('10.0.0.2'))
+
+        self.assertEqual(
+            snapshot, {'host.zerowire.': {QTYPE.A: (A('10.0.0.1'),)}})
+        self.assertEqual(len(store.snapshot()['host.zerowire.'][QTYPE.A]), 2)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+from typing import Any, List, Optional, Tuple
+import unittest
+import asyncio
+import ipaddress
+import socket
+import tempfile
+
+from zerowire import resolver
+
+SERVER = ipaddress.ip_address('127.122.119.53')
+
+
+class FakeBus:
+    def __init__(self) -> None:
+        self.owner: Optional[str] = ':1.1'
+        self.calls: List[Tuple[Any, ...]] = []
+        self.fail = 0
+
+    def get_name_owner(self, name: str) -> str:
+        if self.owner is None:
+            raise Exception('NameHasNoOwner')
+        return self.owner
+
+    def __getattr__(self, method: str) -> Any:
+        def call(*args: Any) -> None:
+            if self.fail:
+                self.fail -= 1
+                raise Exception('NoReply')
+            self.calls.append((method, *args))
+        return call
+
+
+class Client(resolver.ResolvedClient):
+    def __init__(self, bus: FakeBus) -> None:
+        super().__init__(SERVER, watch_interval=0.01, retry_max=0.01)
+        self.bus = bus
+        self.connects = 0
+
+    def connect(self) -> Tuple[Any, Any]:
+        self.connects += 1
+        return self.bus, self.bus
+
+
+class Test_ResolvedClient(unittest.TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.bus = FakeBus()
+        self.client = Client(self.bus)
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def settle(self, seconds: float = 0.1) -> None:
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_batched(self) -> None:
+        self.client.add_link(3)
+        self.client.add_link(4)
+        self.client.remove_link(5)
+        self.settle()
+
+        self.assertEqual(self.client.batches, 1)
+        self.assertEqual(self.client.connects, 1)
+        address = [(socket.AF_INET, list(SERVER.packed))]
+        self.assertEqual(self.bus.calls, [
+            ('RevertLink', 5),
+            ('SetLinkDNS', 3, address),
+            ('SetLinkDomains', 3, [('zerowire.', True)]),
+            ('SetLinkDNS', 4, address),
+            ('SetLinkDomains', 4, [('zerowire.', True)]),
+        ])
+
+    def test_removed_before_flush(self) -> None:
+        self.client.add_link(3)
+        self.client.remove_link(3, revert=False)
+        self.settle()
+
+        self.assertEqual(self.bus.calls, [])
+
+    def test_retried(self) -> None:
+        self.bus.fail = 1
+        self.client.add_link(3)
+        with self.assertLogs(level='WARNING'):
+            self.settle()
+
+        self.assertEqual(self.client.connects, 2)
+        self.assertEqual([call[0] for call in self.bus.calls],
+                         ['SetLinkDNS', 'SetLinkDomains'])
+
+    def test_not_running(self) -> None:
+        self.bus.owner = None
+        self.client.add_link(3)
+        with self.assertLogs(level='WARNING'):
+            self.settle(0.02)
+            self.bus.owner = ':1.2'
+            self.settle()
+
+        self.assertEqual(self.client.batches, 1)
+
+    def test_restarted(self) -> None:
+        self.loop.run_until_complete(self.client.start())
+        self.client.add_link(3)
+        self.settle()
+        self.bus.owner = ':1.2'
+        self.settle()
+
+        self.assertEqual(self.client.batches, 2)
+        self.assertEqual(len(self.bus.calls), 4)
+
+
+class Test_upstreams(unittest.TestCase):
+    def test_parse_endpoint(self) -> None:
+        self.assertEqual(resolver.parse_endpoint('192.0.2.1'),
+                         (ipaddress.ip_address('192.0.2.1'), 53))
+        self.assertEqual(resolver.parse_endpoint('192.0.2.1:5353'),
+                         (ipaddress.ip_address('192.0.2.1'), 5353))
+        self.assertEqual(resolver.parse_endpoint('2001:db8::1'),
+                         (ipaddress.ip_address('2001:db8::1'), 53))
+        self.assertEqual(resolver.parse_endpoint('[2001:db8::1]:5353'),
+                         (ipaddress.ip_address('2001:db8::1'), 5353))
+        self.assertEqual(len(resolver.parse_upstreams('192.0.2.1, ::1,')), 2)
+
+    def test_resolv_conf(self) -> None:
+        with tempfile.NamedTemporaryFile('w') as file:
+            file.write(
+                '# generated\n'
+                'nameserver 127.122.119.53\n'
+                'nameserver fe80::1%eth0\n'
+                'nameserver 192.0.2.1\n'
+                'search example.com\n')
+            file.flush()
+
+            self.assertEqual(
+                resolver.resolv_conf_upstreams(SERVER, file.name),
+                [(ipaddress.ip_address('192.0.2.1'), 53)])
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+import unittest
+import os
+import sys
+import tempfile
+
+from zerowire import startup
+
+
+class Test_ImportProfiler(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        package = os.path.join(self.dir.name, 'profiled')
+        os.mkdir(package)
+        with open(os.path.join(package, '__init__.py'), 'w') as file:
+            file.write('from . import child\nimport time\ntime.sleep(0.02)\n')
+        with open(os.path.join(package, 'child.py'), 'w') as file:
+            file.write('import time\ntime.sleep(0.05)\n')
+        sys.path.insert(0, self.dir.name)
+
+    def tearDown(self) -> None:
+        sys.path.remove(self.dir.name)
+        for name in ('profiled', 'profiled.child'):
+            sys.modules.pop(name, None)
+        self.dir.cleanup()
+
+    def test_profile(self) -> None:
+        profiler = startup.ImportProfiler()
+        profiler.install()
+        try:
+            import profiled  # noqa: F401
+            import profiled  # noqa: F401,F811
+        finally:
+            profiler.uninstall()
+
+        times = profiler.self_times
+        self.assertEqual(set(times), {'profiled', 'profiled.child'})
+        self.assertGreaterEqual(times['profiled.child'], 0.05)
+        self.assertGreaterEqual(times['profiled'], 0.02)
+        self.assertLess(times['profiled'], 0.05)
+        self.assertEqual(
+            profiler.by_package(),
+            [('profiled', times['profiled'] + times['profiled.child'])])
+        self.assertIn('ms  profiled', profiler.report())
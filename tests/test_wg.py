@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import unittest
 from unittest.mock import Mock
+import ipaddress
 from util import ProcTest
 
 from zerowire import wg
@@ -44,5 +45,87 @@ class Test_WGProc(ProcTest, unittest.TestCase):
         self.assertEqual(res, mock.stdout.strip())
 
 
+PUBKEY_A = 'h+LAI3+61Va12APH9GXLEy7NZdCLAPIb/ndrj9rsFBI='
+PUBKEY_B = '4T7IpKzwFODBZZruvNXawH7+Sr0bU5kYAslQ1LyS+FE='
+PSK = '1j75n1Zcwp9tUMuFH5H6C5Jn0PVjk66UXqSbY/OTjb8='
+
+DUMP = '\n'.join([
+    'privkey\tpubkey\t51820\toff',
+    '\t'.join([
+        PUBKEY_A, PSK, '[fe80::1]:1234', 'fd00::1/128,fd00::2/128',
+        '1600000000', '10', '20', '5']),
+    '\t'.join([
+        PUBKEY_B, '(none)', '(none)', '(none)', '0', '0', '0', 'off']),
+])
+
+
+class Test_WGProcBackend(ProcTest, unittest.TestCase):
+
+    def test_set_device(self) -> None:
+        wg.WGProcBackend().set_device('wg-test', 'privkey', 1234)
+
+        self.assertSubprocess(
+            ['set', 'wg-test', 'listen-port', '1234',
+             'private-key', '/dev/stdin'],
+            'privkey')
+
+    def test_set_peers_batched(self) -> None:
+        wg.WGProcBackend().set_peers('wg-test', [
+            wg.WGPeer(
+                pubkey=PUBKEY_A,
+                psk=PSK,
+                endpoint=(ipaddress.ip_address('192.168.0.2'), 1234),
+                keepalive=5,
+                allowed_ips=(ipaddress.ip_network('fd00::1/128'),),
+            ),
+            wg.WGPeer(
+                pubkey=PUBKEY_B,
+                endpoint=(ipaddress.ip_address('fe80::1'), 4321),
+            ),
+            wg.WGPeer(pubkey=PUBKEY_B, remove=True),
+        ])
+
+        self.assertSubprocesses(
+            (['set', 'wg-test', 'peer', PUBKEY_B, 'remove'], None),
+            (['addconf', 'wg-test', '/dev/stdin'], '\n'.join([
+                '[Peer]',
+                f'PublicKey = {PUBKEY_A}',
+                f'PresharedKey = {PSK}',
+                'Endpoint = 192.168.0.2:1234',
+                'PersistentKeepalive = 5',
+                'AllowedIPs = fd00::1/128',
+                '[Peer]',
+                f'PublicKey = {PUBKEY_B}',
+                'Endpoint = [fe80::1]:4321',
+            ]) + '\n'),
+        )
+        self.assertEqual(self.run.call_count, 2)
+
+    def test_dump(self) -> None:
+        self.setRunSideEffects(DUMP)
+
+        device = wg.WGProcBackend().dump('wg-test')
+
+        self.assertSubprocess(['show', 'wg-test', 'dump'])
+        self.assertEqual(device.pubkey, 'pubkey')
+        self.assertEqual(device.listen_port, 51820)
+        self.assertIsNone(device.fwmark)
+        self.assertEqual(set(device.peers), {PUBKEY_A, PUBKEY_B})
+
+        peer_a = device.peers[PUBKEY_A]
+        self.assertEqual(peer_a.psk, PSK)
+        self.assertEqual(
+            peer_a.endpoint, (ipaddress.ip_address('fe80::1'), 1234))
+        self.assertEqual(peer_a.allowed_ips, (
+            ipaddress.ip_network('fd00::1/128'),
+            ipaddress.ip_network('fd00::2/128'),
+        ))
+        self.assertEqual(peer_a.keepalive, 5)
+        self.assertEqual(peer_a.latest_handshake, 1600000000)
+
+        peer_b = device.peers[PUBKEY_B]
+        self.assertEqual(peer_b, wg.WGPeer(pubkey=PUBKEY_B))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+import unittest
+import ipaddress
+
+from zerowire import wg, wgnetlink
+
+PUBKEY_A = 'h+LAI3+61Va12APH9GXLEy7NZdCLAPIb/ndrj9rsFBI='
+PUBKEY_B = '4T7IpKzwFODBZZruvNXawH7+Sr0bU5kYAslQ1LyS+FE='
+PSK = '1j75n1Zcwp9tUMuFH5H6C5Jn0PVjk66UXqSbY/OTjb8='
+
+
+class Test_WGNetlink(unittest.TestCase):
+
+    def test_peer_to_netlink(self) -> None:
+        res = wgnetlink.peer_to_netlink(wg.WGPeer(
+            pubkey=PUBKEY_A,
+            psk=PSK,
+            endpoint=(ipaddress.ip_address('fe80::1'), 1234),
+            keepalive=5,
+            allowed_ips=(ipaddress.ip_network('fd00::1/128'),),
+        ))
+
+        self.assertEqual(res, {
+            'public_key': PUBKEY_A,
+            'preshared_key': PSK,
+            'endpoint_addr': 'fe80::1',
+            'endpoint_port': 1234,
+            'persistent_keepalive': 5,
+            'replace_allowed_ips': True,
+            'allowed_ips': ['fd00::1/128'],
+        })
+
+    def test_peer_to_netlink_remove(self) -> None:
+        res = wgnetlink.peer_to_netlink(
+            wg.WGPeer(pubkey=PUBKEY_B, remove=True))
+
+        self.assertEqual(res, {'public_key': PUBKEY_B, 'remove': True})
+
+    def test_merge_peer_attrs(self) -> None:
+        res = wgnetlink.merge_peer_attrs([
+            ['WGDEVICE_A_IFNAME', 'wg-test'],
+            ['WGDEVICE_A_PEERS', [{'attrs': 'a'}]],
+            ['WGDEVICE_A_LISTEN_PORT', 1234],
+            ['WGDEVICE_A_PEERS', [{'attrs': 'b'}]],
+        ])
+
+        self.assertEqual(res, [
+            ['WGDEVICE_A_IFNAME', 'wg-test'],
+            ['WGDEVICE_A_LISTEN_PORT', 1234],
+            ['WGDEVICE_A_PEERS', [{'attrs': 'a'}, {'attrs': 'b'}]],
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
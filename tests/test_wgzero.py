@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import unittest
+import asyncio
+import base64
+import logging
+import ipaddress
+import os
+import tempfile
+import threading
+import time
+from dataclasses import replace
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from zeroconf import ServiceInfo
+
+from zerowire import classlogger, metrics, wg, wgzero
+from zerowire.app import App
+from zerowire.config import IFF_UP, Config, IfaceConfig, ServiceConfig
+from zerowire.dns import LocalDNSServer
+from zerowire.netmon import IPRoutePool
+from zerowire.probe import Prober
+
+CARRIER = ipaddress.ip_address('192.0.2.1')
+
+
+def key() -> str:
+    return base64.b64encode(os.urandom(32)).decode('ascii')
+
+
+class FakeLink(dict):  # type: ignore
+    '''Just enough of a pyroute2 message for WGZeroconf.scan.'''
+    def get_attr(self, name: str) -> Any:
+        return self[name]
+
+
+class FakeIPRoute:
+    '''The carrier links for WGZeroconf.scan, and every other name an up
+    WireGuard link with no addresses, for IfaceConfig.configure.'''
+    addresses = [CARRIER]
+
+    def __init__(self) -> None:
+        self.calls: List[Tuple[str, str, Dict[str, Any]]] = []
+
+    def get_links(self, *indexes: int) -> List[FakeLink]:
+        if indexes:
+            return [
+                FakeLink(
+                    index=index,
+                    flags=IFF_UP,
+                    IFLA_LINKINFO=FakeLink(IFLA_INFO_KIND='wireguard'),
+                )
+                for index in indexes
+            ]
+        return [
+            FakeLink(index=1, IFLA_IFNAME='lo'),
+            FakeLink(index=2, IFLA_IFNAME='eth0'),
+        ]
+
+    def get_addr(
+        self,
+        label: Optional[str] = None,
+        index: Optional[int] = None,
+    ) -> List[FakeLink]:
+        if index is not None:
+            return []
+        return [
+            FakeLink(IFA_ADDRESS=addr.compressed) for addr in self.addresses]
+
+    def link_lookup(self, ifname: str) -> List[int]:
+        return [3]
+
+    def link(self, command: str, **kwargs: Any) -> None:
+        self.calls.append(('link', command, kwargs))
+
+    def addr(self, command: str, **kwargs: Any) -> None:
+        self.calls.append(('addr', command, kwargs))
+
+    def close(self) -> None:
+        pass
+
+
+class FakeZeroconf:
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        self.registered: Dict[str, ServiceInfo] = {}
+        self.closed = False
+        # Threads that changed it, after construction
+        self.threads: Set[int] = set()
+
+    def register_service(self, info: ServiceInfo) -> None:
+        self.threads.add(threading.get_ident())
+        self.registered[info.name] = info
+
+    def unregister_service(self, info: ServiceInfo) -> None:
+        self.threads.add(threading.get_ident())
+        del self.registered[info.name]
+
+    def close(self) -> None:
+        self.threads.add(threading.get_ident())
+        self.closed = True
+
+
+class BlockingZeroconf(FakeZeroconf):
+    '''Blocks like the real one, registering waits out the announcements
+    and closing sends goodbyes.'''
+    DELAY = 0.2
+
+    def register_service(self, info: ServiceInfo) -> None:
+        time.sleep(self.DELAY)
+        super().register_service(info)
+
+    def close(self) -> None:
+        time.sleep(self.DELAY)
+        super().close()
+
+
+class FakeBackend(wg.WGBackend):
+    def __init__(self) -> None:
+        self.devices: List[str] = []
+
+    def set_device(
+        self,
+        ifname: str,
+        privkey: str,
+        port: Optional[int] = None,
+    ) -> None:
+        self.devices.append(ifname)
+
+    def set_peers(self, ifname: str, peers: Iterable[wg.WGPeer]) -> None:
+        pass
+
+    def dump(self, ifname: str) -> wg.WGDevice:
+        return wg.WGDevice()
+
+
+def make_config(name: str, addr: str, **kwargs: Any) -> IfaceConfig:
+    return IfaceConfig(
+        name=name,
+        addr=ipaddress.ip_interface(addr),
+        privkey=key(),
+        pubkey=key(),
+        psk=key(),
+        port=51820,
+        **kwargs,
+    )
+
+
+class WGZeroconfTest(unittest.TestCase):
+    '''One engine on a fake carrier link, with interfaces added by
+    `interface()`.'''
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        for patcher in (
+            patch('pyroute2.IPRoute', FakeIPRoute),
+            patch('zerowire.wgzero.Zeroconf', FakeZeroconf),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        IPRoutePool.close()
+        self.addCleanup(IPRoutePool.close)
+        classlogger.LIMITS.clear()
+        self.engine = wgzero.WGZeroconf()
+        self.dns = LocalDNSServer(ipaddress.ip_address('127.0.0.1'), 0)
+        self.prober = Prober()
+
+    def tearDown(self) -> None:
+        self.engine.close()
+        self.prober.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def interface(self, config: IfaceConfig) -> wgzero.WGInterface:
+        return wgzero.WGInterface(
+            config.name, config, self.dns, FakeBackend(), self.prober,
+            self.engine)
+
+    def announce(
+        self,
+        config: IfaceConfig,
+        machineid: str,
+        addr: str,
+        hostname: str = 'peer',
+        pubkey: Optional[str] = None,
+    ) -> wgzero.WGServiceInfo:
+        '''A peer on the network of `config`, signed with its psk.'''
+        return wgzero.WGServiceInfo.new(
+            machineid,
+            addresses=[ipaddress.ip_address('192.0.2.2').packed],
+            hostname=hostname,
+            config=replace(
+                config, addr=ipaddress.ip_interface(addr),
+                pubkey=pubkey or key(), port=51821),
+        )
+
+    def settle(self) -> None:
+        '''Wait for every Zeroconf call queued so far.'''
+        self.loop.run_until_complete(
+            self.loop.run_in_executor(self.engine.executor, lambda: None))
+
+    def rebind(self, carrier: ipaddress.IPv4Address) -> None:
+        '''Move the carrier link to `carrier` and wait for the swap.'''
+        old = self.engine.zeroconf
+        with patch.object(FakeIPRoute, 'addresses', [carrier]):
+            self.engine.links_changed({2})
+            for _ in range(100):
+                if self.engine.zeroconf is not old:
+                    break
+                self.loop.run_until_complete(asyncio.sleep(0.01))
+        self.settle()
+
+    def names(self) -> Dict[str, List[str]]:
+        '''Global DNS, name to addresses.'''
+        return {
+            name: [str(record) for records in types.values()
+                   for record in records]
+            for name, types in self.dns.records.snapshot().items()
+        }
+
+
+class Test_WGInterface(WGZeroconfTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.config = make_config('wg0', 'fd00::1/64')
+        self.iface = self.interface(self.config)
+
+    def test_renamed_peer(self) -> None:
+        pubkey = key()
+        for hostname, addr in (
+            ('old', 'fd00::2/64'),
+            ('new', 'fd00::2/64'),
+            ('new', 'fd00::3/64'),
+        ):
+            info = self.announce(
+                self.config, 'a', addr, hostname=hostname, pubkey=pubkey)
+            self.assertTrue(self.iface.listener.handle_info(info.name, info))
+
+        self.assertEqual(self.names(), {'new.zerowire.': ['fd00::3']})
+        self.assertEqual(
+            self.iface.reconciler.desired[pubkey].allowed_ips,
+            (ipaddress.ip_network('fd00::3/128'),))
+
+    def test_touch_evicts(self) -> None:
+        first = self.announce(self.config, 'a', 'fd00::2/64', hostname='a')
+        second = self.announce(self.config, 'b', 'fd00::3/64', hostname='b')
+        self.iface.listener.handle_info(first.name, first)
+        self.iface.listener.handle_info(second.name, second)
+        self.iface.peers.max_peers = 1
+
+        # Unchanged, so only refreshed, which still has to honour the cap
+        self.iface.listener.handle_info(second.name, second)
+
+        self.assertEqual(len(self.iface.peers), 1)
+        self.assertEqual(self.names(), {'b.zerowire.': ['fd00::3']})
+        self.assertEqual(len(self.iface.reconciler.desired), 1)
+        self.assertEqual(len(self.iface.listener.peers), 1)
+
+    def test_drop_peer(self) -> None:
+        info = self.announce(self.config, 'a', 'fd00::2/64', hostname='a')
+        self.iface.listener.handle_info(info.name, info)
+        entry = next(iter(self.iface.peers.entries.values()))
+
+        self.iface.drop_peer(entry)
+
+        self.assertEqual(len(self.iface.peers), 0)
+        self.assertEqual(self.iface.reconciler.desired, {})
+        self.assertEqual(self.iface.listener.peers, {})
+        self.assertEqual(self.names(), {})
+
+    def test_collect(self) -> None:
+        now = time.time()
+        for machineid, addr in (('a', 'fd00::2/64'), ('b', 'fd00::3/64')):
+            info = self.announce(
+                self.config, machineid, addr, hostname=machineid)
+            self.iface.listener.handle_info(info.name, info)
+        stale, active = self.iface.peers.entries.values()
+        later = now + self.iface.peers.ttl + 1
+        # Only the kernel knows the second peer is still talking to us
+        self.iface.reconciler.last_dump = wg.WGDevice(peers={
+            active.pubkey: wg.WGPeer(
+                pubkey=active.pubkey, latest_handshake=int(later)),
+        })
+
+        expired = self.iface.collect(later)
+
+        self.assertEqual(expired, [stale])
+        self.assertEqual(list(self.iface.peers.entries), [active.pubkey])
+        self.assertEqual(list(self.iface.reconciler.desired), [active.pubkey])
+        self.assertEqual(self.names(), {'b.zerowire.': ['fd00::3']})
+
+    def test_can_reload(self) -> None:
+        self.assertTrue(self.iface.can_reload(
+            replace(self.config, port=51821, privkey=key())))
+        self.assertFalse(self.iface.can_reload(
+            replace(self.config, addr=ipaddress.ip_interface('fd00::9/64'))))
+
+    def test_reload_peers(self) -> None:
+        service = self.engine.services['wg0']
+
+        self.loop.run_until_complete(self.iface.reload(
+            replace(self.config, peer_ttl=60, max_peers=3)))
+
+        self.assertEqual(self.iface.peers.ttl, 60)
+        self.assertEqual(self.iface.peers.max_peers, 3)
+        # Nothing announced or configured changed
+        self.assertIs(self.engine.services['wg0'], service)
+        self.assertEqual(self.iface.backend.devices, [])  # type: ignore
+
+    def test_reload_services(self) -> None:
+        old = ServiceConfig('_http._tcp', 'web', 80)
+        new = ServiceConfig('_http._tcp', 'web', 8080)
+        kept = ServiceConfig('_ssh._tcp', 'shell', 22)
+        self.config.services = [old, kept]
+        dns = self.iface.dns
+        with patch.object(dns, 'add_service'), \
+                patch.object(dns, 'remove_service'):
+            self.loop.run_until_complete(self.iface.reload(
+                replace(self.config, services=[new, kept])))
+
+            dns.remove_service.assert_called_once_with(  # type: ignore
+                old)
+            dns.add_service.assert_called_once_with(new)  # type: ignore
+
+    def test_reload_keys(self) -> None:
+        self.settle()
+        old = self.engine.services['wg0']
+        pubkey = key()
+
+        self.loop.run_until_complete(self.iface.reload(
+            replace(self.config, privkey=key(), pubkey=pubkey)))
+        self.settle()
+        service = self.engine.services['wg0']
+
+        self.assertEqual(self.iface.backend.devices, ['wg0'])  # type: ignore
+        self.assertEqual(self.iface.listener.pubkey, pubkey)
+        self.assertIsNot(service, old)
+        self.assertEqual(
+            list(self.engine.zeroconf.registered.values()),  # type: ignore
+            [service])
+
+
+class Test_WGZeroconf(WGZeroconfTest):
+    def setUp(self) -> None:
+        super().setUp()
+        self.configs = [
+            make_config('wg0', 'fd00::1/64'),
+            make_config('wg1', 'fd01::1/64'),
+        ]
+        self.ifaces = [self.interface(config) for config in self.configs]
+
+    def test_add_interface(self) -> None:
+        zeroconf = self.engine.zeroconf
+        self.settle()
+
+        self.assertEqual(list(self.engine.listeners), ['wg0', 'wg1'])
+        self.assertEqual(
+            [listener.wg_iface for listener in self.engine.listeners.values()],
+            self.ifaces)
+        self.assertEqual(
+            set(zeroconf.registered),  # type: ignore
+            {service.name for service in self.engine.services.values()})
+        self.assertEqual(len(zeroconf.registered), 2)  # type: ignore
+        self.assertNotIn(
+            threading.get_ident(), zeroconf.threads)  # type: ignore
+
+    def test_remove_interface(self) -> None:
+        service = self.engine.services['wg0']
+
+        self.ifaces[0].close()
+        self.settle()
+
+        self.assertEqual(list(self.engine.listeners), ['wg1'])
+        self.assertEqual(list(self.engine.services), ['wg1'])
+        self.assertNotIn(
+            service.name, self.engine.zeroconf.registered)  # type: ignore
+        self.assertNotIn(
+            threading.get_ident(),
+            self.engine.zeroconf.threads)  # type: ignore
+        info = self.announce(self.configs[0], 'a', 'fd00::2/64')
+        with self.assertLogs(self.engine.logger, logging.WARNING):
+            self.engine.handle_info(info.name, info)
+        self.assertEqual(len(self.ifaces[0].peers), 0)
+
+    def test_rebind(self) -> None:
+        self.settle()
+        old = self.engine.zeroconf
+        old.threads.clear()  # type: ignore
+        carrier = ipaddress.ip_address('192.0.2.3')
+
+        self.rebind(carrier)
+        zeroconf = self.engine.zeroconf
+
+        self.assertIsNot(zeroconf, old)
+        self.assertIs(self.engine.pipeline.zeroconf, zeroconf)
+        self.assertEqual(self.engine.addresses, [carrier])
+        self.assertTrue(old.closed)  # type: ignore
+        self.assertEqual(
+            set(zeroconf.registered),  # type: ignore
+            {service.name for service in self.engine.services.values()})
+        self.assertEqual(
+            [service.addresses for service in self.engine.services.values()],
+            [[carrier.packed]] * 2)
+        # Only references are swapped on the loop
+        self.assertNotIn(
+            threading.get_ident(),
+            old.threads | zeroconf.threads)  # type: ignore
+
+    def test_rebind_blocking(self) -> None:
+        self.settle()
+        gaps: List[float] = []
+
+        async def tick() -> None:
+            last = time.monotonic()
+            while True:
+                await asyncio.sleep(0.01)
+                now = time.monotonic()
+                gaps.append(now - last)
+                last = now
+
+        ticker = self.loop.create_task(tick())
+        with patch('zerowire.wgzero.Zeroconf', BlockingZeroconf):
+            # Two registers on the new binding and closing the old one
+            self.rebind(ipaddress.ip_address('192.0.2.3'))
+        ticker.cancel()
+        self.loop.run_until_complete(asyncio.gather(
+            ticker, return_exceptions=True))
+
+        self.assertIsInstance(self.engine.zeroconf, BlockingZeroconf)
+        self.assertGreater(len(gaps), 10)
+        self.assertLess(max(gaps), BlockingZeroconf.DELAY / 2)
+
+    def test_rebind_remove_interface(self) -> None:
+        carrier = ipaddress.ip_address('192.0.2.3')
+        service = self.engine.services['wg0']
+        with patch.object(FakeIPRoute, 'addresses', [carrier]):
+            self.engine.links_changed({2})
+            # Gone before the new binding is swapped in
+            self.ifaces[0].close()
+            self.rebind(carrier)
+        zeroconf = self.engine.zeroconf
+
+        self.assertEqual(self.engine.addresses, [carrier])
+        self.assertEqual(list(self.engine.services), ['wg1'])
+        self.assertEqual(
+            list(zeroconf.registered),  # type: ignore
+            [self.engine.services['wg1'].name])
+        self.assertNotEqual(service.name, self.engine.services['wg1'].name)
+
+    def test_handle_info(self) -> None:
+        authenticated = metrics.SERVICES.get('authenticated')
+        info = self.announce(self.configs[1], 'a', 'fd01::2/64', hostname='a')
+
+        self.engine.handle_info(info.name, info)
+
+        # Only the interface whose psk signed it takes the peer
+        self.assertEqual(len(self.ifaces[0].peers), 0)
+        self.assertEqual(len(self.ifaces[1].peers), 1)
+        self.assertEqual(self.names(), {'a.zerowire.': ['fd01::2']})
+        self.assertEqual(
+            metrics.SERVICES.get('authenticated'), authenticated + 1)
+
+    def test_handle_info_rejected(self) -> None:
+        rejected = metrics.SERVICES.get('rejected')
+        # Another network on the same prefix, under a psk we do not have
+        stranger = make_config('wg2', 'fd00::1/64')
+        info = self.announce(stranger, 'a', 'fd00::2/64')
+
+        with self.assertLogs(self.engine.logger, logging.WARNING):
+            self.engine.handle_info(info.name, info)
+
+        self.assertEqual([len(iface.peers) for iface in self.ifaces], [0, 0])
+        self.assertEqual(metrics.SERVICES.get('rejected'), rejected + 1)
+
+    def test_handle_info_rejected_burst(self) -> None:
+        rejected = metrics.SERVICES.get('rejected')
+        stranger = make_config('wg2', 'fd00::1/64')
+        info = self.announce(stranger, 'a', 'fd00::2/64')
+
+        with self.assertLogs(self.engine.logger, logging.WARNING) as logs:
+            for _ in range(20):
+                self.engine.handle_info(info.name, info)
+                self.engine.handle_info(info.name, None)
+
+        self.assertEqual(
+            [record.event for record in logs.records],  # type: ignore
+            ['service_rejected', 'service_missing'])
+        self.assertEqual(metrics.SERVICES.get('rejected'), rejected + 20)
+
+    def test_handle_info_own(self) -> None:
+        for listener in self.engine.listeners.values():
+            patcher = patch.object(listener, 'handle_info')
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        for service in list(self.engine.services.values()):
+            self.engine.handle_info(service.name, service)
+
+        for listener in self.engine.listeners.values():
+            listener.handle_info.assert_not_called()  # type: ignore
+
+
+def iface_dict(addr: str, **kwargs: Any) -> Dict[str, Any]:
+    return dict(
+        addr=addr, privkey=key(), pubkey=key(), psk=key(), port=51820,
+        **kwargs)
+
+
+class Test_AppReload(WGZeroconfTest):
+    '''App.__reload on a bare App, with interfaces that do not start.'''
+    def setUp(self) -> None:
+        super().setUp()
+
+        async def start(iface: wgzero.WGInterface) -> None:
+            pass
+        patcher = patch.object(wgzero.WGInterface, 'start', start)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.file = tempfile.NamedTemporaryFile('w', suffix='.yaml')
+        self.addCleanup(self.file.close)
+        self.app = App.__new__(App)
+        self.app.loop = self.loop
+        self.app.interfaces = []
+        self.app.args = SimpleNamespace(config=self.file)  # type: ignore
+        self.app.config = Config({})
+        self.app.backend = FakeBackend()
+        self.app.dns = self.dns
+        self.app.prober = self.prober
+        self.app.zeroconf = self.engine
+        self.app.reload_lock = asyncio.Lock()
+
+    def tearDown(self) -> None:
+        for iface in self.app.interfaces:
+            iface.close()
+        super().tearDown()
+
+    def reload(self, interfaces: Dict[str, Dict[str, Any]]) -> None:
+        import yaml
+        self.file.seek(0)
+        self.file.truncate()
+        yaml.safe_dump({'interfaces': interfaces}, self.file)
+        self.file.flush()
+        self.loop.run_until_complete(
+            self.app._App__reload())  # type: ignore
+        self.settle()
+
+    def ifnames(self) -> List[str]:
+        return [iface.ifname for iface in self.app.interfaces]
+
+    def registered(self) -> Set[str]:
+        return set(self.engine.zeroconf.registered)  # type: ignore
+
+    def test_add(self) -> None:
+        self.reload({'a': iface_dict('fd00::1/64')})
+
+        self.assertEqual(self.ifnames(), ['wg-a'])
+        self.assertEqual(list(self.engine.listeners), ['wg-a'])
+        self.assertEqual(
+            self.registered(), {self.engine.services['wg-a'].name})
+        self.assertEqual(self.app.backend.devices, ['wg-a'])  # type: ignore
+        self.assertEqual(list(self.app.config), ['wg-a'])
+
+    def test_remove(self) -> None:
+        self.reload({'a': iface_dict('fd00::1/64')})
+
+        self.reload({})
+
+        self.assertEqual(self.ifnames(), [])
+        self.assertEqual(self.engine.listeners, {})
+        self.assertEqual(self.registered(), set())
+        with IPRoutePool.get() as ip:
+            self.assertIn(
+                ('link', 'del', {'index': 3}), ip.calls)  # type: ignore
+
+    def test_reload_in_place(self) -> None:
+        config = iface_dict('fd00::1/64')
+        self.reload({'a': config})
+        iface = self.app.interfaces[0]
+
+        self.reload({'a': dict(config, peer_ttl=60)})
+
+        self.assertIs(self.app.interfaces[0], iface)
+        self.assertEqual(iface.peers.ttl, 60)
+
+    def test_replace(self) -> None:
+        config = iface_dict('fd00::1/64')
+        self.reload({'a': config})
+        iface = self.app.interfaces[0]
+
+        # A new address cannot be reloaded, so the interface is rebuilt
+        self.reload({'a': dict(config, addr='fd00::9/64')})
+
+        self.assertEqual(self.ifnames(), ['wg-a'])
+        replaced = self.app.interfaces[0]
+        self.assertIsNot(replaced, iface)
+        self.assertEqual(
+            replaced.config.addr, ipaddress.ip_interface('fd00::9/64'))
+        self.assertIs(self.engine.listeners['wg-a'].wg_iface, replaced)
+        self.assertEqual(
+            self.registered(), {self.engine.services['wg-a'].name})
+
+
+if __name__ == '__main__':
+    unittest.main()
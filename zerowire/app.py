@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+from . import __version__
+from .args import Args
+from .config import Config, IfaceConfig
+from .control import (
+    ControlServer,
+    TStatus,
+    dns_client_status,
+    interface_status,
+    zone_status,
+)
+from .wg import WGBackend
+from .wgzero import WGInterface, WGZeroconf, link_index
+from .dns import LocalDNSServer
+from .metrics import REGISTRY, MetricsServer
+from .peercache import PeerCache
+from .probe import Prober
+from .resolver import ResolvedClient, parse_upstreams, resolv_conf_upstreams
+from .netmon import IPRoutePool
+from .startup import ImportProfiler
+from .types import TEndpoint
+
+from typing import (
+    List,
+    Optional,
+    TYPE_CHECKING,
+)
+
+import time
+import logging
+from .classlogger import ClassLogger
+
+import ipaddress
+from asyncio import (
+    AbstractEventLoop,
+    gather,
+    get_event_loop,
+    Lock,
+    Task,
+)
+from concurrent.futures import ThreadPoolExecutor
+from signal import SIGHUP, SIGINT, SIGTERM
+
+if TYPE_CHECKING:
+    from .dnsworkers import DNSWorkers
+
+
+FORMAT = '[%(levelname)s] %(name)s - %(message)s'
+CONFIGURE_CONCURRENCY = 8
+LOCAL_DNS = ipaddress.ip_address('127.122.119.53')
+RESOLVER_MODES = ('resolved', 'stub', 'none')
+
+
+class App(ClassLogger):
+    loop: AbstractEventLoop
+    interfaces: List[WGInterface]
+    dns_workers: Optional[DNSWorkers] = None
+    metrics: Optional[MetricsServer] = None
+    peer_cache: Optional[PeerCache] = None
+    resolver: Optional[ResolvedClient] = None
+    control: Optional[ControlServer] = None
+    __stopping: bool = False
+
+    def __init__(
+        self,
+        args: Args,
+        profiler: Optional[ImportProfiler] = None,
+    ) -> None:
+        self.started = time.time()
+        self.loop = get_event_loop()
+        self.interfaces = []
+
+        self.args = args
+        self.profiler = profiler
+
+        logging.basicConfig(format=FORMAT, level=self.args.level)
+        self.config = Config.load(self.args.config)
+        self.logger.debug('Config %s', self.config.__dict__)
+        if self.args.dns_workers:
+            from .dnsworkers import DNSWorkers
+            # Forks, before anything below starts a thread
+            self.dns_workers = DNSWorkers(self.args.dns_workers)
+            self.dns_workers.start()
+        if self.args.resolver not in RESOLVER_MODES:
+            raise ValueError(f'Unknown resolver mode {self.args.resolver}')
+        upstreams: List[TEndpoint] = []
+        if self.args.resolver == 'stub':
+            upstreams = (
+                parse_upstreams(self.args.upstream) if self.args.upstream
+                else resolv_conf_upstreams(LOCAL_DNS))
+            if not upstreams:
+                raise ValueError('The stub resolver needs --upstream')
+            self.logger.info('Forwarding to %r', upstreams)
+        self.dns = LocalDNSServer(LOCAL_DNS, 53, upstreams=upstreams)
+        if self.args.resolver == 'resolved':
+            self.resolver = ResolvedClient(self.dns.bind)
+        self.backend = WGBackend.create(self.args.wg_backend)
+        self.prober = Prober()
+        if self.args.auth not in ('compat', 'hmac'):
+            raise ValueError(f'Unknown authentication mode {self.args.auth}')
+        self.zeroconf = WGZeroconf(compat=self.args.auth == 'compat')
+        if self.args.metrics:
+            self.metrics = MetricsServer(self.args.metrics)
+        if self.args.control:
+            self.control = ControlServer(self.args.control, self.status)
+        if self.args.peer_cache:
+            self.peer_cache = PeerCache(self.args.peer_cache)
+            self.peer_cache.load()
+
+        self.configure_interfaces()
+        for wg_ifname in self.config:
+            self.interfaces.append(self.new_interface(self.config[wg_ifname]))
+
+        self.reload_lock = Lock()
+        for sig in {SIGINT, SIGTERM}:
+            self.loop.add_signal_handler(sig, self.stop, sig)
+        self.loop.add_signal_handler(SIGHUP, self.reload)
+
+    def new_interface(
+        self,
+        config: IfaceConfig,
+        ifindex: Optional[int] = None,
+    ) -> WGInterface:
+        iface = WGInterface(
+            config.name,
+            config,
+            self.dns,
+            self.backend,
+            self.prober,
+            self.zeroconf,
+            self.peer_cache,
+            ifindex,
+        )
+        if self.resolver is not None:
+            self.resolver.add_link(iface.ifindex)
+        return iface
+
+    def configure_interfaces(self) -> None:
+        '''Bring every interface up at once, each one only changing what
+        differs from the kernel.'''
+        configs = [self.config[wg_ifname] for wg_ifname in self.config]
+        if not configs:
+            return
+        with ThreadPoolExecutor(
+            min(len(configs), CONFIGURE_CONCURRENCY),
+            thread_name_prefix='zerowire-configure',
+        ) as executor:
+            results = executor.map(
+                lambda config: config.configure(self.backend), configs)
+            for config, changed in zip(configs, results):
+                self.logger.info(
+                    '%s %s', config.name,
+                    'configured' if changed else 'already up to date')
+
+    def reload(self) -> None:
+        self.loop.create_task(self.__reload())
+
+    async def __reload(self) -> None:
+        '''Re-read the config and apply only the difference, interfaces
+        that did not change keep their peers and DNS records.'''
+        async with self.reload_lock:
+            self.logger.info('Reloading %s', self.args.config.name)
+            try:
+                with open(self.args.config.name) as file:
+                    config = Config.load(file)
+            except Exception as e:
+                self.logger.error('Reload failed, config unchanged: %s', e)
+                return
+            for iface in list(self.interfaces):
+                if iface.ifname not in config:
+                    await self.remove_interface(iface, delete=True)
+            for wg_ifname in config:
+                wg_ifconfig = config[wg_ifname]
+                running = self.interface(wg_ifname)
+                try:
+                    if running is None:
+                        await self.add_interface(wg_ifconfig)
+                    elif running.can_reload(wg_ifconfig):
+                        await running.reload(wg_ifconfig)
+                    else:
+                        await self.remove_interface(running)
+                        await self.add_interface(wg_ifconfig)
+                except Exception as e:
+                    self.logger.exception(e)
+            self.config = config
+
+    def interface(self, ifname: str) -> Optional[WGInterface]:
+        for iface in self.interfaces:
+            if iface.ifname == ifname:
+                return iface
+        return None
+
+    async def add_interface(self, config: IfaceConfig) -> None:
+        self.logger.info('Adding %s', config.name)
+        await self.loop.run_in_executor(None, config.configure, self.backend)
+        ifindex = await self.loop.run_in_executor(
+            None, link_index, config.name)
+        iface = self.new_interface(config, ifindex)
+        self.interfaces.append(iface)
+        if self.dns_workers is not None:
+            self.dns_workers.add_server(iface.dns)
+        await iface.start()
+
+    async def remove_interface(
+        self,
+        iface: WGInterface,
+        delete: bool = False,
+    ) -> None:
+        self.logger.info('Removing %s', iface.ifname)
+        self.interfaces.remove(iface)
+        if self.dns_workers is not None:
+            self.dns_workers.remove_server(iface.dns)
+        iface.close()
+        if self.resolver is not None:
+            self.resolver.remove_link(iface.ifindex, revert=not delete)
+        if self.peer_cache is not None:
+            self.peer_cache.untrack(iface.ifname)
+        for entry in list(iface.peers.entries.values()):
+            self.dns.del_addr_record(entry.hostname, entry.internal_addr)
+        if delete:
+            await self.loop.run_in_executor(None, iface.config.deconfigure)
+
+    async def __stop(self, sig: int) -> None:
+        self.logger.info('Exiting on signal %d', sig)
+        if self.peer_cache is not None:
+            # Before the interfaces close, while their peers are known
+            self.peer_cache.flush()
+        for wgiface in self.interfaces:
+            wgiface.close()
+        await self.zeroconf.stop()
+        IPRoutePool.close()
+        self.backend.close()
+        self.prober.close()
+        self.dns.close()
+        if self.resolver is not None:
+            self.resolver.close()
+        if self.dns_workers is not None:
+            self.dns_workers.close()
+        if self.metrics is not None:
+            self.metrics.close()
+        if self.control is not None:
+            self.control.close()
+
+    def stop(self, sig: int) -> None:
+        if self.__stopping:
+            return
+        self.__stopping = True
+
+        def stop(task: Task[None]) -> None:
+            self.logger.info('Stopping event loop')
+            self.loop.stop()
+        self.loop.create_task(self.__stop(sig)).add_done_callback(stop)
+
+    async def init_task(self) -> None:
+        if self.dns_workers is not None:
+            self.dns_workers.add_server(self.dns)
+            for iface in self.interfaces:
+                self.dns_workers.add_server(iface.dns)
+        if self.metrics is not None:
+            await self.metrics.start()
+        if self.control is not None:
+            await self.control.start()
+        await self.dns.start()
+        if self.resolver is not None:
+            await self.resolver.start()
+        await self.prober.start()
+        await gather(*(
+            iface.start()
+            for iface in self.interfaces
+        ))
+        await self.zeroconf.start()
+        self.logger.info('Init done')
+        if self.profiler is not None:
+            self.profiler.uninstall()
+            self.logger.info('Startup profile\n%s', self.profiler.report())
+
+    def status(self) -> TStatus:
+        return {
+            'version': __version__,
+            'started': self.started,
+            'interfaces': [
+                interface_status(iface) for iface in self.interfaces],
+            'zone': zone_status(self.dns.get_all_records()),
+            'dns_client': dns_client_status(self.dns.client),
+            'counters': REGISTRY.series(),
+        }
+
+    def run(self) -> None:
+        try:
+            self.loop.create_task(self.init_task())
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
@@ -1,16 +1,50 @@
 '''
 Usage:
-  zerowire [options]
+  zerowire [options] [--control=<path>]
+  zerowire status [--watch] [--interval=<secs>] [--json] [--control=<path>]
 
 Options:
   -h --help                      Show this help.
   --version                      Show version.
   -c <config> --config=<config>  Set config location. [default: /etc/security/zerowire.conf].
   -l <level> --level=<level>     Set logging level. [default: info].
+  --wg-backend=<backend>         WireGuard backend, wg or netlink.
+                                 [default: wg].
+  --dns-workers=<count>          Extra processes serving DNS. [default: 0].
+  --auth=<mode>                  Service authentication, compat (also the
+                                 pre-HMAC digest) or hmac. [default: compat].
+  --metrics=<address>            Serve Prometheus metrics on host:port or
+                                 unix:<path>.
+  --peer-cache=<path>            Remember peers here for a warm start, empty
+                                 to disable.
+                                 [default: /var/lib/zerowire/peers.json].
+  --resolver=<mode>              How the host resolves zerowire. names:
+                                 resolved (systemd-resolved over D-Bus),
+                                 stub (point resolv.conf at 127.122.119.53,
+                                 the rest is forwarded to --upstream) or
+                                 none. [default: resolved].
+  --upstream=<servers>           Comma separated DNS servers for the stub
+                                 resolver, addr or addr:port, default the
+                                 nameservers in /etc/resolv.conf.
+  --startup-profile              Log the startup time and the import time of
+                                 each package once up.
+  --control=<path>               UNIX socket of the status API, empty to
+                                 disable.
+                                 [default: /run/zerowire/control.sock].
+
+Status options:
+  --watch                        Follow changes until interrupted.
+  --interval=<secs>              Seconds between checks for changes.
+                                 [default: 2].
+  --json                         Print the raw JSON, one status per line.
 '''
 from __future__ import annotations
 from typing import (
+    Any,
+    Dict,
+    Optional,
     TextIO,
+    Union,
 )
 import logging
 from enum import IntEnum
@@ -36,13 +70,56 @@ class Args:
     help: bool
     version: bool
     level: LogLevels
+    wg_backend: str
+    dns_workers: int
+    auth: str
+    metrics: Optional[str]
+    peer_cache: Optional[str]
+    startup_profile: bool
+    resolver: str
+    upstream: Optional[str]
+    control: Optional[str]
 
     @classmethod
-    def from_docopt(Cls) -> Args:
-        args = docopt(__doc__, version=VERSION)
+    def from_docopt(Cls, args: Dict[str, Any]) -> Args:
         return Cls(
             open(args['--config']),
             args['--help'],
             args['--version'],
             LogLevels[args['--level']],
+            args['--wg-backend'],
+            int(args['--dns-workers']),
+            args['--auth'],
+            args['--metrics'],
+            args['--peer-cache'] or None,
+            args['--startup-profile'],
+            args['--resolver'],
+            args['--upstream'],
+            args['--control'] or None,
+        )
+
+
+@dataclass(frozen=True)
+class StatusArgs:
+    control: str
+    watch: bool
+    interval: float
+    json: bool
+
+    @classmethod
+    def from_docopt(Cls, args: Dict[str, Any]) -> StatusArgs:
+        return Cls(
+            args['--control'],
+            args['--watch'],
+            float(args['--interval']),
+            args['--json'],
         )
+
+
+def parse() -> Union[Args, StatusArgs]:
+    '''The daemon arguments, or those of `zerowire status`, which leaves
+    the config unopened.'''
+    args = docopt(__doc__, version=VERSION)
+    if args['status']:
+        return StatusArgs.from_docopt(args)
+    return Args.from_docopt(args)
@@ -0,0 +1,133 @@
+from __future__ import annotations
+from typing import (
+    Dict,
+    Optional,
+    Tuple,
+)
+import hmac
+import base64
+import binascii
+import hashlib
+import struct
+from collections import OrderedDict
+
+from zeroconf import ServiceInfo
+
+from .classlogger import ClassLogger
+
+TProperties = Dict[bytes, Optional[bytes]]
+# Name, port and every property, the properties sorted
+TVerifyKey = Tuple[
+    str, Optional[int], Tuple[Tuple[bytes, Optional[bytes]], ...]]
+
+# Properties covered by the HMAC, in order
+SIGNED = (b'addr', b'hostname', b'pubkey', b'probe', b'salt')
+FIELD_LENGTH = struct.Struct('!H')
+
+
+def prop(properties: TProperties, key: bytes) -> bytes:
+    return properties.get(key) or b''
+
+
+def message(name: str, port: Optional[int], properties: TProperties) -> bytes:
+    '''Length prefixed fields, so no two announcements sign the same bytes.'''
+    fields = [
+        name.encode('utf-8'),
+        str(port).encode('utf-8'),
+        *(prop(properties, key) for key in SIGNED),
+    ]
+    return b''.join(FIELD_LENGTH.pack(len(field)) + field for field in fields)
+
+
+def sign(
+    name: str,
+    port: Optional[int],
+    properties: TProperties,
+    psk: str,
+) -> bytes:
+    '''The `hmac` property, HMAC-SHA256 keyed by the psk.'''
+    mac = hmac.new(
+        psk.encode('utf-8'), message(name, port, properties), hashlib.sha256)
+    return base64.b64encode(mac.digest())
+
+
+def legacy_digest(
+    name: str,
+    port: Optional[int],
+    properties: TProperties,
+    psk: str,
+) -> bytes:
+    '''The `auth` property understood by releases before the HMAC, a plain
+    SHA-256 over the fields with the psk appended.'''
+    digest = hashlib.sha256(name.encode('utf-8'))
+    digest.update(str(port).encode('utf-8'))
+    for key in (b'addr', b'hostname', b'pubkey', b'salt'):
+        digest.update(prop(properties, key))
+    digest.update(psk.encode('utf-8'))
+    return base64.b64encode(digest.digest())
+
+
+def verify(info: ServiceInfo, psk: str, compat: bool = True) -> bool:
+    '''Whether `info` was announced by a holder of `psk`. An `hmac` property
+    must verify; without one, `compat` accepts the legacy `auth` digest.'''
+    properties: TProperties = info.properties
+    signature = properties.get(b'hmac')
+    if signature is not None:
+        try:
+            expected = base64.b64decode(signature, validate=True)
+        except binascii.Error:
+            return False
+        mac = hmac.new(
+            psk.encode('utf-8'),
+            message(info.name, info.port, properties),
+            hashlib.sha256)
+        return hmac.compare_digest(mac.digest(), expected)
+    if not compat:
+        return False
+    return hmac.compare_digest(
+        legacy_digest(info.name, info.port, properties, psk),
+        prop(properties, b'auth'))
+
+
+class ServiceVerifier(ClassLogger):
+    '''verify() against one psk, with the verdicts of the last `max_entries`
+    distinct announcements remembered.
+
+    Zeroconf resolves the same unchanged announcement again and again, on
+    every cache refresh and re-announcement, and every interface sees the
+    services of every other one. The key holds the announcement itself, so
+    only a byte for byte repeat is answered from the cache.'''
+    verdicts: OrderedDict[TVerifyKey, bool]
+
+    def __init__(self, psk: str, compat: bool = True, max_entries: int = 1024):
+        self.psk = psk
+        self.compat = compat
+        self.max_entries = max_entries
+        self.verdicts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self.verdicts)
+
+    @staticmethod
+    def key(info: ServiceInfo) -> TVerifyKey:
+        properties: TProperties = info.properties
+        return (info.name, info.port, tuple(sorted(properties.items())))
+
+    def verify(self, info: ServiceInfo) -> bool:
+        key = self.key(info)
+        verdict = self.verdicts.get(key)
+        if verdict is not None:
+            self.hits += 1
+            self.verdicts.move_to_end(key)
+            return verdict
+        self.misses += 1
+        verdict = verify(info, self.psk, self.compat)
+        self.verdicts[key] = verdict
+        if len(self.verdicts) > self.max_entries:
+            self.verdicts.popitem(last=False)
+        return verdict
+
+    def clear(self) -> None:
+        self.verdicts.clear()
@@ -1,8 +1,73 @@
 from __future__ import annotations
-from typing import Optional
+from typing import (
+    Any,
+    Dict,
+    Optional,
+    Tuple,
+)
+import json
+import time
+from threading import Lock
 from logging import getLogger, Logger
 
 
+class RateLimit:
+    '''Token bucket of one call site, and what it held back since the last
+    record it let through.'''
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'calls', 'suppressed')
+
+    def __init__(self, rate: Optional[float], burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.calls = 0
+        self.suppressed = 0
+
+    def allow(self, sample: int) -> bool:
+        self.calls += 1
+        if self.calls % sample:
+            return False
+        if self.rate is None:
+            return True
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Event:
+    '''`name key=value ...`, formatted only once a handler emits it.'''
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name: str, fields: Dict[str, Any]) -> None:
+        self.name = name
+        self.fields = fields
+
+    @staticmethod
+    def format_value(value: Any) -> str:
+        text = str(value)
+        if not text or any(char in text for char in ' ="\\\n'):
+            return json.dumps(text)
+        return text
+
+    def __str__(self) -> str:
+        return ' '.join((self.name, *(
+            f'{key}={self.format_value(value)}'
+            for key, value in self.fields.items()
+        )))
+
+
+# Per logger and event, kept out of the class so dataclasses do not see it
+LIMITS: Dict[Tuple[str, str], RateLimit] = {}
+LIMITS_LOCK = Lock()
+
+
 class ClassLogger:
     __cachedLogger: Optional[Logger] = None
     __loggerName: Optional[str] = None
@@ -31,3 +96,42 @@ class ClassLogger:
             else:
                 self.__cachedLogger = clslogger.getChild(name)
         return self.__cachedLogger
+
+    def log_event(
+        self,
+        level: int,
+        event: str,
+        *,
+        rate: Optional[float] = None,
+        burst: Optional[float] = None,
+        sample: int = 1,
+        exc_info: Any = None,
+        **fields: Any,
+    ) -> None:
+        '''Log `event` with key=value fields, for hot paths.
+
+        Nothing is formatted unless the level is on and a handler emits the
+        record, which also carries `event` and `fields` as attributes. With
+        `rate` at most that many records a second (after a `burst`, default
+        `rate`) are let through, with `sample` one call in that many; the
+        next record let through counts what was held back.'''
+        logger = self.logger
+        if not logger.isEnabledFor(level):
+            return
+        if rate is not None or sample > 1:
+            key = (logger.name, event)
+            with LIMITS_LOCK:
+                limit = LIMITS.get(key)
+                if limit is None:
+                    limit = LIMITS[key] = RateLimit(
+                        rate, max(1.0, rate or 1) if burst is None else burst)
+                if not limit.allow(sample):
+                    return
+                suppressed, limit.suppressed = limit.suppressed, 0
+            if sample > 1:
+                fields['sampled'] = sample
+            if suppressed:
+                fields['suppressed'] = suppressed
+        logger.log(
+            level, '%s', Event(event, fields), exc_info=exc_info,
+            extra={'event': event, 'fields': fields})
@@ -4,28 +4,40 @@ from typing import (
     List,
     Dict,
     Optional,
+    Set,
     TextIO,
     Iterator,
+    TYPE_CHECKING,
     get_type_hints,
 )
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from abc import abstractmethod
+from functools import lru_cache
 import socket
 import ipaddress
-from typeguard import check_type
-import yaml
-from pyroute2 import IPDB
 from .types import TIfaceAddress, TNetwork
-from .wg import WGProc
+from .wg import WGBackend, WGProcBackend
+from .netmon import IPRoutePool
 from .classlogger import ClassLogger
 
+if TYPE_CHECKING:
+    from pyroute2 import IPRoute
+
 HOSTNAME = socket.gethostname()
-with open('/etc/machine-id', 'rb') as f:
-    MACHINE_ID = f.read().decode('utf-8').strip()
+MACHINE_ID_PATH = '/etc/machine-id'
+# ifinfomsg flag of a link that is administratively up
+IFF_UP = 0x1
 
 TFromDict = Dict[str, Any]
 
 
+@lru_cache(maxsize=None)
+def machine_id() -> str:
+    '''Read on first use rather than on import.'''
+    with open(MACHINE_ID_PATH, 'rb') as f:
+        return f.read().decode('utf-8').strip()
+
+
 class ConfigBase:
     @classmethod
     @abstractmethod
@@ -42,6 +54,7 @@ class ServiceConfig(ConfigBase):
 
     @classmethod
     def from_dict(Cls, from_dict: TFromDict) -> ServiceConfig:
+        from typeguard import check_type
         hints = get_type_hints(ServiceConfig)
         for key, hint in hints.items():
             value = from_dict.get(key)
@@ -58,9 +71,12 @@ class IfaceConfig(ConfigBase, ClassLogger):
     psk: str
     port: Optional[int] = None
     services: Optional[List[ServiceConfig]] = None
+    peer_ttl: Optional[int] = None
+    max_peers: Optional[int] = None
 
     @classmethod
     def from_dict(Cls, from_dict: TFromDict) -> IfaceConfig:
+        from typeguard import check_type
         hints = get_type_hints(IfaceConfig)
         check_type('IfaceConfig.addr', from_dict['addr'], str)
         from_dict['addr'] = ipaddress.ip_interface(from_dict['addr'])
@@ -78,26 +94,82 @@ class IfaceConfig(ConfigBase, ClassLogger):
     def prefix(self) -> TNetwork:
         return self.addr.network
 
-    def configure(self) -> None:
-        # Recreate iface
-        with IPDB() as ipdb:
-            if self.name in ipdb.interfaces:
-                ipdb.interfaces[self.name].remove().commit()
-            with ipdb.create(kind='wireguard', ifname=self.name) as i:
-                i.add_ip(f'{self.addr}')
-                i.up()
-
-        (WGProc('set', self.name)
-            .args(
-                [] if self.port is None else ['listen-port', str(self.port)],
-                'private-key', '/dev/stdin'
-            )
-            .input(self.privkey)
-            .run())
+    def changed(self, other: IfaceConfig) -> Set[str]:
+        '''Names of the settings that differ in `other`. A port left to
+        WireGuard in `other` keeps the one in use.'''
+        return {
+            field.name
+            for field in fields(self)
+            if getattr(self, field.name) != getattr(other, field.name)
+            and not (field.name == 'port' and other.port is None)
+        }
+
+    def configure(self, backend: Optional[WGBackend] = None) -> bool:
+        '''Bring the link and WireGuard device in line with this config,
+        changing only what differs from the kernel so a restart keeps live
+        tunnels. Returns whether anything changed.'''
+        if backend is None:
+            backend = WGProcBackend()
+        with IPRoutePool.get() as ip:
+            changed = self.configure_link(ip)
+
+        device = backend.dump(self.name)
+        if device.pubkey != self.pubkey or (
+                self.port is not None and device.listen_port != self.port):
+            backend.set_device(self.name, self.privkey, self.port)
+            changed = True
+            if self.port is None:
+                device = backend.dump(self.name)
         if self.port is None:
-            port = int(WGProc('show', self.name, 'dump').run().split('\t')[2])
+            port = device.listen_port
+            assert port is not None, 'WireGuard did not report a listen port'
             self.logger.info('Dynamic port %d', port)
             self.port = port
+        return changed
+
+    def deconfigure(self) -> None:
+        '''Delete the link, and every peer with it.'''
+        with IPRoutePool.get() as ip:
+            for index in ip.link_lookup(ifname=self.name):
+                ip.link('del', index=index)
+
+    def configure_link(self, ip: IPRoute) -> bool:
+        changed = False
+        index = None
+        for found in ip.link_lookup(ifname=self.name):
+            link = ip.get_links(found)[0]
+            linkinfo = link.get_attr('IFLA_LINKINFO')
+            kind = linkinfo and linkinfo.get_attr('IFLA_INFO_KIND')
+            if kind == 'wireguard':
+                index = found
+                up = bool(link['flags'] & IFF_UP)
+            else:
+                self.logger.info('Replacing %s link %s', kind, self.name)
+                ip.link('del', index=found)
+        if index is None:
+            ip.link('add', ifname=self.name, kind='wireguard')
+            index = ip.link_lookup(ifname=self.name)[0]
+            changed, up = True, False
+
+        addrs = {
+            ipaddress.ip_interface(
+                f"{addr.get_attr('IFA_ADDRESS')}/{addr['prefixlen']}")
+            for addr in ip.get_addr(index=index)
+        }
+        for stale in addrs - {self.addr}:
+            if stale.is_link_local:
+                continue
+            ip.addr('del', index=index, address=stale.ip.compressed,
+                    prefixlen=stale.network.prefixlen)
+            changed = True
+        if self.addr not in addrs:
+            ip.addr('add', index=index, address=self.addr.ip.compressed,
+                    prefixlen=self.addr.network.prefixlen)
+            changed = True
+        if not up:
+            ip.link('set', index=index, state='up')
+            changed = True
+        return changed
 
 
 @dataclass
@@ -106,6 +178,7 @@ class Config(ConfigBase):
 
     @classmethod
     def load(Cls, file: TextIO) -> Config:
+        import yaml
         config = yaml.safe_load(file.read())
         return Cls.from_dict(config)
 
@@ -0,0 +1,290 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    TYPE_CHECKING,
+)
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+
+from .classlogger import ClassLogger
+from .wg import format_endpoint
+
+if TYPE_CHECKING:
+    from .args import StatusArgs
+    from .dnsclient import DNSClientPool, HostHealth
+    from .peers import PeerEntry
+    from .records import TSnapshot
+    from .wg import WGPeer
+    from .wgzero import WGInterface
+
+CONTROL_SOCKET = '/run/zerowire/control.sock'
+WATCH_INTERVAL = 2.0
+# Floor for the interval a watching client asks for
+WATCH_MIN_INTERVAL = 0.1
+REQUEST_TIMEOUT = 5
+
+TStatus = Dict[str, Any]
+
+
+def peer_status(entry: PeerEntry, peer: Optional[WGPeer]) -> TStatus:
+    '''A peer table entry, and whether the kernel has the peer.'''
+    return {
+        'pubkey': entry.pubkey,
+        'hostname': entry.hostname,
+        'addr': entry.internal_addr.compressed,
+        'endpoint': format_endpoint(entry.endpoint),
+        'candidates': [addr.compressed for addr in entry.candidates],
+        'last_seen': round(entry.last_seen),
+        'latest_handshake': round(entry.latest_handshake),
+        'withdrawn': entry.withdrawn,
+        'confirmed': entry.confirm_by is None,
+        'kernel': peer is not None,
+    }
+
+
+def interface_status(iface: WGInterface) -> TStatus:
+    '''An interface and its peers, as of the last reconcile dump.'''
+    device = iface.reconciler.last_dump
+    kernel = {} if device is None else device.peers
+    return {
+        'name': iface.ifname,
+        'ifindex': iface.ifindex,
+        'addr': iface.config.addr.with_prefixlen,
+        'pubkey': iface.config.pubkey,
+        'listen_port': None if device is None else device.listen_port,
+        'peers': [
+            peer_status(entry, kernel.get(entry.pubkey))
+            for entry in iface.peers.entries.values()
+        ],
+    }
+
+
+def breaker_state(health: HostHealth, now: float) -> str:
+    if health.open_until is None:
+        return 'closed'
+    if health.trial:
+        return 'trial'
+    return 'open' if now < health.open_until else 'half-open'
+
+
+def dns_client_status(pool: DNSClientPool) -> TStatus:
+    '''Forwarding counters, and the health of every host queried
+    lately.'''
+    now = pool.loop.time()
+    return {
+        **pool.stats(),
+        'hosts': [
+            {
+                'host': host.compressed,
+                'srtt': None if health.srtt is None else round(health.srtt, 4),
+                'rto': round(health.rto, 4),
+                'failures': health.failures,
+                'breaker': breaker_state(health, now),
+            }
+            for host, health in pool.health.items()
+        ],
+    }
+
+
+def zone_status(snapshot: TSnapshot) -> Dict[str, Dict[str, List[str]]]:
+    from dnslib import QTYPE
+    return {
+        name: {
+            QTYPE[qtype]: [str(record) for record in records]
+            for qtype, records in types.items()
+        }
+        for name, types in sorted(snapshot.items())
+    }
+
+
+def encode(status: TStatus) -> bytes:
+    return json.dumps(status, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class ControlServer(ClassLogger):
+    '''Serves the daemon status as JSON lines on a UNIX socket.
+
+    A client sends one request line, `{"command": "status"}` is answered
+    with one status line and `{"command": "watch", "interval": 2}` with a
+    line whenever the status changed, checked every interval, until the
+    client hangs up.'''
+    writers: Set[asyncio.StreamWriter]
+
+    def __init__(
+        self,
+        path: str,
+        status: Callable[[], TStatus],
+        interval: float = WATCH_INTERVAL,
+    ):
+        self._setLoggerName(path)
+        self.path = path
+        self.status = status
+        self.interval = interval
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.writers = set()
+
+    async def start(self) -> None:
+        os.makedirs(os.path.dirname(self.path) or '.', mode=0o700,
+                    exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self.serve, self.path)
+        # Peer keys and addresses are for root only
+        os.chmod(self.path, 0o600)
+        self.logger.info('Serving control socket')
+
+    async def serve(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        self.writers.add(writer)
+        try:
+            request = json.loads(await asyncio.wait_for(
+                reader.readline(), REQUEST_TIMEOUT))
+            if not isinstance(request, dict):
+                raise ValueError('Request is not an object')
+            command = request.get('command')
+            if command == 'status':
+                writer.write(encode(self.status()))
+                await writer.drain()
+            elif command == 'watch':
+                interval = float(request.get('interval', self.interval))
+                await self.watch(
+                    reader, writer, max(WATCH_MIN_INTERVAL, interval))
+            else:
+                writer.write(encode({'error': f'Unknown command {command!r}'}))
+                await writer.drain()
+        except (asyncio.TimeoutError, ValueError, TypeError,
+                ConnectionError) as e:
+            self.logger.debug('Bad request %r', e)
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def watch(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        interval: float,
+    ) -> None:
+        last = b''
+        while True:
+            data = encode(self.status())
+            if data != last:
+                writer.write(data)
+                await writer.drain()
+                last = data
+            try:
+                # Anything but a timeout means the client is done
+                await asyncio.wait_for(reader.read(1), interval)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.close()
+        for writer in self.writers:
+            writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def request(path: str, command: str, **params: Any) -> Iterator[TStatus]:
+    '''The replies of the daemon to one request, blocking.'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(encode({'command': command, **params}))
+        with sock.makefile('rb') as file:
+            for line in file:
+                reply = json.loads(line)
+                if 'error' in reply:
+                    raise ValueError(reply['error'])
+                yield reply
+
+
+def format_age(seconds: float) -> str:
+    if seconds < 120:
+        return f'{seconds:.0f}s'
+    if seconds < 7200:
+        return f'{seconds / 60:.0f}m'
+    return f'{seconds / 3600:.0f}h'
+
+
+def format_status(status: TStatus, now: float) -> str:
+    lines = [
+        f'ZeroWire {status["version"]}, '
+        f'up {format_age(now - status["started"])}',
+    ]
+    for iface in status['interfaces']:
+        lines.append(
+            f'{iface["name"]} {iface["addr"]} port {iface["listen_port"]}, '
+            f'{len(iface["peers"])} peers')
+        for peer in iface['peers']:
+            if peer['latest_handshake']:
+                active = (
+                    f'handshake {format_age(now - peer["latest_handshake"])}'
+                    ' ago')
+            else:
+                active = 'no handshake'
+            flags = [
+                flag
+                for flag, on in (
+                    ('withdrawn', peer['withdrawn']),
+                    ('unconfirmed', not peer['confirmed']),
+                    ('not in kernel', not peer['kernel']),
+                )
+                if on
+            ]
+            lines.append(
+                f'  {peer["hostname"]} {peer["addr"]} {peer["endpoint"]} '
+                f'{active}, seen {format_age(now - peer["last_seen"])} ago'
+                + ''.join(f', {flag}' for flag in flags))
+    client = status['dns_client']
+    lines.append(
+        f'dns {client["sent"]} sent, {client["timeouts"]} timeouts, '
+        f'{client["hedges"]} hedges, '
+        f'{client["short_circuits"]} short circuits')
+    for host in client['hosts']:
+        srtt = 'no rtt' if host['srtt'] is None else (
+            f'rtt {host["srtt"] * 1000:.0f}ms')
+        lines.append(
+            f'  {host["host"]} {srtt}, rto {host["rto"] * 1000:.0f}ms, '
+            f'breaker {host["breaker"]}')
+    zone = status['zone']
+    records = sum(
+        len(rrs) for types in zone.values() for rrs in types.values())
+    lines.append(f'zone {len(zone)} names, {records} records')
+    return '\n'.join(lines)
+
+
+def status_main(args: StatusArgs) -> int:
+    '''`zerowire status`, the exit status.'''
+    command = 'watch' if args.watch else 'status'
+    params = {'interval': args.interval} if args.watch else {}
+    try:
+        for status in request(args.control, command, **params):
+            if args.json:
+                print(json.dumps(status), flush=True)
+                continue
+            if args.watch:
+                # Redraw in place
+                print('\033[H\033[J', end='')
+            print(format_status(status, time.time()), flush=True)
+    except (OSError, ValueError) as e:
+        print(f'zerowire status: {args.control}: {e}', file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
@@ -0,0 +1,84 @@
+from __future__ import annotations
+from typing import (
+    Callable,
+    List,
+    Optional,
+    Set,
+)
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from zeroconf import Zeroconf, ServiceInfo
+
+from .classlogger import ClassLogger
+
+THandler = Callable[[str, Optional[ServiceInfo]], None]
+
+
+class DiscoveryPipeline(ClassLogger):
+    '''Turns Zeroconf browse callbacks into resolved ServiceInfo.
+
+    Names are queued with de-duplication from the Zeroconf threads, resolved
+    by up to `concurrency` blocking get_service_info calls at once, and
+    handed to `handler` on the event loop.'''
+    queue: asyncio.Queue[str]
+    pending: Set[str]
+    workers: List[asyncio.Task[None]]
+
+    def __init__(
+        self,
+        zeroconf: Zeroconf,
+        type: str,
+        handler: THandler,
+        concurrency: int = 8,
+        timeout: int = 3000,
+    ):
+        self.zeroconf = zeroconf
+        self.type = type
+        self.handler = handler
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        self.pending = set()
+        self.workers = []
+        self.executor = ThreadPoolExecutor(
+            concurrency, thread_name_prefix='zerowire-resolve')
+
+    def push(self, name: str) -> None:
+        '''Queue a name for resolution, safe from any thread.'''
+        self.loop.call_soon_threadsafe(self.__push, name)
+
+    def __push(self, name: str) -> None:
+        if name in self.pending:
+            return
+        self.pending.add(name)
+        self.queue.put_nowait(name)
+
+    def resolve(self, name: str) -> Optional[ServiceInfo]:
+        return self.zeroconf.get_service_info(self.type, name, self.timeout)
+
+    async def worker(self) -> None:
+        while True:
+            name = await self.queue.get()
+            # Announcements arriving from here on need a fresh resolve
+            self.pending.discard(name)
+            try:
+                info = await self.loop.run_in_executor(
+                    self.executor, self.resolve, name)
+                self.handler(name, info)
+            except Exception as e:
+                self.logger.exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def start(self) -> None:
+        self.workers = [
+            self.loop.create_task(self.worker())
+            for _ in range(self.concurrency)
+        ]
+
+    def close(self) -> None:
+        for worker in self.workers:
+            worker.cancel()
+        self.executor.shutdown(wait=False)
@@ -1,82 +1,106 @@
 from __future__ import annotations
 
 from .config import ServiceConfig
-from .types import TAddress, TIfaceAddress
+from .types import TAddress, TEndpoint, TIfaceAddress
 
 from typing import (
+    Any,
+    Awaitable,
+    Callable,
     Tuple,
     List,
     Dict,
     Optional,
+    Sequence,
+    Set,
     Union,
     cast,
-    TYPE_CHECKING
 )
-from copy import deepcopy
+import time
+import struct
 import asyncio
 import logging
 import ipaddress
 from abc import abstractmethod
-from collections import defaultdict
 
-import dbus
 import dnslib
-from dnslib import DNSRecord, DNSLabel, QTYPE, RCODE, RD
+from dnslib import DNSRecord, DNSHeader, DNSLabel, QTYPE, RCODE, RD
 
 from .classlogger import ClassLogger
+from .dnscache import AnswerCache
+from .dnsclient import DNSClientPool
+from .metrics import DNS_QUERIES
+from .records import RecordStore, TSnapshot, TStrOrLabel
 
-if TYPE_CHECKING:
-    from .wgzero import WGInterface
-
-logger = logging.getLogger(__name__)
 
 TSource = Tuple[TAddress, int]
-TStrOrLabel = Union[str, DNSLabel]
-
-
-class DNSClientProtocol(asyncio.DatagramProtocol, ClassLogger):
-    result: Optional[DNSRecord]
-
-    def __init__(self, query: DNSRecord, future: asyncio.Future[DNSRecord]):
-        self.query = query
-        self.future = future
-        self.result = None
-        super().__init__()
-
-    def connection_made(self, transport: asyncio.BaseTransport) -> None:
-        cast(asyncio.DatagramTransport, transport).sendto(self.query.pack())
-        self.transport = transport
-
-    def datagram_received(
-        self,
-        data: Union[bytes, str],
-        src: Tuple[str, int],
-    ) -> None:
-        try:
-            self.result = DNSRecord.parse(data)
-        except Exception as e:
-            self.future.set_exception(e)
-        finally:
-            self.transport.close()
-
-    def connection_lost(self, exc: Optional[Exception]) -> None:
-        if exc is not None:
-            self.future.set_exception(exc)
-        elif self.result is not None:
-            self.future.set_result(self.result)
-
-
-async def dns_query(host: TAddress, port: int, query: DNSRecord) -> DNSRecord:
-    logger.debug('dns_query %r:%i %r', host, port, query)
-    loop = asyncio.get_running_loop()
-    result_future = loop.create_future()
-    transport, protocol = await loop.create_datagram_endpoint(
-        lambda: DNSClientProtocol(query, result_future),
-        remote_addr=(host.compressed, port))
-    try:
-        return await result_future
-    finally:
-        transport.close()
+# Called with 'add' or 'del' and the arguments of every zone change
+TChangeCallback = Callable[
+    [str, TStrOrLabel, Optional[int], Optional[RD]], None]
+
+# TTL of the answers we give, lets resolvers and peers cache them briefly
+RECORD_TTL = 30
+# Plain DNS over UDP, and the EDNS0 payload size we offer and accept at most,
+# the one from DNS flag day 2020 that avoids IP fragmentation.
+UDP_SIZE = 512
+EDNS_UDP_SIZE = 1232
+TCP_LENGTH = struct.Struct('!H')
+TCP_IDLE_TIMEOUT = 10
+TCP_MAX_PIPELINE = 32
+DNS_HEADER = struct.Struct('!HBBHHHH')
+# Root name, type, UDP payload size, extended rcode, version, flags, length
+OPT_HEADER = struct.Struct('!BHHBBHH')
+# Flag bits of the third header byte
+FLAG_QR = 0x80
+FLAG_OPCODE = 0x78
+FLAG_RD = 0x01
+# Low nibble of the fourth header byte
+RCODE_MASK = 0x0f
+# Records a second of each per query log event, so a query flood does not
+# become a journal flood
+QUERY_LOG_RATE = 20
+ERROR_LOG_RATE = 1
+
+
+def rcode_name(rcode: int) -> str:
+    return str(RCODE.get(rcode, rcode))
+
+
+def question_key(data: bytes) -> Optional[bytes]:
+    '''The question section of a plain single question query with the name
+    lower cased, then for an EDNS0 query the UDP payload size it takes,
+    None for anything else.'''
+    if len(data) <= DNS_HEADER.size:
+        return None
+    _id, flags, _, qdcount, ancount, nscount, arcount = \
+        DNS_HEADER.unpack_from(data)
+    if flags & (FLAG_QR | FLAG_OPCODE) or (
+            qdcount, ancount, nscount) != (1, 0, 0) or arcount > 1:
+        return None
+    offset = DNS_HEADER.size
+    while offset < len(data):
+        length = data[offset]
+        if length & 0xc0:
+            return None
+        offset += 1 + length
+        if not length:
+            break
+    offset += 4
+    key = bytes(
+        data[DNS_HEADER.size:offset - 4].lower() + data[offset - 4:offset])
+    if not arcount:
+        return key if offset == len(data) else None
+    # Only an OPT record may follow, on the root, version 0, and its options
+    # change nothing in our answers
+    if offset + OPT_HEADER.size > len(data):
+        return None
+    name, type, udp_len, _rcode, version, _flags, rdlength = \
+        OPT_HEADER.unpack_from(data, offset)
+    if (name, type, version) != (0, QTYPE.OPT, 0) or (
+            offset + OPT_HEADER.size + rdlength != len(data)):
+        return None
+    return key + struct.pack(
+        '!H', max(UDP_SIZE, min(udp_len, EDNS_UDP_SIZE)))
 
 
 class DNSServerProtocol(asyncio.DatagramProtocol, ClassLogger):
@@ -95,6 +119,14 @@ class DNSServerProtocol(asyncio.DatagramProtocol, ClassLogger):
         data: Union[bytes, str],
         src: Tuple[str, int],
     ) -> None:
+        if isinstance(data, bytes):
+            start = time.perf_counter()
+            source: TSource = (ipaddress.ip_address(src[0]), src[1])
+            packed = self.server.cached_reply(data, source)
+            if packed is not None:
+                self.transport.sendto(packed, src)
+                self.server.observe(start, packed[3] & RCODE_MASK)
+                return
         asyncio.run_coroutine_threadsafe(
             self.handle_query(data, src), self.server.loop)
 
@@ -103,36 +135,175 @@ class DNSServerProtocol(asyncio.DatagramProtocol, ClassLogger):
         data: Union[bytes, str],
         src: Tuple[str, int],
     ) -> None:
-        source = cast(TSource, (ipaddress.ip_address(src[0]), int))
-        query = DNSRecord.parse(data)
+        if not isinstance(data, bytes):
+            return
+        source: TSource = (ipaddress.ip_address(src[0]), src[1])
+        packed = await self.server.answer(data, source)
+        if packed is not None:
+            self.transport.sendto(packed, src)
+
+
+class DNSStreamProtocol(asyncio.Protocol, ClassLogger):
+    '''DNS over TCP, length prefixed queries answered as they complete,
+    the connection kept open for more until it idles.'''
+    transport: asyncio.Transport
+    source: TSource
+    tasks: Set[asyncio.Task[None]]
+
+    def __init__(self, server: BaseDNSServer) -> None:
+        self.server = server
+        self._setLoggerName('tcp', parent=server)
+        self.buffer = bytearray()
+        self.tasks = set()
+        self.__idle: Optional[asyncio.TimerHandle] = None
+        super().__init__()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = cast(asyncio.Transport, transport)
+        peer = self.transport.get_extra_info('peername')
+        self.source = (ipaddress.ip_address(peer[0]), peer[1])
+        self.__reset_idle()
+
+    def __reset_idle(self) -> None:
+        if self.__idle is not None:
+            self.__idle.cancel()
+        self.__idle = self.server.loop.call_later(
+            TCP_IDLE_TIMEOUT, self.transport.close)
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer += data
+        while len(self.buffer) >= TCP_LENGTH.size:
+            length, = TCP_LENGTH.unpack_from(self.buffer)
+            end = TCP_LENGTH.size + length
+            if len(self.buffer) < end:
+                break
+            query = bytes(self.buffer[TCP_LENGTH.size:end])
+            del self.buffer[:end]
+            task = self.server.loop.create_task(self.handle_query(query))
+            self.tasks.add(task)
+            task.add_done_callback(self.__done)
+        if len(self.tasks) >= TCP_MAX_PIPELINE:
+            self.transport.pause_reading()
+        self.__reset_idle()
+
+    def __done(self, task: asyncio.Task[None]) -> None:
+        self.tasks.discard(task)
+        if len(self.tasks) < TCP_MAX_PIPELINE and \
+                not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    async def handle_query(self, data: bytes) -> None:
         try:
-            reply = await self.server.handle_query(query, source)
+            packed = await self.server.answer(data, self.source, tcp=True)
         except Exception as e:
-            self.logger.exception(e)
-            reply = query.reply()
-            reply.header.set_rcode(RCODE.SERVFAIL)
-        self.logger.debug('Reply %r to %r', reply, src)
-        if reply is not None:
-            self.transport.sendto(reply.pack(), src)
-        self.logger.debug('Done')
+            self.log_event(
+                logging.ERROR, 'query_failed', rate=ERROR_LOG_RATE,
+                exc_info=e, source=self.source[0], error=e)
+            self.transport.close()
+            return
+        if packed is not None and not self.transport.is_closing():
+            self.transport.write(TCP_LENGTH.pack(len(packed)) + packed)
+            self.__reset_idle()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        if self.__idle is not None:
+            self.__idle.cancel()
+        for task in self.tasks:
+            task.cancel()
 
 
 class BaseDNSServer(ClassLogger):
-    __records: Dict[DNSLabel, Dict[QTYPE, List[RD]]]
+    # Constructor arguments, to build a replica of this server elsewhere
+    init_args: Tuple[Any, ...]
 
     def __init__(self, bind: TAddress, port: int):
-        self._setLoggerName(f'{bind}:{port}')
+        self.name = f'{bind}:{port}'
+        self._setLoggerName(self.name)
         self.bind = bind
         self.port = port
         self.loop = asyncio.get_event_loop()
-        self.__records = defaultdict(lambda: defaultdict(list))
+        self.records = RecordStore()
+        self.reuse_port = False
+        self.on_change: Optional[TChangeCallback] = None
+        self.transport: Optional[asyncio.BaseTransport] = None
+        self.tcp_server: Optional[asyncio.AbstractServer] = None
 
     async def start(
         self,
     ) -> Tuple[asyncio.BaseTransport, asyncio.BaseProtocol]:
-        return await self.loop.create_datagram_endpoint(
+        self.transport, protocol = await self.loop.create_datagram_endpoint(
             lambda: DNSServerProtocol(self),
-            local_addr=(self.bind.compressed, self.port))
+            local_addr=(self.bind.compressed, self.port),
+            reuse_port=self.reuse_port)
+        self.tcp_server = await self.loop.create_server(
+            lambda: DNSStreamProtocol(self),
+            self.bind.compressed, self.port,
+            reuse_port=self.reuse_port)
+        return self.transport, protocol
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+        if self.tcp_server is not None:
+            self.tcp_server.close()
+
+    @staticmethod
+    def udp_size(query: DNSRecord) -> Optional[int]:
+        '''The UDP payload size the client takes, None without EDNS0.'''
+        for rr in query.ar:
+            if rr.rtype == QTYPE.OPT:
+                return int(max(UDP_SIZE, min(rr.rclass, EDNS_UDP_SIZE)))
+        return None
+
+    @staticmethod
+    def truncate(reply: DNSRecord) -> DNSRecord:
+        '''The reply with the TC flag and nothing but the question and OPT
+        record, telling the client to ask again over TCP.'''
+        truncated = DNSRecord(
+            DNSHeader(id=reply.header.id, bitmap=reply.header.bitmap),
+            questions=reply.questions,
+            ar=[rr for rr in reply.ar if rr.rtype == QTYPE.OPT])
+        truncated.header.tc = 1
+        return truncated
+
+    async def answer(
+        self,
+        data: bytes,
+        source: TSource,
+        tcp: bool = False,
+    ) -> Optional[bytes]:
+        '''Packed reply to a packed query, truncated to what the client
+        takes over UDP.'''
+        start = time.perf_counter()
+        query = DNSRecord.parse(data)
+        try:
+            reply = await self.handle_query(query, source)
+        except Exception as e:
+            self.log_event(
+                logging.ERROR, 'query_failed', rate=ERROR_LOG_RATE,
+                exc_info=e, source=source[0], error=e)
+            reply = query.reply()
+            reply.header.set_rcode(RCODE.SERVFAIL)
+        if reply is None:
+            return None
+        self.log_event(
+            logging.DEBUG, 'reply', rate=QUERY_LOG_RATE, source=source[0],
+            rcode=rcode_name(reply.header.rcode), answers=len(reply.rr))
+        udp_size = self.udp_size(query)
+        if udp_size is not None:
+            reply.add_ar(dnslib.EDNS0(udp_len=EDNS_UDP_SIZE))
+        packed = bytes(reply.pack())
+        if not tcp:
+            if len(packed) > (udp_size or UDP_SIZE):
+                packed = bytes(self.truncate(reply).pack())
+            self.store_reply(data, reply, packed)
+        self.observe(start, reply.header.rcode)
+        return packed
+
+    def observe(self, start: float, rcode: int) -> None:
+        '''Count a query answered with `rcode`, received at `start`.'''
+        DNS_QUERIES.observe(
+            time.perf_counter() - start, self.name, rcode_name(rcode))
 
     @staticmethod
     def addr_to_qdata(addr: TAddress) -> dnslib.RD:
@@ -144,10 +315,8 @@ class BaseDNSServer(ClassLogger):
         return QTYPE.A if addr.version == 4 else QTYPE.AAAA
 
     def add_record(self, name: TStrOrLabel, type: QTYPE, record: RD) -> RD:
-        name = name if isinstance(name, DNSLabel) else DNSLabel(name)
-        records = self.__records[name][type]
-        if record not in records:
-            records.append(record)
+        if self.records.add(name, type, record) and self.on_change:
+            self.on_change('add', name, type, record)
         return record
 
     def add_addr_record(self, name: TStrOrLabel, addr: TAddress) -> RD:
@@ -160,44 +329,45 @@ class BaseDNSServer(ClassLogger):
         type: Optional[QTYPE] = None,
         record: Optional[RD] = None,
     ) -> None:
-        name = name if isinstance(name, DNSLabel) else DNSLabel(name)
-        records = self.__records[name]
-        if record is None:
-            if type is None:
-                del self.__records[name]
-            else:
-                del records[type]
-        else:
-            if type is None:
-                for type_records in records.values():
-                    type_records.remove(record)
-            else:
-                records[type].remove(record)
+        if self.records.remove(name, type, record) and self.on_change:
+            self.on_change('del', name, type, record)
 
-    def get_records(self, name: TStrOrLabel, type: QTYPE) -> List[RD]:
-        name = name if isinstance(name, DNSLabel) else DNSLabel(name)
-        records = self.__records.get(name, {})
-        return records.get(type, [])
+    def del_addr_record(self, name: TStrOrLabel, addr: TAddress) -> None:
+        self.del_record(
+            name, self.addr_to_qtype(addr), self.addr_to_qdata(addr))
+
+    def get_records(self, name: TStrOrLabel, type: QTYPE) -> Sequence[RD]:
+        return self.records.get(name, type)
 
-    def get_addr_records(self, name: TStrOrLabel) -> List[RD]:
-        name = name if isinstance(name, DNSLabel) else DNSLabel(name)
-        return [
-            *self.get_records(name, QTYPE.AAAA),
-            *self.get_records(name, QTYPE.A)
-        ]
+    def get_addr_records(self, name: TStrOrLabel) -> Sequence[RD]:
+        return (
+            *self.records.get(name, QTYPE.AAAA),
+            *self.records.get(name, QTYPE.A),
+        )
 
     def has_name(self, name: TStrOrLabel) -> bool:
-        name = name if isinstance(name, DNSLabel) else DNSLabel(name)
-        return name in self.__records
+        return name in self.records
 
-    def get_all_records(self) -> Dict[DNSLabel, Dict[QTYPE, List[RD]]]:
-        return deepcopy(self.__records)
+    def get_all_records(self) -> TSnapshot:
+        return self.records.snapshot()
 
     @staticmethod
     def validate_query_label(query: DNSLabel) -> None:
-        if query.label[-1] != b'zerowire':
+        if query.label[-1].lower() != b'zerowire':
             raise Exception('Invalid suffix')
 
+    def cached_reply(self, data: bytes, source: TSource) -> Optional[bytes]:
+        '''A packed reply to a raw query that skips handle_query, or None.'''
+        return None
+
+    def store_reply(
+        self,
+        data: bytes,
+        reply: DNSRecord,
+        packed: bytes,
+    ) -> None:
+        '''Called with every packed UDP reply given by handle_query.'''
+
     @abstractmethod
     async def handle_query(
         self,
@@ -208,92 +378,165 @@ class BaseDNSServer(ClassLogger):
 
 
 class LocalDNSServer(BaseDNSServer):
-    def __init__(self, bind: TAddress, port: int):
+    '''Answers zerowire. from the peers, and with `upstreams` (the stub
+    resolver mode) forwards every other name to those servers.'''
+    def __init__(
+        self,
+        bind: TAddress,
+        port: int,
+        remote_port: int = 53,
+        upstreams: Sequence[TEndpoint] = (),
+    ):
         super().__init__(bind, port)
+        self.init_args = (bind, port, remote_port, tuple(upstreams))
+        self.remote_port = remote_port
+        self.upstreams = tuple(upstreams)
+        self.cache = AnswerCache()
+        self.client = DNSClientPool()
+
+    def del_record(
+        self,
+        name: TStrOrLabel,
+        type: Optional[QTYPE] = None,
+        record: Optional[RD] = None,
+    ) -> None:
+        super().del_record(name, type, record)
+        # Answers from a host that went away or changed address are stale
+        self.cache.invalidate(
+            name if isinstance(name, DNSLabel) else DNSLabel(name))
+
+    def add_answer(
+        self,
+        reply: DNSRecord,
+        rcode: int,
+        rrs: List[dnslib.RR],
+    ) -> bool:
+        '''Add a remote answer to the reply, True if it was NXDOMAIN.'''
+        reply.add_answer(*rrs)
+        return bool(rcode == RCODE.NXDOMAIN)
+
+    def is_local(self, request: DNSRecord) -> bool:
+        return bool(request.questions) and all(
+            [label.lower() for label in question.qname.label[-1:]]
+            == [b'zerowire']
+            for question in request.questions
+        )
+
+    async def forward(self, request: DNSRecord) -> DNSRecord:
+        '''The reply of the first upstream that gives one.'''
+        error: Optional[Exception] = None
+        for host, port in self.upstreams:
+            try:
+                reply = await self.client.query(host, port, request)
+            except (asyncio.TimeoutError, OSError) as e:
+                self.log_event(
+                    logging.DEBUG, 'upstream_failed', rate=ERROR_LOG_RATE,
+                    upstream=host, error=e)
+                error = e
+                continue
+            # answer() adds our own OPT record
+            reply.ar = [rr for rr in reply.ar if rr.rtype != QTYPE.OPT]
+            return reply
+        assert error is not None
+        raise error
 
     async def handle_query(
         self,
         request: DNSRecord,
         source: TSource,
     ) -> DNSRecord:
+        if self.upstreams and not self.is_local(request):
+            try:
+                return await self.forward(request)
+            except (asyncio.TimeoutError, OSError):
+                # Each upstream logged its failure already
+                reply = request.reply()
+                reply.header.set_rcode(RCODE.SERVFAIL)
+                return reply
         reply = request.reply()
-        queries: List[asyncio.Future[DNSRecord]] = []
+        queries: List[Tuple[DNSLabel, int, Awaitable[DNSRecord]]] = []
 
         nxdomain = False
+        servfail = False
 
         for question in request.questions:
             qname = question.qname
             qtype = question.qtype
             self.validate_query_label(qname)
-            self.logger.debug('Question %r %r', qname, QTYPE[qtype])
+            self.log_event(
+                logging.DEBUG, 'question', rate=QUERY_LOG_RATE, qname=qname,
+                qtype=QTYPE.get(qtype, qtype))
             if len(qname.label) > 2:
-                remote_qname = str(DNSLabel(qname.label[-2:]))
+                remote_qname = DNSLabel(qname.label[-2:])
                 remote_records = self.get_addr_records(remote_qname)
-                self.logger.debug('Remote question %r', question.qname)
                 if remote_records:
+                    cached = self.cache.get(qname, qtype)
+                    if cached is not None:
+                        nxdomain |= self.add_answer(reply, *cached)
+                        continue
                     q = DNSRecord()
                     q.add_question(question)
-                    queries.append(asyncio.wait_for(
-                        dns_query(
-                            ipaddress.ip_address(repr(remote_records[0])),
-                            53,
-                            q,
-                        ),
-                        0.5
-                    ))
+                    q.add_ar(dnslib.EDNS0(udp_len=EDNS_UDP_SIZE))
+                    queries.append((qname, qtype, self.client.query_hedged(
+                        [
+                            ipaddress.ip_address(repr(record))
+                            for record in remote_records
+                        ],
+                        self.remote_port,
+                        q,
+                    )))
                 else:
                     nxdomain = True
                 continue
             if not self.has_name(qname):
                 nxdomain = True
             records = self.get_records(qname, qtype)
-            self.logger.debug('Record %r', records)
             for record in records:
                 reply.add_answer(dnslib.RR(
                     rname=qname,
                     rtype=qtype,
                     rdata=record,
+                    ttl=RECORD_TTL,
                 ))
         if queries:
-            self.logger.debug('Awaiting gather')
             try:
                 answers = await asyncio.gather(
-                    *queries, return_exceptions=True)
+                    *(query for _, _, query in queries),
+                    return_exceptions=True)
             except Exception as e:
                 self.logger.error(e)
             else:
-                self.logger.debug('gather complete %r', answers)
-                for answer in answers:
-                    self.logger.debug('answer %r', answer)
-                    if isinstance(answer, Exception):
-                        self.logger.exception(answer)
+                for (qname, qtype, _), answer in zip(queries, answers):
+                    if isinstance(answer, BaseException):
+                        servfail = True
+                        self.log_event(
+                            logging.WARNING, 'remote_failed',
+                            rate=ERROR_LOG_RATE, qname=qname, error=answer)
                     else:
-                        reply.add_answer(*answer.rr)
+                        self.cache.put(qname, qtype, answer)
+                        nxdomain |= self.add_answer(
+                            reply, answer.header.rcode, answer.rr)
 
-        if nxdomain:
-            self.logger.debug('No answers')
+        if servfail:
+            reply.header.set_rcode(RCODE.SERVFAIL)
+        elif nxdomain:
             reply.header.set_rcode(RCODE.NXDOMAIN)
 
         return reply
 
-    def add_to_resolved(self, iface: WGInterface) -> None:
-        self.logger.debug('ifindex %r', iface.ifindex)
-        bus = dbus.SystemBus()
-        dbus_proxy = bus.get_object(
-            'org.freedesktop.resolve1', '/org/freedesktop/resolve1')
-        dbus_iface = dbus.Interface(
-            dbus_proxy, 'org.freedesktop.resolve1.Manager')
-        dbus_iface.SetLinkDNS(
-            iface.ifindex, [(2, [int(b) for b in self.bind.packed])])
-        dbus_iface.SetLinkDomains(
-            iface.ifindex, [['zerowire.', True]])
+    def close(self) -> None:
+        super().close()
+        self.client.close()
 
 
 class InterfaceDNSServer(BaseDNSServer):
     def __init__(self, hostname: str, bind: TIfaceAddress, port: int = 53):
         super().__init__(bind.ip, port)
+        self.init_args = (hostname, bind, port)
         self.hostname = DNSLabel(f'{hostname}.zerowire.')
         self.network = bind.network
+        self.responses: Dict[bytes, bytes] = {}
+        self.max_responses = 4096
         self.add_record(
             '_services._dns-sd._udp',
             QTYPE.PTR,
@@ -308,6 +551,55 @@ class InterfaceDNSServer(BaseDNSServer):
             QTYPE.PTR,
             dnslib.PTR(self.hostname))
 
+    def add_record(self, name: TStrOrLabel, type: QTYPE, record: RD) -> RD:
+        self.responses.clear()
+        return super().add_record(name, type, record)
+
+    def del_record(
+        self,
+        name: TStrOrLabel,
+        type: Optional[QTYPE] = None,
+        record: Optional[RD] = None,
+    ) -> None:
+        self.responses.clear()
+        super().del_record(name, type, record)
+
+    def cached_reply(self, data: bytes, source: TSource) -> Optional[bytes]:
+        if source[0] not in self.network:
+            return None
+        key = question_key(data)
+        if key is None:
+            return None
+        packed = self.responses.get(key)
+        if packed is None:
+            return None
+        # Same question length, so only the ID, the RD flag and the question
+        # itself, for its case, differ. Answer names point into the question.
+        # An EDNS0 key ends in the payload size, arcount is 0 or 1 here.
+        end = DNS_HEADER.size + len(key) - 2 * data[11]
+        return b''.join((
+            data[:2],
+            bytes((packed[2] & ~FLAG_RD | data[2] & FLAG_RD,)),
+            packed[3:DNS_HEADER.size],
+            data[DNS_HEADER.size:end],
+            packed[end:],
+        ))
+
+    def store_reply(
+        self,
+        data: bytes,
+        reply: DNSRecord,
+        packed: bytes,
+    ) -> None:
+        if reply.header.rcode not in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            return
+        key = question_key(data)
+        if key is None:
+            return
+        if len(self.responses) >= self.max_responses:
+            del self.responses[next(iter(self.responses))]
+        self.responses[key] = packed
+
     def add_service(self, service: ServiceConfig) -> None:
         type = DNSLabel(service.type)
         name = type.add(DNSLabel(service.name))
@@ -349,6 +641,17 @@ class InterfaceDNSServer(BaseDNSServer):
             QTYPE.TXT,
             dnslib.TXT(props))
 
+    def remove_service(self, service: ServiceConfig) -> None:
+        type = DNSLabel(service.type)
+        name = type.add(DNSLabel(service.name))
+        self.del_record(name)
+        self.del_record(type, QTYPE.PTR, dnslib.PTR(self.hostname.add(name)))
+        if not self.get_records(type, QTYPE.PTR):
+            self.del_record(
+                '_services._dns-sd._udp',
+                QTYPE.PTR,
+                dnslib.PTR(self.hostname.add(type)))
+
     async def handle_query(
         self,
         request: DNSRecord,
@@ -366,7 +669,9 @@ class InterfaceDNSServer(BaseDNSServer):
                 raise Exception('Request for non local domain.')
             qname = orig_qname.stripSuffix(self.hostname)
             qtype = question.qtype
-            self.logger.debug('Question %r %r', qname, QTYPE[qtype])
+            self.log_event(
+                logging.DEBUG, 'question', rate=QUERY_LOG_RATE, qname=qname,
+                qtype=QTYPE.get(qtype, qtype))
 
             records = self.get_records(qname, qtype)
             for record in records:
@@ -374,11 +679,11 @@ class InterfaceDNSServer(BaseDNSServer):
                     rname=orig_qname,
                     rtype=qtype,
                     rdata=record,
+                    ttl=RECORD_TTL,
                 ))
                 gave_answers = True
 
         if not gave_answers:
-            self.logger.debug('No answers')
             reply.header.set_rcode(RCODE.NXDOMAIN)
 
         return reply
@@ -0,0 +1,106 @@
+from __future__ import annotations
+from typing import (
+    List,
+    Optional,
+    Tuple,
+)
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from dnslib import DNSLabel, DNSRecord, QTYPE, RCODE, RR
+
+from .classlogger import ClassLogger
+from .metrics import DNS_ANSWER_CACHE
+
+# Used for NXDOMAIN and empty answers that carry no SOA to take it from
+NEGATIVE_TTL = 10
+
+TCacheKey = Tuple[DNSLabel, int]
+
+
+@dataclass
+class CacheEntry:
+    rcode: int
+    rrs: List[RR]
+    stored: float
+    expires: float
+
+
+class AnswerCache(ClassLogger):
+    '''Bounded LRU of answers from remote InterfaceDNSServers keyed by
+    (qname, qtype), kept for the smallest TTL of the answer. NXDOMAIN and
+    empty answers are cached too, for `negative_ttl`.'''
+    entries: OrderedDict[TCacheKey, CacheEntry]
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        negative_ttl: int = NEGATIVE_TTL,
+    ):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def ttl(self, answer: DNSRecord) -> int:
+        if answer.header.rcode == RCODE.NOERROR and answer.rr:
+            return int(min(rr.ttl for rr in answer.rr))
+        soa = [rr for rr in answer.auth if rr.rtype == QTYPE.SOA]
+        if soa:
+            return int(min(soa[0].ttl, soa[0].rdata.times[-1]))
+        return self.negative_ttl
+
+    def put(
+        self,
+        qname: DNSLabel,
+        qtype: int,
+        answer: DNSRecord,
+        now: Optional[float] = None,
+    ) -> None:
+        if answer.header.rcode not in (RCODE.NOERROR, RCODE.NXDOMAIN):
+            return
+        ttl = self.ttl(answer)
+        if ttl <= 0:
+            return
+        now = time.monotonic() if now is None else now
+        key = (qname, qtype)
+        self.entries[key] = CacheEntry(
+            answer.header.rcode, list(answer.rr), now, now + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(
+        self,
+        qname: DNSLabel,
+        qtype: int,
+        now: Optional[float] = None,
+    ) -> Optional[Tuple[int, List[RR]]]:
+        '''The rcode and answers for a question with their TTLs counted down,
+        None on a miss.'''
+        now = time.monotonic() if now is None else now
+        key = (qname, qtype)
+        entry = self.entries.get(key)
+        if entry is None or entry.expires <= now:
+            if entry is not None:
+                del self.entries[key]
+            DNS_ANSWER_CACHE.inc('miss')
+            return None
+        DNS_ANSWER_CACHE.inc('hit')
+        self.entries.move_to_end(key)
+        elapsed = int(now - entry.stored)
+        return entry.rcode, [
+            RR(rr.rname, rr.rtype, rr.rclass, rr.ttl - elapsed, rr.rdata)
+            for rr in entry.rrs
+        ]
+
+    def invalidate(self, suffix: DNSLabel) -> None:
+        '''Drop every answer for names under `suffix`.'''
+        for key in [key for key in self.entries if key[0].matchSuffix(suffix)]:
+            del self.entries[key]
+
+    def clear(self) -> None:
+        self.entries.clear()
@@ -0,0 +1,388 @@
+from __future__ import annotations
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    cast,
+)
+import socket
+import random
+import struct
+import asyncio
+import ipaddress
+
+from dnslib import DNSRecord
+
+from .types import TAddress
+from .classlogger import ClassLogger
+from .metrics import (
+    DNS_FORWARD_HEDGES,
+    DNS_FORWARD_SHORT_CIRCUITS,
+    DNS_FORWARD_TIMEOUTS,
+)
+
+DNS_ID = struct.Struct('!H')
+TCP_LENGTH = struct.Struct('!H')
+# Retransmission timeout of each host, RFC 6298 with the gains and bounds
+# scaled down to DNS over a LAN. A hedged attempt waits ATTEMPT_RTOS of them.
+RTO_MIN = 0.01
+RTO_MAX = 4.0
+RTT_ALPHA = 1 / 8
+RTT_BETA = 1 / 4
+ATTEMPT_RTOS = 2
+# Timeouts in a row that mark a host down, how long until one query may try
+# it again, and the bound that back off doubles up to while it still fails.
+BREAKER_FAILURES = 3
+BREAKER_COOLDOWN = 5.0
+BREAKER_COOLDOWN_MAX = 60.0
+MAX_HOSTS = 1024
+
+TWaitingKey = Tuple[int, int]
+# Where a query went and the future its reply resolves
+TWaiting = Tuple[Tuple[TAddress, int], 'asyncio.Future[bytes]']
+
+
+class HostDown(ConnectionError):
+    '''Every host that could answer a query is known to be down.'''
+
+
+class HostHealth:
+    '''Smoothed RTT and retransmission timeout of one host, and a circuit
+    breaker that opens after BREAKER_FAILURES timeouts in a row.
+
+    An open breaker lets one trial query through once its cooldown is over,
+    a reply closes it and a timeout opens it for twice as long.'''
+    __slots__ = (
+        'srtt', 'rttvar', 'rto', 'failures', 'cooldown', 'open_until', 'trial')
+
+    def __init__(self, rto: float) -> None:
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        self.rto = rto
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.open_until: Optional[float] = None
+        self.trial = False
+
+    def observe(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        self.rto = min(RTO_MAX, max(RTO_MIN, self.srtt + 4 * self.rttvar))
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.open_until = None
+        self.trial = False
+
+    def timed_out(self, now: float) -> None:
+        self.rto = min(RTO_MAX, self.rto * 2)
+        self.failures += 1
+        if self.trial:
+            self.trial = False
+            self.cooldown = min(BREAKER_COOLDOWN_MAX, self.cooldown * 2)
+            self.open_until = now + self.cooldown
+        elif self.open_until is None and self.failures >= BREAKER_FAILURES:
+            self.open_until = now + self.cooldown
+
+    def abandoned(self) -> None:
+        '''An attempt was cancelled, another host answered first.'''
+        self.trial = False
+
+    def available(self, now: float) -> bool:
+        '''Whether to query the host now, taking the trial if it is due.'''
+        if self.open_until is None:
+            return True
+        if self.trial or now < self.open_until:
+            return False
+        self.trial = True
+        return True
+
+
+class DNSClientProtocol(asyncio.DatagramProtocol, ClassLogger):
+    transport: asyncio.DatagramTransport
+
+    def __init__(self, pool: DNSClientPool, family: int) -> None:
+        self.pool = pool
+        self.family = family
+        self._setLoggerName(str(family), parent=pool)
+        super().__init__()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = cast(asyncio.DatagramTransport, transport)
+
+    def datagram_received(
+        self,
+        data: Union[bytes, str],
+        src: Tuple[str, int],
+    ) -> None:
+        if isinstance(data, bytes) and len(data) >= DNS_ID.size:
+            self.pool.reply(self.family, data, src)
+
+    def error_received(self, exc: Exception) -> None:
+        # ICMP unreachable and friends, the query will time out and retry
+        self.logger.debug('Error %s', exc)
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.pool.lost(self.family)
+
+
+class DNSClientPool(ClassLogger):
+    '''Forwards DNS queries over one long lived UDP socket per address
+    family, matching replies to queries by transaction ID and source.'''
+    transports: Dict[int, asyncio.DatagramTransport]
+    waiting: Dict[TWaitingKey, TWaiting]
+    health: Dict[TAddress, HostHealth]
+
+    def __init__(self, timeout: float = 0.5, attempts: int = 2):
+        self.timeout = timeout
+        self.attempts = attempts
+        self.loop = asyncio.get_event_loop()
+        self.transports = {}
+        self.waiting = {}
+        self.health = {}
+        self.lock = asyncio.Lock()
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.unmatched = 0
+        self.tcp_fallbacks = 0
+        self.hedges = 0
+        self.short_circuits = 0
+
+    async def transport(self, family: int) -> asyncio.DatagramTransport:
+        async with self.lock:
+            transport = self.transports.get(family)
+            if transport is None:
+                bind = '::' if family == socket.AF_INET6 else '0.0.0.0'
+                transport, _ = await self.loop.create_datagram_endpoint(
+                    lambda: DNSClientProtocol(self, family),
+                    local_addr=(bind, 0), family=family)
+                self.transports[family] = transport
+            return transport
+
+    def new_id(self, family: int) -> int:
+        while True:
+            id = random.getrandbits(16)
+            if (family, id) not in self.waiting:
+                return id
+
+    async def query(
+        self,
+        host: TAddress,
+        port: int,
+        query: DNSRecord,
+        timeout: Optional[float] = None,
+        attempts: Optional[int] = None,
+    ) -> DNSRecord:
+        '''Send `query` to host:port and return the reply, retrying with a
+        fresh transaction ID after each timeout, and over TCP if the reply
+        was truncated.'''
+        timeout = self.timeout if timeout is None else timeout
+        attempts = self.attempts if attempts is None else attempts
+        request = DNSRecord.parse(query.pack())
+        for attempt in range(attempts):
+            if attempt:
+                self.retries += 1
+            try:
+                data = await self.attempt(host, port, request, timeout)
+            except asyncio.TimeoutError:
+                continue
+            return await self.finish(host, port, query, request, data, timeout)
+        raise asyncio.TimeoutError(
+            f'No reply from {host.compressed}:{port} '
+            f'after {attempts} attempts')
+
+    async def attempt(
+        self,
+        host: TAddress,
+        port: int,
+        request: DNSRecord,
+        timeout: float,
+    ) -> bytes:
+        '''Send `request` once under a fresh transaction ID, the raw reply.'''
+        family = socket.AF_INET if host.version == 4 else socket.AF_INET6
+        transport = await self.transport(family)
+        key = (family, self.new_id(family))
+        request.header.id = key[1]
+        future: asyncio.Future[bytes] = self.loop.create_future()
+        self.waiting[key] = ((host, port), future)
+        self.sent += 1
+        transport.sendto(request.pack(), (host.compressed, port))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            DNS_FORWARD_TIMEOUTS.inc()
+            raise
+        finally:
+            self.waiting.pop(key, None)
+
+    async def finish(
+        self,
+        host: TAddress,
+        port: int,
+        query: DNSRecord,
+        request: DNSRecord,
+        data: bytes,
+        timeout: float,
+    ) -> DNSRecord:
+        '''The reply to `query`, over TCP if the UDP one was truncated.'''
+        reply = DNSRecord.parse(data)
+        if reply.header.tc:
+            self.tcp_fallbacks += 1
+            reply = await self.query_tcp(host, port, request, timeout)
+        reply.header.id = query.header.id
+        return reply
+
+    def host_health(self, host: TAddress) -> HostHealth:
+        health = self.health.get(host)
+        if health is None:
+            if len(self.health) >= MAX_HOSTS:
+                del self.health[next(iter(self.health))]
+            health = self.health[host] = HostHealth(self.timeout)
+        return health
+
+    async def timed_attempt(
+        self,
+        host: TAddress,
+        port: int,
+        request: DNSRecord,
+    ) -> bytes:
+        '''An attempt that feeds the health of `host`. Every attempt has its
+        own transaction ID, so an RTT sample is never ambiguous.'''
+        health = self.host_health(host)
+        start = self.loop.time()
+        try:
+            data = await self.attempt(
+                host, port, request, min(RTO_MAX, health.rto * ATTEMPT_RTOS))
+        except asyncio.TimeoutError:
+            health.timed_out(self.loop.time())
+            raise
+        except asyncio.CancelledError:
+            health.abandoned()
+            raise
+        health.observe(self.loop.time() - start)
+        return data
+
+    async def query_hedged(
+        self,
+        hosts: Sequence[TAddress],
+        port: int,
+        query: DNSRecord,
+        attempts: Optional[int] = None,
+    ) -> DNSRecord:
+        '''Send `query` to the fastest of `hosts` that is not down, and
+        once its RTO passes without a reply hedge with the next one, or the
+        same one again, up to `attempts` in flight; the first reply wins.
+
+        Raises HostDown without sending anything if every host is down.'''
+        if not hosts:
+            raise HostDown('No hosts to query')
+        attempts = self.attempts if attempts is None else attempts
+        ranked = sorted(hosts, key=lambda host: self.host_health(host).rto)
+        request = DNSRecord.parse(query.pack())
+        pending: Dict[asyncio.Task[bytes], TAddress] = {}
+        sent = 0
+        delay: Optional[float] = None
+        try:
+            while True:
+                if sent < attempts:
+                    now = self.loop.time()
+                    start = sent % len(ranked)
+                    host = next((
+                        host
+                        for host in ranked[start:] + ranked[:start]
+                        if self.host_health(host).available(now)
+                    ), None)
+                    if host is None and not sent:
+                        self.short_circuits += 1
+                        DNS_FORWARD_SHORT_CIRCUITS.inc()
+                        raise HostDown(
+                            f'{", ".join(h.compressed for h in ranked)} down')
+                    if host is None:
+                        sent = attempts
+                    else:
+                        if sent:
+                            self.hedges += 1
+                            DNS_FORWARD_HEDGES.inc()
+                        pending[self.loop.create_task(self.timed_attempt(
+                            host, port, request))] = host
+                        sent += 1
+                        delay = self.host_health(host).rto
+                if not pending:
+                    raise asyncio.TimeoutError(
+                        f'No reply from {len(ranked)} hosts after {sent} '
+                        'attempts')
+                done, _ = await asyncio.wait(
+                    pending, timeout=delay if sent < attempts else None,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    host = pending.pop(task)
+                    if task.exception() is None:
+                        return await self.finish(
+                            host, port, query, request, task.result(),
+                            self.timeout)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def query_tcp(
+        self,
+        host: TAddress,
+        port: int,
+        query: DNSRecord,
+        timeout: Optional[float] = None,
+    ) -> DNSRecord:
+        timeout = self.timeout if timeout is None else timeout
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host.compressed, port), timeout)
+        try:
+            packed = query.pack()
+            writer.write(TCP_LENGTH.pack(len(packed)) + packed)
+            length, = TCP_LENGTH.unpack(await asyncio.wait_for(
+                reader.readexactly(TCP_LENGTH.size), timeout))
+            return DNSRecord.parse(await asyncio.wait_for(
+                reader.readexactly(length), timeout))
+        finally:
+            writer.close()
+
+    def reply(self, family: int, data: bytes, src: Tuple[str, int]) -> None:
+        key = (family, DNS_ID.unpack_from(data)[0])
+        waiting = self.waiting.get(key)
+        if waiting is None or waiting[1].done() or waiting[0] != (
+                ipaddress.ip_address(src[0].split('%')[0]), src[1]):
+            self.unmatched += 1
+            return
+        self.received += 1
+        waiting[1].set_result(data)
+
+    def lost(self, family: int) -> None:
+        # A fresh socket is opened on the next query
+        self.transports.pop(family, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'sockets': len(self.transports),
+            'in_flight': len(self.waiting),
+            'sent': self.sent,
+            'received': self.received,
+            'timeouts': self.timeouts,
+            'retries': self.retries,
+            'unmatched': self.unmatched,
+            'tcp_fallbacks': self.tcp_fallbacks,
+            'hedges': self.hedges,
+            'short_circuits': self.short_circuits,
+        }
+
+    def close(self) -> None:
+        for transport in list(self.transports.values()):
+            transport.close()
+        self.transports.clear()
+        for _, future in self.waiting.values():
+            future.cancel()
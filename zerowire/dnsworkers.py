@@ -0,0 +1,199 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+)
+import signal
+import asyncio
+import multiprocessing
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+
+from .dns import BaseDNSServer, InterfaceDNSServer, LocalDNSServer
+from .records import TStrOrLabel
+from .metrics import REGISTRY
+from .classlogger import ClassLogger
+
+SERVER_CLASSES: Dict[str, Type[BaseDNSServer]] = {
+    Cls.__name__: Cls for Cls in (LocalDNSServer, InterfaceDNSServer)
+}
+
+# Seconds between the metrics a worker sends back
+METRICS_INTERVAL = 1.0
+
+# To a worker ('server', index, class name, init args), ('close', index) or
+# ('add' | 'del', index, name, type, record), from one ('metrics', drained)
+TMessage = Tuple[Any, ...]
+
+
+class DNSWorker(ClassLogger):
+    '''A worker process' replicas of the daemon's DNS servers, kept in sync
+    by messages from the daemon. What the servers count goes back to the
+    daemon's metrics every METRICS_INTERVAL.'''
+    servers: Dict[int, BaseDNSServer]
+
+    def __init__(self, conn: Connection):
+        self.conn = conn
+        self.loop = asyncio.get_event_loop()
+        self.servers = {}
+
+    def read(self) -> None:
+        try:
+            while self.conn.poll():
+                self.handle(self.conn.recv())
+        except EOFError:
+            # The daemon is gone
+            self.loop.stop()
+
+    def handle(self, message: TMessage) -> None:
+        op, index, *args = message
+        if op == 'server':
+            name, init_args = args
+            server = SERVER_CLASSES[name](*init_args)
+            server.reuse_port = True
+            self.servers[index] = server
+            self.loop.create_task(server.start())
+        elif op == 'close':
+            self.servers.pop(index).close()
+        elif op == 'add':
+            self.servers[index].add_record(*args)
+        elif op == 'del':
+            self.servers[index].del_record(*args)
+
+    def report(self) -> None:
+        drained = REGISTRY.drain()
+        if drained:
+            try:
+                self.conn.send(('metrics', drained))
+            except OSError:
+                self.loop.stop()
+                return
+        self.loop.call_later(METRICS_INTERVAL, self.report)
+
+    def close(self) -> None:
+        for server in self.servers.values():
+            server.close()
+
+
+def worker_main(conn: Connection, inherited: List[Connection]) -> None:
+    # Only the daemon may hold its ends of the pipes, or we never see EOF
+    # when it goes away
+    for other in inherited:
+        other.close()
+    # Ctrl-C reaches the whole process group, leave stopping to the daemon
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Forked with the daemon's counts, which it already has
+    REGISTRY.drain()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    worker = DNSWorker(conn)
+    loop.add_reader(conn.fileno(), worker.read)
+    loop.call_later(METRICS_INTERVAL, worker.report)
+    try:
+        loop.run_forever()
+    finally:
+        worker.close()
+        loop.close()
+
+
+class DNSWorkers(ClassLogger):
+    '''Extra processes answering DNS on the same addresses as the daemon's
+    servers through SO_REUSEPORT, each with a read only copy of every zone.
+
+    The processes are forked, so start() must run before the daemon starts
+    any threads. Servers are registered with add_server() before they are
+    started; their zones are copied over and every later change is
+    forwarded. The metrics counted by the workers are merged into the
+    daemon's.'''
+    processes: List[BaseProcess]
+    conns: List[Connection]
+    servers: Dict[int, BaseDNSServer]
+
+    def __init__(self, count: int):
+        self.count = count
+        self.loop = asyncio.get_event_loop()
+        self.processes = []
+        self.conns = []
+        self.servers = {}
+        self.__next_index = 0
+
+    def start(self) -> None:
+        context = multiprocessing.get_context('fork')
+        for i in range(self.count):
+            conn, worker_conn = context.Pipe()
+            process = context.Process(
+                target=worker_main,
+                args=(worker_conn, [conn, *self.conns]),
+                name=f'zerowire-dns-{i}',
+                daemon=True,
+            )
+            process.start()
+            worker_conn.close()
+            self.processes.append(process)
+            self.conns.append(conn)
+            self.loop.add_reader(process.sentinel, self.__died, process)
+            self.loop.add_reader(conn.fileno(), self.__read, conn)
+        self.logger.info('Started %d DNS workers', self.count)
+
+    def __died(self, process: BaseProcess) -> None:
+        self.loop.remove_reader(process.sentinel)
+        self.logger.error(
+            'DNS worker %s exited with %s', process.name, process.exitcode)
+
+    def __read(self, conn: Connection) -> None:
+        try:
+            while conn.poll():
+                op, drained = conn.recv()
+                if op == 'metrics':
+                    REGISTRY.merge(drained)
+        except (EOFError, OSError):
+            self.loop.remove_reader(conn.fileno())
+
+    def send(self, message: TMessage) -> None:
+        for conn in self.conns:
+            try:
+                conn.send(message)
+            except OSError as e:
+                self.logger.debug('Send failed %s', e)
+
+    def add_server(self, server: BaseDNSServer) -> None:
+        index = self.__next_index
+        self.__next_index += 1
+        self.servers[index] = server
+        server.reuse_port = True
+        self.send(('server', index, type(server).__name__, server.init_args))
+        for name, types in server.get_all_records().items():
+            for qtype, records in types.items():
+                for record in records:
+                    self.send(('add', index, name, qtype, record))
+
+        def on_change(
+            op: str,
+            name: TStrOrLabel,
+            qtype: Optional[int],
+            record: Optional[Any],
+        ) -> None:
+            self.send((op, index, str(name), qtype, record))
+        server.on_change = on_change
+
+    def remove_server(self, server: BaseDNSServer) -> None:
+        for index, registered in list(self.servers.items()):
+            if registered is server:
+                del self.servers[index]
+                server.on_change = None
+                self.send(('close', index))
+
+    def close(self) -> None:
+        for conn in self.conns:
+            if not conn.closed:
+                self.loop.remove_reader(conn.fileno())
+            conn.close()
+        for process in self.processes:
+            self.loop.remove_reader(process.sentinel)
+            process.terminate()
+        for process in self.processes:
+            process.join(1)
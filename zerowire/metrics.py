@@ -0,0 +1,407 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+import os
+import time
+import asyncio
+from bisect import bisect_left
+from threading import Lock
+
+from .classlogger import ClassLogger
+
+TLabels = Tuple[str, ...]
+
+# Seconds, from a cached DNS reply to a slow `wg` fork
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5,
+)
+LOOP_LAG_INTERVAL = 0.5
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape(value: str) -> str:
+    return (value
+            .replace('\\', r'\\')
+            .replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(
+        f'{name}="{escape(value)}"' for name, value in zip(names, values)
+    ) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    '''A named family of time series, one per tuple of label values.
+
+    Updates take a lock, as they come from executor and Zeroconf threads as
+    well as the event loop, and are a dict lookup and an add otherwise.'''
+    type = 'untyped'
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+    ):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = Lock()
+
+    def header(self) -> List[str]:
+        return [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+
+    def samples(self) -> Iterator[str]:
+        return iter(())
+
+    def series(self) -> List[Dict[str, Any]]:
+        '''Every time series as its labels and values, for the control
+        socket.'''
+        return []
+
+    def drain(self) -> Dict[TLabels, Any]:
+        '''Take every value, leaving the metric empty, for merge() into the
+        same metric of another process.'''
+        return {}
+
+    def merge(self, values: Dict[TLabels, Any]) -> None:
+        pass
+
+    def render(self) -> List[str]:
+        return [*self.header(), *self.samples()]
+
+
+class Counter(Metric):
+    type = 'counter'
+    values: Dict[TLabels, float]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+    ):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self.values.get(labels, 0)
+
+    def drain(self) -> Dict[TLabels, float]:
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(self, values: Dict[TLabels, float]) -> None:
+        with self.lock:
+            for labels, value in values.items():
+                self.values[labels] = self.values.get(labels, 0) + value
+
+    def series(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            values = list(self.values.items())
+        return [
+            {'labels': dict(zip(self.labels, labels)), 'value': value}
+            for labels, value in sorted(values)
+        ]
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = list(self.values.items())
+        for labels, value in sorted(values):
+            yield (f'{self.name}{format_labels(self.labels, labels)} '
+                   f'{format_value(value)}')
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    # Per label values, a count per bucket (not cumulative) then the sum
+    values: Dict[TLabels, Tuple[List[int], List[float]]]
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = (
+                    [0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def count(self, *labels: str) -> int:
+        series = self.values.get(labels)
+        return 0 if series is None else sum(series[0])
+
+    def drain(self) -> Dict[TLabels, Tuple[List[int], List[float]]]:
+        with self.lock:
+            values, self.values = self.values, {}
+        return values
+
+    def merge(
+        self,
+        values: Dict[TLabels, Tuple[List[int], List[float]]],
+    ) -> None:
+        with self.lock:
+            for labels, (counts, total) in values.items():
+                series = self.values.get(labels)
+                if series is None:
+                    series = self.values[labels] = (
+                        [0] * (len(self.buckets) + 1), [0.0])
+                for index, count in enumerate(counts):
+                    series[0][index] += count
+                series[1][0] += total[0]
+
+    def series(self) -> List[Dict[str, Any]]:
+        with self.lock:
+            values = [
+                (labels, sum(counts), total[0])
+                for labels, (counts, total) in self.values.items()
+            ]
+        return [
+            {'labels': dict(zip(self.labels, labels)), 'count': count,
+             'sum': total}
+            for labels, count, total in sorted(values)
+        ]
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = [
+                (labels, list(counts), total[0])
+                for labels, (counts, total) in self.values.items()
+            ]
+        names = (*self.labels, 'le')
+        for labels, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float('inf')), counts):
+                cumulative += count
+                le = format_labels(names, (*labels, format_value(bound)))
+                yield f'{self.name}_bucket{le} {cumulative}'
+            suffix = format_labels(self.labels, labels)
+            yield f'{self.name}_sum{suffix} {format_value(total)}'
+            yield f'{self.name}_count{suffix} {cumulative}'
+
+
+class Registry:
+    metrics: Dict[str, Metric]
+
+    def __init__(self) -> None:
+        self.metrics = {}
+
+    def register(self, metric: Metric) -> None:
+        assert metric.name not in self.metrics, metric.name
+        self.metrics[metric.name] = metric
+
+    def counter(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+    ) -> Counter:
+        counter = Counter(name, help, labels)
+        self.register(counter)
+        return counter
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        histogram = Histogram(name, help, labels, buckets)
+        self.register(histogram)
+        return histogram
+
+    def drain(self) -> Dict[str, Dict[TLabels, Any]]:
+        '''What every metric counted since the last drain, by name.'''
+        drained = {
+            name: metric.drain() for name, metric in self.metrics.items()
+        }
+        return {name: values for name, values in drained.items() if values}
+
+    def merge(self, drained: Dict[str, Dict[TLabels, Any]]) -> None:
+        for name, values in drained.items():
+            metric = self.metrics.get(name)
+            if metric is not None:
+                metric.merge(values)
+
+    def series(self) -> Dict[str, List[Dict[str, Any]]]:
+        return {
+            name: metric.series() for name, metric in self.metrics.items()
+        }
+
+    def render(self) -> str:
+        return ''.join(
+            line + '\n'
+            for metric in self.metrics.values()
+            for line in metric.render()
+        )
+
+
+REGISTRY = Registry()
+
+SERVICES = REGISTRY.counter(
+    'zerowire_services_total',
+    'WireGuard services by stage: discovered, missing (did not resolve), '
+    'authenticated or rejected.',
+    ['event'])
+PEERS = REGISTRY.counter(
+    'zerowire_peers_total',
+    'Peers added (or updated) and removed.',
+    ['interface', 'event'])
+WG_SECONDS = REGISTRY.histogram(
+    'zerowire_wg_seconds',
+    'Latency of WireGuard operations, `wg` subcommands or netlink calls.',
+    ['backend', 'operation'])
+DNS_QUERIES = REGISTRY.histogram(
+    'zerowire_dns_query_seconds',
+    'DNS queries answered, by server and rcode.',
+    ['server', 'rcode'])
+DNS_FORWARD_TIMEOUTS = REGISTRY.counter(
+    'zerowire_dns_forward_timeouts_total',
+    'Forwarded DNS queries that got no reply in time, per attempt.')
+DNS_FORWARD_HEDGES = REGISTRY.counter(
+    'zerowire_dns_forward_hedges_total',
+    'Extra attempts sent while an earlier one was still unanswered.')
+DNS_FORWARD_SHORT_CIRCUITS = REGISTRY.counter(
+    'zerowire_dns_forward_short_circuits_total',
+    'Forwarded DNS queries failed at once, every peer address was down.')
+DNS_ANSWER_CACHE = REGISTRY.counter(
+    'zerowire_dns_answer_cache_total',
+    'Lookups in the cache of remote service answers, by result: hit or '
+    'miss.',
+    ['result'])
+LOOP_LAG = REGISTRY.histogram(
+    'zerowire_event_loop_lag_seconds',
+    'How late the event loop ran a timer.')
+
+
+class LoopLagMonitor(ClassLogger):
+    '''Sleeps in a loop and records how much later than asked it woke.'''
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.loop = asyncio.get_event_loop()
+        self.__task: Optional[asyncio.Task[None]] = None
+
+    async def run(self) -> None:
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            LOOP_LAG.observe(
+                max(0.0, self.loop.time() - start - self.interval))
+
+    async def start(self) -> None:
+        self.__task = self.loop.create_task(self.run())
+
+    def close(self) -> None:
+        if self.__task is not None:
+            self.__task.cancel()
+
+
+class MetricsServer(ClassLogger):
+    '''Serves the registry in the Prometheus text format over HTTP, on
+    `host:port` or on a UNIX socket given as `unix:<path>`.'''
+
+    def __init__(self, address: str, registry: Registry = REGISTRY):
+        self._setLoggerName(address)
+        self.address = address
+        self.registry = registry
+        self.loop = asyncio.get_event_loop()
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.lag = LoopLagMonitor()
+
+    @property
+    def path(self) -> Optional[str]:
+        if self.address.startswith('unix:'):
+            return self.address[len('unix:'):]
+        return None
+
+    async def start(self) -> None:
+        path = self.path
+        if path is not None:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = await asyncio.start_unix_server(self.serve, path)
+        else:
+            host, port = self.address.rsplit(':', 1)
+            self.server = await asyncio.start_server(
+                self.serve, host.strip('[]'), int(port))
+        await self.lag.start()
+        self.logger.info('Serving metrics')
+
+    async def serve(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            method, target = request.split(b' ', 2)[:2]
+            if method != b'GET':
+                status, body = '405 Method Not Allowed', ''
+            elif target.split(b'?', 1)[0] not in (b'/', b'/metrics'):
+                status, body = '404 Not Found', ''
+            else:
+                start = time.perf_counter()
+                status, body = '200 OK', self.registry.render()
+                self.logger.debug(
+                    'Rendered in %.6fs', time.perf_counter() - start)
+            payload = body.encode('utf-8')
+            writer.write(
+                f'HTTP/1.0 {status}\r\n'
+                f'Content-Type: {CONTENT_TYPE}\r\n'
+                f'Content-Length: {len(payload)}\r\n'
+                f'Connection: close\r\n\r\n'.encode('ascii') + payload)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError, ValueError, ConnectionError) as e:
+            self.logger.debug('Bad request %r', e)
+        finally:
+            writer.close()
+
+    def close(self) -> None:
+        self.lag.close()
+        if self.server is not None:
+            self.server.close()
+        path = self.path
+        if path is not None and os.path.exists(path):
+            os.unlink(path)
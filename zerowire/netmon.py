@@ -0,0 +1,126 @@
+from __future__ import annotations
+from typing import (
+    Callable,
+    Iterator,
+    Optional,
+    Set,
+    Tuple,
+    TYPE_CHECKING,
+)
+import socket
+import struct
+import asyncio
+from contextlib import contextmanager
+from threading import Lock
+
+from .classlogger import ClassLogger
+
+if TYPE_CHECKING:
+    from pyroute2 import IPRoute
+
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+NLMSGHDR = struct.Struct('=IHHII')
+# ifi_index of ifinfomsg, ifa_index of ifaddrmsg
+IFINFO_INDEX = struct.Struct('=BxHi')
+IFADDR_INDEX = struct.Struct('=BBBBI')
+
+
+class IPRoutePool:
+    '''The one IPRoute handle of the daemon, opened on first use.
+
+    Only use it off the event loop thread (constructors or executors), and
+    only inside `get()`, which serialises callers. pyroute2 is imported
+    then too, it is by far the slowest import of the daemon.'''
+    __ipr: Optional[IPRoute] = None
+    __lock = Lock()
+
+    @classmethod
+    @contextmanager
+    def get(Cls) -> Iterator[IPRoute]:
+        with Cls.__lock:
+            if Cls.__ipr is None:
+                from pyroute2 import IPRoute
+                Cls.__ipr = IPRoute()
+            yield Cls.__ipr
+
+    @classmethod
+    def close(Cls) -> None:
+        with Cls.__lock:
+            if Cls.__ipr is not None:
+                Cls.__ipr.close()
+                Cls.__ipr = None
+
+
+def parse_events(data: bytes) -> Iterator[Tuple[int, int]]:
+    '''(message type, ifindex) of every link or address message in a netlink
+    datagram, only the headers are decoded.'''
+    offset = 0
+    while offset + NLMSGHDR.size <= len(data):
+        length, type, _flags, _seq, _pid = NLMSGHDR.unpack_from(data, offset)
+        if length < NLMSGHDR.size:
+            break
+        body = offset + NLMSGHDR.size
+        if type in (RTM_NEWLINK, RTM_DELLINK):
+            yield type, IFINFO_INDEX.unpack_from(data, body)[2]
+        elif type in (RTM_NEWADDR, RTM_DELADDR):
+            yield type, IFADDR_INDEX.unpack_from(data, body)[4]
+        # NLMSG_ALIGN
+        offset += (length + 3) & ~3
+
+
+class LinkMonitor(ClassLogger):
+    '''Subscribes to link and address changes on the event loop and reports
+    the indexes of the links that changed, debounced.'''
+    changed: Set[int]
+
+    def __init__(
+        self,
+        callback: Callable[[Set[int]], None],
+        debounce: float = 1.0,
+    ):
+        self.callback = callback
+        self.debounce = debounce
+        self.loop = asyncio.get_event_loop()
+        self.changed = set()
+        self.__handle: Optional[asyncio.TimerHandle] = None
+        self.sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.sock.bind(
+            (0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        self.sock.setblocking(False)
+
+    async def start(self) -> None:
+        self.loop.add_reader(self.sock.fileno(), self.__read)
+
+    def __read(self) -> None:
+        try:
+            data = self.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # ENOBUFS, events were dropped, assume everything changed
+            self.logger.warning('Netlink overrun %s', e)
+            self.changed.add(0)
+        else:
+            for _type, index in parse_events(data):
+                self.changed.add(index)
+        if self.changed and self.__handle is None:
+            self.__handle = self.loop.call_later(self.debounce, self.__flush)
+
+    def __flush(self) -> None:
+        self.__handle = None
+        changed, self.changed = self.changed, set()
+        self.callback(changed)
+
+    def close(self) -> None:
+        if self.__handle is not None:
+            self.__handle.cancel()
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
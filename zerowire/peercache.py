@@ -0,0 +1,188 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+import os
+import json
+import time
+import asyncio
+import hashlib
+import tempfile
+import ipaddress
+from threading import Lock
+
+from .peers import PeerEntry, PeerTable
+from .classlogger import ClassLogger
+
+PEER_CACHE = '/var/lib/zerowire/peers.json'
+# Seconds between writes at most, the table changes with every announcement
+PEER_CACHE_INTERVAL = 30
+VERSION = 1
+
+# pubkey, name, hostname, internal addr, endpoint addr, endpoint port,
+# last active, candidate addrs, probe port
+TRow = List[Any]
+
+
+def fingerprint(ifname: str, psk: str) -> str:
+    '''Ties cached peers to the interface and psk they authenticated with,
+    without writing the psk to disk.'''
+    return hashlib.sha256(f'{ifname}\0{psk}'.encode('utf-8')).hexdigest()[:16]
+
+
+def entry_to_row(entry: PeerEntry) -> TRow:
+    return [
+        entry.pubkey,
+        entry.name,
+        entry.hostname,
+        entry.internal_addr.compressed,
+        entry.endpoint[0].compressed,
+        entry.endpoint[1],
+        round(entry.last_active),
+        [addr.compressed for addr in entry.candidates],
+        entry.probe_port,
+    ]
+
+
+def row_to_entry(row: TRow) -> PeerEntry:
+    (pubkey, name, hostname, internal_addr, host, port, last_active,
+        candidates, probe_port) = row
+    return PeerEntry(
+        pubkey=str(pubkey),
+        name=str(name),
+        hostname=str(hostname),
+        internal_addr=ipaddress.ip_address(internal_addr),
+        endpoint=(ipaddress.ip_address(host), int(port)),
+        last_seen=float(last_active),
+        candidates=tuple(ipaddress.ip_address(addr) for addr in candidates),
+        probe_port=None if probe_port is None else int(probe_port),
+    )
+
+
+class PeerCache(ClassLogger):
+    '''The authenticated peers of every interface, persisted so a restart
+    can program them before mDNS finds them again.
+
+    The file is compact JSON, replaced atomically at most every `interval`
+    seconds after a change, and once more on exit.'''
+    stored: Dict[str, Dict[str, Any]]
+    tables: Dict[str, Tuple[str, PeerTable]]
+
+    def __init__(
+        self,
+        path: str = PEER_CACHE,
+        interval: float = PEER_CACHE_INTERVAL,
+    ):
+        self._setLoggerName(path)
+        self.path = path
+        self.interval = interval
+        self.loop = asyncio.get_event_loop()
+        self.stored = {}
+        self.tables = {}
+        self.lock = Lock()
+        self.writes = 0
+        self.__handle: Optional[asyncio.TimerHandle] = None
+        self.__last_write = 0.0
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'rb') as file:
+                data = json.loads(file.read())
+            if data.get('version') != VERSION:
+                raise ValueError(f'Unknown version {data.get("version")}')
+            self.stored = dict(data['interfaces'])
+        except FileNotFoundError:
+            self.stored = {}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning('Ignoring unreadable peer cache: %s', e)
+            self.stored = {}
+
+    def entries(self, ifname: str, psk: str) -> List[PeerEntry]:
+        '''Peers stored for the interface, if it still has the same psk.'''
+        stored = self.stored.get(ifname)
+        if not stored or stored.get('key') != fingerprint(ifname, psk):
+            return []
+        entries = []
+        for row in stored.get('peers', []):
+            try:
+                entries.append(row_to_entry(row))
+            except (ValueError, TypeError) as e:
+                self.logger.warning('Skipping cached peer %r: %s', row, e)
+        return entries
+
+    def track(self, ifname: str, psk: str, table: PeerTable) -> None:
+        self.tables[ifname] = (fingerprint(ifname, psk), table)
+        self.changed()
+
+    def untrack(self, ifname: str) -> None:
+        self.tables.pop(ifname, None)
+        self.stored.pop(ifname, None)
+        self.changed()
+
+    def changed(self) -> None:
+        '''Schedule a write, at most one per interval.'''
+        if self.__handle is not None:
+            return
+        delay = max(0.0, self.__last_write + self.interval - time.monotonic())
+        self.__handle = self.loop.call_later(delay, self.__write)
+
+    def snapshot(self) -> bytes:
+        interfaces = {
+            ifname: {
+                'key': key,
+                'peers': [
+                    entry_to_row(entry)
+                    for entry in table.entries.values()
+                    if not entry.withdrawn
+                ],
+            }
+            for ifname, (key, table) in self.tables.items()
+        }
+        return json.dumps(
+            {'version': VERSION, 'interfaces': interfaces},
+            separators=(',', ':'),
+        ).encode('utf-8')
+
+    def __write(self) -> None:
+        self.__handle = None
+        self.__last_write = time.monotonic()
+        future = self.loop.run_in_executor(None, self.write, self.snapshot())
+        future.add_done_callback(self.__written)
+
+    def __written(self, future: asyncio.Future[None]) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error(
+                'Writing peer cache failed %s', future.exception())
+
+    def write(self, data: bytes) -> None:
+        '''Replace the file with `data`, readers see the old or the new one
+        in full.'''
+        directory = os.path.dirname(self.path) or '.'
+        with self.lock:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            # Created 0600, only root may learn or plant peers
+            fd, tmp = tempfile.mkstemp(prefix='.peers.', dir=directory)
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            self.writes += 1
+
+    def flush(self) -> None:
+        '''Write now, from the event loop thread.'''
+        if self.__handle is not None:
+            self.__handle.cancel()
+            self.__handle = None
+        try:
+            self.write(self.snapshot())
+        except OSError as e:
+            self.logger.error('Writing peer cache failed %s', e)
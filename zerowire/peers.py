@@ -0,0 +1,120 @@
+from __future__ import annotations
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from .types import TAddress, TEndpoint
+from .classlogger import ClassLogger
+
+PEER_TTL = 600
+# Once a peer has said goodbye over mDNS only a live tunnel keeps it, for as
+# long as WireGuard itself would (REJECT_AFTER_TIME).
+WITHDRAWN_TTL = 180
+# Peers restored from the peer cache have this long to be seen over mDNS
+# again, after which only a live tunnel keeps them.
+CONFIRM_GRACE = 60
+
+
+@dataclass
+class PeerEntry:
+    pubkey: str
+    name: str
+    hostname: str
+    internal_addr: TAddress
+    endpoint: TEndpoint
+    last_seen: float
+    latest_handshake: float = 0
+    withdrawn: bool = False
+    # Every usable carrier address, and where the peer answers probes
+    candidates: Tuple[TAddress, ...] = ()
+    probe_port: Optional[int] = None
+    # Set while restored from the peer cache and not yet seen again
+    confirm_by: Optional[float] = None
+
+    @property
+    def last_active(self) -> float:
+        return max(self.last_seen, self.latest_handshake)
+
+
+class PeerTable(ClassLogger):
+    '''Discovered peers of one WireGuard interface, least recently active
+    first, with TTL expiry and an optional size cap.'''
+    entries: OrderedDict[str, PeerEntry]
+
+    def __init__(
+        self,
+        ttl: Optional[int] = None,
+        max_peers: Optional[int] = None,
+    ):
+        self.ttl = PEER_TTL if ttl is None else ttl
+        self.max_peers = max_peers
+        self.entries = OrderedDict()
+
+    def __contains__(self, pubkey: str) -> bool:
+        return pubkey in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, pubkey: str) -> Optional[PeerEntry]:
+        return self.entries.get(pubkey)
+
+    def touch(self, entry: PeerEntry) -> List[PeerEntry]:
+        '''Insert or refresh an entry, returns the entries evicted to stay
+        within max_peers.'''
+        old = self.entries.get(entry.pubkey)
+        if old is not None:
+            entry.latest_handshake = max(
+                entry.latest_handshake, old.latest_handshake)
+        self.entries[entry.pubkey] = entry
+        self.entries.move_to_end(entry.pubkey)
+        evicted: List[PeerEntry] = []
+        max_peers = self.max_peers
+        while max_peers is not None and len(self.entries) > max_peers:
+            evicted.append(self.entries.popitem(last=False)[1])
+        return evicted
+
+    def withdraw(self, name: str) -> Optional[PeerEntry]:
+        for entry in self.entries.values():
+            if entry.name == name:
+                entry.withdrawn = True
+                return entry
+        return None
+
+    def remove(self, pubkey: str) -> Optional[PeerEntry]:
+        return self.entries.pop(pubkey, None)
+
+    def update_handshakes(self, handshakes: Dict[str, int]) -> None:
+        for pubkey, handshake in handshakes.items():
+            entry = self.entries.get(pubkey)
+            if entry is None or handshake <= entry.latest_handshake:
+                continue
+            entry.latest_handshake = handshake
+            self.entries.move_to_end(pubkey)
+
+    def is_expired(self, entry: PeerEntry, now: float) -> bool:
+        if entry.withdrawn:
+            ttl = min(self.ttl, WITHDRAWN_TTL)
+            return now - entry.latest_handshake > ttl
+        if entry.confirm_by is not None and now > entry.confirm_by:
+            if now - entry.latest_handshake > min(self.ttl, WITHDRAWN_TTL):
+                return True
+        return now - entry.last_active > self.ttl
+
+    def expire(self, now: Optional[float] = None) -> List[PeerEntry]:
+        '''Remove and return every entry past its TTL.'''
+        now = time.time() if now is None else now
+        expired = [
+            entry
+            for entry in self.entries.values()
+            if self.is_expired(entry, now)
+        ]
+        for entry in expired:
+            del self.entries[entry.pubkey]
+        return expired
@@ -0,0 +1,131 @@
+from __future__ import annotations
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
+import os
+import time
+import socket
+import asyncio
+
+from .types import TAddress
+from .classlogger import ClassLogger
+
+REQUEST = b'ZWP?'
+REPLY = b'ZWP!'
+TOKEN_LEN = 12
+PACKET_LEN = len(REQUEST) + TOKEN_LEN
+
+
+class ProbeProtocol(asyncio.DatagramProtocol, ClassLogger):
+    transport: asyncio.DatagramTransport
+
+    def __init__(self, prober: Prober) -> None:
+        self.prober = prober
+        self._setLoggerName(parent=prober)
+        super().__init__()
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        self.transport = cast(asyncio.DatagramTransport, transport)
+
+    def datagram_received(
+        self,
+        data: Union[bytes, str],
+        src: Tuple[str, int],
+    ) -> None:
+        if not isinstance(data, bytes) or len(data) != PACKET_LEN:
+            return
+        magic, token = data[:len(REQUEST)], data[len(REQUEST):]
+        if magic == REQUEST:
+            # Same size as the request, nothing to amplify
+            self.transport.sendto(REPLY + token, src)
+        elif magic == REPLY:
+            self.prober.reply(token)
+
+
+class Prober(ClassLogger):
+    '''UDP echo used to time carrier paths to a peer.
+
+    A single dual-stack socket both answers probes from remote peers and
+    sends our own; its port is advertised in the WireGuard service.'''
+    waiting: Dict[bytes, asyncio.Future[float]]
+
+    def __init__(self, port: int = 0, timeout: float = 0.5, attempts: int = 3):
+        self.timeout = timeout
+        self.attempts = attempts
+        self.waiting = {}
+        self.loop = asyncio.get_event_loop()
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        try:
+            self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            self.sock.bind(('::', port))
+            self.family = socket.AF_INET6
+        except OSError:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.bind(('0.0.0.0', port))
+            self.family = socket.AF_INET
+        self.port: int = self.sock.getsockname()[1]
+        self._setLoggerName(str(self.port))
+
+    async def start(self) -> None:
+        self.transport, _ = await self.loop.create_datagram_endpoint(
+            lambda: ProbeProtocol(self), sock=self.sock)
+
+    def reply(self, token: bytes) -> None:
+        future = self.waiting.pop(token, None)
+        if future is not None and not future.done():
+            future.set_result(time.perf_counter())
+
+    def sockaddr(self, addr: TAddress, port: int) -> Tuple[str, int]:
+        if addr.version == 4 and self.family == socket.AF_INET6:
+            return (f'::ffff:{addr.compressed}', port)
+        return (addr.compressed, port)
+
+    async def rtt(self, addr: TAddress, port: int) -> Optional[float]:
+        '''Best round trip in seconds over a few attempts, None if the peer
+        never answered.'''
+        if self.transport is None:
+            return None
+        if addr.version == 6 and self.family == socket.AF_INET:
+            return None
+        best: Optional[float] = None
+        for _ in range(self.attempts):
+            token = os.urandom(TOKEN_LEN)
+            future: asyncio.Future[float] = self.loop.create_future()
+            self.waiting[token] = future
+            sent = time.perf_counter()
+            self.transport.sendto(REQUEST + token, self.sockaddr(addr, port))
+            try:
+                rtt = await asyncio.wait_for(future, self.timeout) - sent
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                self.waiting.pop(token, None)
+            best = rtt if best is None else min(best, rtt)
+        return best
+
+    async def rank(
+        self,
+        addrs: Iterable[TAddress],
+        port: int,
+    ) -> List[Tuple[float, TAddress]]:
+        '''Probe every address at once, fastest first, silent ones left
+        out.'''
+        addrs = list(addrs)
+        rtts = await asyncio.gather(*(self.rtt(addr, port) for addr in addrs))
+        return sorted(
+            ((rtt, addr) for rtt, addr in zip(rtts, addrs) if rtt is not None),
+            key=lambda ranked: ranked[0],
+        )
+
+    def close(self) -> None:
+        if self.transport is not None:
+            self.transport.close()
+        else:
+            self.sock.close()
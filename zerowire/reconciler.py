@@ -0,0 +1,162 @@
+from __future__ import annotations
+from typing import (
+    Dict,
+    List,
+    Optional,
+)
+import asyncio
+import time
+from threading import Lock
+
+from .wg import WGBackend, WGDevice, WGPeer
+from .classlogger import ClassLogger
+
+# WireGuard's REJECT_AFTER_TIME, a peer that handshook more recently than
+# this has a working endpoint even if it roamed away from the advertised one.
+ROAM_GRACE = 180
+# How long after start peers found in the kernel but not (yet) desired are
+# kept, so a restart does not drop tunnels discovery is about to re-add.
+ADOPT_GRACE = 60
+
+
+class PeerReconciler(ClassLogger):
+    '''Holds the desired peer table of one WireGuard interface and converges
+    the kernel to it, one dump and one batched update per pass.'''
+    desired: Dict[str, WGPeer]
+    applied: Dict[str, WGPeer]
+
+    def __init__(
+        self,
+        ifname: str,
+        backend: WGBackend,
+        interval: float = 30.0,
+        debounce: float = 0.05,
+        adopt: float = 0.0,
+    ):
+        self._setLoggerName(ifname)
+        self.ifname = ifname
+        self.backend = backend
+        self.interval = interval
+        self.debounce = debounce
+        self.adopt = adopt
+        self.adopt_until = 0.0
+        self.loop = asyncio.get_event_loop()
+        self.desired = {}
+        self.applied = {}
+        self.last_dump: Optional[WGDevice] = None
+        self.lock = Lock()
+        self.__handle: Optional[asyncio.TimerHandle] = None
+        self.__pass: Optional[asyncio.Future[List[WGPeer]]] = None
+        self.__rerun = False
+        self.__periodic: Optional[asyncio.Task[None]] = None
+        self.__adopted: Optional[asyncio.TimerHandle] = None
+
+    def set_peer(self, peer: WGPeer) -> None:
+        with self.lock:
+            self.desired[peer.pubkey] = peer
+        self.schedule()
+
+    def remove_peer(self, pubkey: str) -> None:
+        with self.lock:
+            self.desired.pop(pubkey, None)
+        self.schedule()
+
+    def schedule(self) -> None:
+        '''Request a pass, safe from any thread. Requests arriving within
+        `debounce` of each other share a single pass.'''
+        self.loop.call_soon_threadsafe(self.__schedule)
+
+    def __schedule(self) -> None:
+        if self.__handle is None:
+            self.__handle = self.loop.call_later(self.debounce, self.__start)
+
+    def __start(self) -> None:
+        self.__handle = None
+        if self.__pass is not None:
+            self.__rerun = True
+            return
+        self.__pass = self.loop.run_in_executor(None, self.reconcile)
+        self.__pass.add_done_callback(self.__done)
+
+    def __done(self, future: asyncio.Future[List[WGPeer]]) -> None:
+        self.__pass = None
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error('Reconcile failed %s', future.exception())
+        if self.__rerun:
+            self.__rerun = False
+            self.__schedule()
+
+    @staticmethod
+    def in_sync(
+        desired: WGPeer,
+        actual: WGPeer,
+        now: Optional[float] = None,
+        applied: Optional[WGPeer] = None,
+    ) -> bool:
+        if (desired.psk, desired.keepalive, set(desired.allowed_ips)) != (
+                actual.psk, actual.keepalive, set(actual.allowed_ips)):
+            return False
+        if desired.endpoint == actual.endpoint:
+            return True
+        if applied is not None and applied.endpoint != desired.endpoint:
+            # We picked a new endpoint since the last pass, not a roam
+            return False
+        now = time.time() if now is None else now
+        return actual.latest_handshake > now - ROAM_GRACE
+
+    @classmethod
+    def diff(
+        Cls,
+        desired: Dict[str, WGPeer],
+        actual: WGDevice,
+        now: Optional[float] = None,
+        applied: Optional[Dict[str, WGPeer]] = None,
+    ) -> List[WGPeer]:
+        applied = applied or {}
+        changes = [
+            peer
+            for pubkey, peer in desired.items()
+            if pubkey not in actual.peers
+            or not Cls.in_sync(
+                peer, actual.peers[pubkey], now, applied.get(pubkey))
+        ]
+        changes.extend(
+            WGPeer(pubkey=pubkey, remove=True)
+            for pubkey in actual.peers
+            if pubkey not in desired
+        )
+        return changes
+
+    def reconcile(self) -> List[WGPeer]:
+        with self.lock:
+            desired = dict(self.desired)
+        self.last_dump = self.backend.dump(self.ifname)
+        changes = self.diff(desired, self.last_dump, applied=self.applied)
+        if time.monotonic() < self.adopt_until:
+            changes = [peer for peer in changes if not peer.remove]
+        if changes:
+            self.logger.debug('Applying %d peer changes', len(changes))
+            self.backend.set_peers(self.ifname, changes)
+        self.applied = desired
+        return changes
+
+    async def __run_periodic(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.__schedule()
+
+    async def start(self) -> None:
+        if self.adopt:
+            self.adopt_until = time.monotonic() + self.adopt
+            # Drop whatever was not re-discovered once the grace is over
+            self.__adopted = self.loop.call_later(self.adopt, self.schedule)
+        self.__periodic = self.loop.create_task(self.__run_periodic())
+        self.__schedule()
+
+    def close(self) -> None:
+        if self.__handle is not None:
+            self.__handle.cancel()
+        if self.__adopted is not None:
+            self.__adopted.cancel()
+        if self.__periodic is not None:
+            self.__periodic.cancel()
@@ -0,0 +1,191 @@
+from __future__ import annotations
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterator,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+from types import MappingProxyType
+from functools import lru_cache
+
+from dnslib import DNSBuffer, DNSLabel, RD
+
+TStrOrLabel = Union[str, DNSLabel]
+# Lower cased labels, leftmost first
+TNameKey = Tuple[bytes, ...]
+TSnapshot = Mapping[str, Mapping[int, Tuple[RD, ...]]]
+
+
+@lru_cache(maxsize=4096)
+def str_key(name: str) -> TNameKey:
+    return tuple(label.lower() for label in DNSLabel(name).label)
+
+
+def name_key(name: TStrOrLabel) -> TNameKey:
+    if isinstance(name, DNSLabel):
+        return tuple(label.lower() for label in name.label)
+    return str_key(name)
+
+
+def rdata_key(record: RD) -> bytes:
+    '''Wire format of the record data, RD objects are not hashable.'''
+    buffer = DNSBuffer()
+    record.pack(buffer)
+    return bytes(buffer.data)
+
+
+class RecordStore:
+    '''Records by case-insensitive name and type.
+
+    Names are interned as tuples of lower cased labels and every record set
+    is an immutable tuple, so lookups neither allocate nor insert, and
+    duplicates are found by wire format in O(1). Names are also indexed by
+    parent, for enumerating everything under a suffix, and by first label.'''
+    names: Dict[TNameKey, Dict[int, Tuple[RD, ...]]]
+    # Wire format of every record in a record set
+    packed: Dict[Tuple[TNameKey, int], Set[bytes]]
+    children: Dict[TNameKey, Set[TNameKey]]
+    first_labels: Dict[bytes, Set[TNameKey]]
+    count: int
+
+    def __init__(self) -> None:
+        self.names = {}
+        self.packed = {}
+        self.children = {}
+        self.first_labels = {}
+        self.count = 0
+        self.__snapshot: Optional[TSnapshot] = None
+
+    def __contains__(self, name: TStrOrLabel) -> bool:
+        return name_key(name) in self.names
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[TNameKey]:
+        return iter(self.names)
+
+    def get(self, name: TStrOrLabel, type: int) -> Tuple[RD, ...]:
+        types = self.names.get(name_key(name))
+        if types is None:
+            return ()
+        return types.get(type, ())
+
+    def add(self, name: TStrOrLabel, type: int, record: RD) -> bool:
+        '''Add a record, False if it was already there.'''
+        key = name_key(name)
+        packed = rdata_key(record)
+        record_set = self.packed.get((key, type))
+        if record_set is None:
+            record_set = self.packed[(key, type)] = set()
+        elif packed in record_set:
+            return False
+        record_set.add(packed)
+        types = self.names.get(key)
+        if types is None:
+            types = self.names[key] = {}
+            self.__index(key)
+        types[type] = (*types.get(type, ()), record)
+        self.count += 1
+        self.__snapshot = None
+        return True
+
+    def remove(
+        self,
+        name: TStrOrLabel,
+        type: Optional[int] = None,
+        record: Optional[RD] = None,
+    ) -> int:
+        '''Remove a record, every record of a type or of the whole name, or
+        a record from every type. Returns the number removed.'''
+        key = name_key(name)
+        types = self.names.get(key)
+        if types is None:
+            return 0
+        packed = None if record is None else rdata_key(record)
+        removed = 0
+        for rtype in [type] if type is not None else list(types):
+            record_set = self.packed.get((key, rtype))
+            if record_set is None:
+                continue
+            if packed is None:
+                removed += len(record_set)
+                del self.packed[(key, rtype)]
+                del types[rtype]
+                continue
+            if packed not in record_set:
+                continue
+            record_set.discard(packed)
+            removed += 1
+            if not record_set:
+                del self.packed[(key, rtype)]
+                del types[rtype]
+                continue
+            types[rtype] = tuple(
+                existing for existing in types[rtype]
+                if rdata_key(existing) != packed)
+        if not types:
+            del self.names[key]
+            self.__unindex(key)
+        if removed:
+            self.count -= removed
+            self.__snapshot = None
+        return removed
+
+    def __index(self, key: TNameKey) -> None:
+        if not key:
+            return
+        self.first_labels.setdefault(key[0], set()).add(key)
+        # Link up to the root, through names that hold no records themselves
+        while key:
+            siblings = self.children.setdefault(key[1:], set())
+            if key in siblings:
+                break
+            siblings.add(key)
+            key = key[1:]
+
+    def __unindex(self, key: TNameKey) -> None:
+        if not key:
+            return
+        same_first = self.first_labels[key[0]]
+        same_first.discard(key)
+        if not same_first:
+            del self.first_labels[key[0]]
+        while key and key not in self.names and key not in self.children:
+            siblings = self.children[key[1:]]
+            siblings.discard(key)
+            if siblings:
+                break
+            del self.children[key[1:]]
+            key = key[1:]
+
+    def under(self, suffix: TStrOrLabel) -> FrozenSet[TNameKey]:
+        '''Every name at or below `suffix`.'''
+        root = name_key(suffix)
+        found = set()
+        stack = [root]
+        while stack:
+            key = stack.pop()
+            if key in self.names:
+                found.add(key)
+            stack.extend(self.children.get(key, ()))
+        return frozenset(found)
+
+    def starting_with(self, label: Union[str, bytes]) -> FrozenSet[TNameKey]:
+        '''Every name whose first label is `label`.'''
+        if isinstance(label, str):
+            label = label.encode()
+        return frozenset(self.first_labels.get(label.lower(), ()))
+
+    def snapshot(self) -> TSnapshot:
+        '''Read only view of the whole store, shared until the next change.'''
+        if self.__snapshot is None:
+            self.__snapshot = MappingProxyType({
+                str(DNSLabel(key)): MappingProxyType(dict(types))
+                for key, types in self.names.items()
+            })
+        return self.__snapshot
@@ -0,0 +1,231 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+import socket
+import asyncio
+import ipaddress
+from concurrent.futures import ThreadPoolExecutor
+
+from .types import TAddress, TEndpoint
+from .classlogger import ClassLogger
+
+RESOLVE1 = 'org.freedesktop.resolve1'
+RESOLVE1_PATH = '/org/freedesktop/resolve1'
+RESOLVE1_MANAGER = 'org.freedesktop.resolve1.Manager'
+DOMAIN = 'zerowire.'
+RESOLV_CONF = '/etc/resolv.conf'
+DNS_PORT = 53
+# Seconds between checks that resolved still runs under the same owner, and
+# the bounds of the back off after a failed update.
+WATCH_INTERVAL = 10
+RETRY_MIN = 1
+RETRY_MAX = 30
+
+
+def parse_endpoint(value: str, port: int = DNS_PORT) -> TEndpoint:
+    '''`addr`, `addr:port` or `[addr]:port`.'''
+    value = value.strip()
+    if value.startswith('['):
+        host, _, rest = value[1:].partition(']')
+        if rest:
+            port = int(rest.lstrip(':'))
+        return (ipaddress.ip_address(host), port)
+    if value.count(':') == 1:
+        host, _, _port = value.partition(':')
+        return (ipaddress.ip_address(host), int(_port))
+    return (ipaddress.ip_address(value), port)
+
+
+def parse_upstreams(value: str) -> List[TEndpoint]:
+    return [parse_endpoint(part) for part in value.split(',') if part.strip()]
+
+
+def resolv_conf_upstreams(
+    exclude: TAddress,
+    path: str = RESOLV_CONF,
+) -> List[TEndpoint]:
+    '''The nameservers of resolv.conf, other than ourselves.'''
+    upstreams: List[TEndpoint] = []
+    with open(path) as file:
+        for line in file:
+            fields = line.split()
+            # Scoped link local servers need the zone, lost on 3.7
+            if (len(fields) < 2 or fields[0] != 'nameserver'
+                    or '%' in fields[1]):
+                continue
+            try:
+                addr = ipaddress.ip_address(fields[1])
+            except ValueError:
+                continue
+            if addr != exclude:
+                upstreams.append((addr, DNS_PORT))
+    return upstreams
+
+
+class ResolvedClient(ClassLogger):
+    '''Routes the zerowire. domain of every WireGuard link to the local DNS
+    server through systemd-resolved.
+
+    dbus-python blocks, so one system bus connection lives on one worker
+    thread and the event loop only queues work for it. Links added or
+    removed in the same loop iteration go out together in one job.
+
+    resolved forgets link settings made over D-Bus when it restarts, so the
+    owner of its bus name is checked every `watch_interval`. A new owner gets
+    every link again, and failed updates are retried with back off.'''
+    links: Set[int]
+    pending: Set[int]
+    reverts: Set[int]
+
+    def __init__(
+        self,
+        server: TAddress,
+        watch_interval: float = WATCH_INTERVAL,
+        retry_max: float = RETRY_MAX,
+    ):
+        self.server = server
+        self.watch_interval = watch_interval
+        self.retry_max = retry_max
+        self.loop = asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(
+            1, thread_name_prefix='zerowire-resolved')
+        self.links = set()
+        self.pending = set()
+        self.reverts = set()
+        self.retry = 0.0
+        self.batches = 0
+        # Only touched on the worker thread
+        self.__bus: Any = None
+        self.__manager: Any = None
+        self.__owner: Optional[str] = None
+        self.__handle: Optional[asyncio.Handle] = None
+        self.__watch: Optional[asyncio.Task[None]] = None
+
+    def add_link(self, ifindex: int) -> None:
+        self.links.add(ifindex)
+        self.reverts.discard(ifindex)
+        self.pending.add(ifindex)
+        self.schedule()
+
+    def remove_link(self, ifindex: int, revert: bool = True) -> None:
+        '''Forget a link, reverting its settings unless it is gone.'''
+        self.links.discard(ifindex)
+        self.pending.discard(ifindex)
+        if revert:
+            self.reverts.add(ifindex)
+            self.schedule()
+
+    def schedule(self, delay: float = 0) -> None:
+        if self.__handle is not None:
+            return
+        if delay:
+            self.__handle = self.loop.call_later(delay, self.__flush)
+        else:
+            self.__handle = self.loop.call_soon(self.__flush)
+
+    def __flush(self) -> None:
+        self.__handle = None
+        if not self.pending and not self.reverts:
+            return
+        links, reverts = sorted(self.pending), sorted(self.reverts)
+        self.pending.clear()
+        self.reverts.clear()
+        future = self.loop.run_in_executor(
+            self.executor, self.apply, links, reverts)
+        future.add_done_callback(
+            lambda future: self.__applied(future, links, reverts))
+
+    def __applied(
+        self,
+        future: asyncio.Future[None],
+        links: List[int],
+        reverts: List[int],
+    ) -> None:
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            self.retry = 0
+            return
+        self.retry = min(self.retry_max, max(RETRY_MIN, self.retry * 2))
+        self.logger.warning(
+            'Updating systemd-resolved failed, retrying in %.0fs: %s',
+            self.retry, error)
+        self.pending.update(link for link in links if link in self.links)
+        self.reverts.update(
+            link for link in reverts if link not in self.links)
+        self.schedule(self.retry)
+
+    def connect(self) -> Tuple[Any, Any]:
+        '''The bus and the resolved manager, on the worker thread.'''
+        import dbus
+        bus = dbus.SystemBus()
+        proxy = bus.get_object(RESOLVE1, RESOLVE1_PATH, introspect=False)
+        return bus, dbus.Interface(proxy, RESOLVE1_MANAGER)
+
+    def disconnect(self) -> None:
+        self.__bus = self.__manager = None
+
+    def owner(self) -> Optional[str]:
+        '''Unique bus name of resolved, None while it is not running.'''
+        try:
+            if self.__bus is None:
+                self.__bus, self.__manager = self.connect()
+            return str(self.__bus.get_name_owner(RESOLVE1))
+        except Exception as e:
+            self.logger.debug('No systemd-resolved %s', e)
+            self.disconnect()
+            return None
+
+    def apply(self, links: List[int], reverts: List[int]) -> None:
+        '''One batch of link updates, on the worker thread.'''
+        owner = self.owner()
+        if owner is None:
+            raise ConnectionError(f'{RESOLVE1} is not running')
+        family = (
+            socket.AF_INET if self.server.version == 4 else socket.AF_INET6)
+        address = [(family, list(self.server.packed))]
+        try:
+            for ifindex in reverts:
+                self.__manager.RevertLink(ifindex)
+            for ifindex in links:
+                self.__manager.SetLinkDNS(ifindex, address)
+                self.__manager.SetLinkDomains(ifindex, [(DOMAIN, True)])
+        except Exception:
+            self.disconnect()
+            raise
+        self.__owner = owner
+        self.batches += 1
+        self.logger.debug('Set links %r, reverted %r', links, reverts)
+
+    def restarted(self) -> bool:
+        '''Whether resolved runs under another owner than at the last
+        update, on the worker thread.'''
+        owner = self.owner()
+        return owner is not None and owner != self.__owner
+
+    async def run_watch(self) -> None:
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            if not self.links:
+                continue
+            if await self.loop.run_in_executor(self.executor, self.restarted):
+                self.logger.info('systemd-resolved restarted, updating links')
+                self.pending.update(self.links)
+                self.schedule()
+
+    async def start(self) -> None:
+        self.__watch = self.loop.create_task(self.run_watch())
+
+    def close(self) -> None:
+        if self.__handle is not None:
+            self.__handle.cancel()
+            self.__handle = None
+        if self.__watch is not None:
+            self.__watch.cancel()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,113 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+import sys
+import time
+import builtins
+import threading
+from importlib.util import resolve_name
+from types import ModuleType
+
+REPORT_LINES = 20
+
+
+class ImportProfiler:
+    '''Times first imports by wrapping __import__, much like
+    `python -X importtime`, which a zipapp cannot be started with.
+
+    An import that loads new modules is charged to the module it names, or
+    the submodule it takes from a package, less the time of the imports it
+    made in turn. Each thread keeps its own stack, executors import too.'''
+    self_times: Dict[str, float]
+
+    def __init__(self) -> None:
+        self.started = time.perf_counter()
+        self.self_times = {}
+        self.__local = threading.local()
+        self.__lock = threading.Lock()
+        self.__import = builtins.__import__
+
+    def install(self) -> None:
+        builtins.__import__ = self
+
+    def uninstall(self) -> None:
+        if builtins.__import__ is self:
+            builtins.__import__ = self.__import
+
+    def __call__(
+        self,
+        name: str,
+        globals: Optional[Mapping[str, Any]] = None,
+        locals: Optional[Mapping[str, Any]] = None,
+        fromlist: Optional[Sequence[str]] = (),
+        level: int = 0,
+    ) -> ModuleType:
+        stack: List[float] = self.__local.__dict__.setdefault('stack', [])
+        target = self.resolve(name, globals, level)
+        # `from package import module`, for a package already imported
+        submodules = [
+            f'{target}.{item}'
+            for item in fromlist or ()
+            if target in sys.modules and f'{target}.{item}' not in sys.modules
+        ]
+        count = len(sys.modules)
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.__import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            if len(sys.modules) > count:
+                loaded = [name for name in submodules if name in sys.modules]
+                self.charge(
+                    loaded[0] if loaded else target, elapsed - children)
+
+    @staticmethod
+    def resolve(
+        name: str,
+        globals: Optional[Mapping[str, Any]],
+        level: int,
+    ) -> str:
+        if not level:
+            return name
+        package = (globals or {}).get('__package__') or ''
+        try:
+            return resolve_name('.' * level + name, package)
+        except (ImportError, ValueError):
+            return package or name
+
+    def charge(self, name: str, seconds: float) -> None:
+        with self.__lock:
+            self.self_times[name] = self.self_times.get(name, 0.0) + seconds
+
+    def by_package(self) -> List[Tuple[str, float]]:
+        '''Self time summed per top level package, slowest first.'''
+        totals: Dict[str, float] = {}
+        for name, seconds in self.self_times.items():
+            package = name.split('.', 1)[0]
+            totals[package] = totals.get(package, 0.0) + seconds
+        return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+    def report(self, lines: int = REPORT_LINES) -> str:
+        elapsed = time.perf_counter() - self.started
+        imports = sum(self.self_times.values())
+        packages = self.by_package()
+        report = [
+            f'Started in {elapsed:.3f}s, {imports:.3f}s of it in '
+            f'{len(self.self_times)} imports',
+            *(
+                f'{seconds * 1000:9.1f}ms  {package}'
+                for package, seconds in packages[:lines]
+            ),
+        ]
+        return '\n'.join(report)
@@ -1,4 +1,4 @@
-from typing import Union
+from typing import Tuple, Union
 from ipaddress import (
     IPv4Interface,
     IPv6Interface,
@@ -11,3 +11,4 @@ from ipaddress import (
 TIfaceAddress = Union[IPv4Interface, IPv6Interface]
 TAddress = Union[IPv4Address, IPv6Address]
 TNetwork = Union[IPv4Network, IPv6Network]
+TEndpoint = Tuple[TAddress, int]
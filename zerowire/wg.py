@@ -1,12 +1,21 @@
 from __future__ import annotations
 from typing import (
+    Dict,
+    Iterable,
     List,
     Union,
     Optional,
+    Tuple,
 )
 
+import time
 import subprocess
+import ipaddress
+from abc import abstractmethod
+from dataclasses import dataclass, field
 from .classlogger import ClassLogger
+from .metrics import WG_SECONDS
+from .types import TEndpoint, TNetwork
 
 
 class WGProc(ClassLogger):
@@ -32,14 +41,163 @@ class WGProc(ClassLogger):
         args = self._args
         input = self._input
         self.logger.debug('run %r input %r', args, bool(input))
-        return (
-            subprocess.run(
-                ['wg', *args],
-                stdout=subprocess.PIPE,
-                text=True,
-                input=input,
-                check=True,
+        start = time.perf_counter()
+        try:
+            return (
+                subprocess.run(
+                    ['wg', *args],
+                    stdout=subprocess.PIPE,
+                    text=True,
+                    input=input,
+                    check=True,
+                )
+                .stdout
+                .strip()
             )
-            .stdout
-            .strip()
+        finally:
+            WG_SECONDS.observe(
+                time.perf_counter() - start, 'wg', args[0] if args else '')
+
+
+def format_endpoint(endpoint: TEndpoint) -> str:
+    addr, port = endpoint
+    if addr.version == 6:
+        return f'[{addr.compressed}]:{port}'
+    return f'{addr.compressed}:{port}'
+
+
+def parse_endpoint(endpoint: str) -> Optional[TEndpoint]:
+    if endpoint == '(none)':
+        return None
+    host, port = endpoint.rsplit(':', 1)
+    return (ipaddress.ip_address(host.strip('[]')), int(port))
+
+
+@dataclass(frozen=True)
+class WGPeer:
+    pubkey: str
+    psk: Optional[str] = None
+    endpoint: Optional[TEndpoint] = None
+    allowed_ips: Tuple[TNetwork, ...] = ()
+    keepalive: Optional[int] = None
+    remove: bool = False
+    # Kernel state, not part of the desired configuration
+    latest_handshake: int = field(default=0, compare=False)
+
+
+@dataclass
+class WGDevice:
+    pubkey: Optional[str] = None
+    listen_port: Optional[int] = None
+    fwmark: Optional[int] = None
+    peers: Dict[str, WGPeer] = field(default_factory=dict)
+
+
+class WGBackend(ClassLogger):
+    @staticmethod
+    def create(name: str) -> WGBackend:
+        if name == 'netlink':
+            from .wgnetlink import WGNetlinkBackend
+            return WGNetlinkBackend()
+        if name == 'wg':
+            return WGProcBackend()
+        raise ValueError(f'Unknown WireGuard backend {name}')
+
+    @abstractmethod
+    def set_device(
+        self,
+        ifname: str,
+        privkey: str,
+        port: Optional[int] = None,
+    ) -> None:
+        pass
+
+    @abstractmethod
+    def set_peers(self, ifname: str, peers: Iterable[WGPeer]) -> None:
+        '''Add, update or remove (peer.remove) peers in as few calls as the
+        backend allows.'''
+
+    @abstractmethod
+    def dump(self, ifname: str) -> WGDevice:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class WGProcBackend(WGBackend):
+    '''Drives the kernel through the `wg` binary.
+
+    Peer updates are written as a single `wg addconf` config on stdin, so the
+    shared psk never hits the command line, and removals are collapsed into
+    one `wg set`.'''
+
+    def set_device(
+        self,
+        ifname: str,
+        privkey: str,
+        port: Optional[int] = None,
+    ) -> None:
+        (WGProc('set', ifname)
+            .args(
+                [] if port is None else ['listen-port', str(port)],
+                'private-key', '/dev/stdin'
+            )
+            .input(privkey)
+            .run())
+
+    def set_peers(self, ifname: str, peers: Iterable[WGPeer]) -> None:
+        removed: List[str] = []
+        conf: List[str] = []
+        for peer in peers:
+            if peer.remove:
+                removed.extend(['peer', peer.pubkey, 'remove'])
+                continue
+            conf.append('[Peer]')
+            conf.append(f'PublicKey = {peer.pubkey}')
+            if peer.psk is not None:
+                conf.append(f'PresharedKey = {peer.psk}')
+            if peer.endpoint is not None:
+                conf.append(f'Endpoint = {format_endpoint(peer.endpoint)}')
+            if peer.keepalive is not None:
+                conf.append(f'PersistentKeepalive = {peer.keepalive}')
+            if peer.allowed_ips:
+                conf.append('AllowedIPs = ' + ', '.join(
+                    net.compressed for net in peer.allowed_ips))
+        if removed:
+            WGProc('set', ifname).args(removed).run()
+        if conf:
+            (WGProc('addconf', ifname, '/dev/stdin')
+                .input('\n'.join(conf) + '\n')
+                .run())
+
+    def dump(self, ifname: str) -> WGDevice:
+        return self.parse_dump(WGProc('show', ifname, 'dump').run())
+
+    @staticmethod
+    def parse_dump(dump: str) -> WGDevice:
+        lines = dump.splitlines()
+        if not lines:
+            return WGDevice()
+        iface = lines[0].split('\t')
+        device = WGDevice(
+            pubkey=iface[1],
+            listen_port=int(iface[2]),
+            fwmark=None if iface[3] in ('off', 'none') else int(iface[3], 0),
         )
+        for line in lines[1:]:
+            (pubkey, psk, endpoint, allowed_ips,
+                handshake, _rx, _tx, keepalive) = line.split('\t')
+            device.peers[pubkey] = WGPeer(
+                pubkey=pubkey,
+                psk=None if psk == '(none)' else psk,
+                endpoint=parse_endpoint(endpoint),
+                allowed_ips=tuple(
+                    ipaddress.ip_network(net)
+                    for net in allowed_ips.split(',')
+                    if net != '(none)'
+                ),
+                keepalive=None if keepalive == 'off' else int(keepalive),
+                latest_handshake=int(handshake),
+            )
+        return device
@@ -0,0 +1,162 @@
+from __future__ import annotations
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+)
+
+import time
+import ipaddress
+from threading import Lock
+from pyroute2 import WireGuard
+from pyroute2.netlink.generic.wireguard import AsyncWireGuard
+
+from .wg import WGBackend, WGDevice, WGPeer
+from .metrics import WG_SECONDS
+
+# Peers per WG_CMD_SET_DEVICE message, keeps each request well inside the
+# default netlink socket buffer.
+BATCH_SIZE = 128
+
+
+def peer_to_netlink(peer: WGPeer) -> Dict[str, Any]:
+    if peer.remove:
+        return {'public_key': peer.pubkey, 'remove': True}
+    nlpeer: Dict[str, Any] = {
+        'public_key': peer.pubkey,
+        'replace_allowed_ips': True,
+        'allowed_ips': [net.compressed for net in peer.allowed_ips],
+    }
+    if peer.psk is not None:
+        nlpeer['preshared_key'] = peer.psk
+    if peer.endpoint is not None:
+        nlpeer['endpoint_addr'] = peer.endpoint[0].compressed
+        nlpeer['endpoint_port'] = peer.endpoint[1]
+    if peer.keepalive is not None:
+        nlpeer['persistent_keepalive'] = peer.keepalive
+    return nlpeer
+
+
+def merge_peer_attrs(attrs: List[List[Any]]) -> List[List[Any]]:
+    '''pyroute2 emits one WGDEVICE_A_PEERS attribute per peer, the kernel
+    only reads one, so fold them into a single nested peer list.'''
+    peers: List[Any] = []
+    merged: List[List[Any]] = []
+    for attr in attrs:
+        if attr[0] == 'WGDEVICE_A_PEERS':
+            peers.extend(attr[1])
+        else:
+            merged.append(attr)
+    if peers:
+        merged.append(['WGDEVICE_A_PEERS', peers])
+    return merged
+
+
+class PeerBatch(list):  # type: ignore
+    pass
+
+
+class AsyncBatchWireGuard(AsyncWireGuard):  # type: ignore
+    def _wg_set_peer(self, msg: Any, peer: Any) -> None:
+        if not isinstance(peer, PeerBatch):
+            return super()._wg_set_peer(msg, peer)  # type: ignore
+        for each in peer:
+            super()._wg_set_peer(msg, each)
+        msg['attrs'] = merge_peer_attrs(msg['attrs'])
+
+
+class BatchWireGuard(WireGuard):
+    async_class = AsyncBatchWireGuard
+
+
+class WGNetlinkBackend(WGBackend):
+    '''Talks the WireGuard generic netlink protocol directly, no forks.'''
+
+    def __init__(self, batch_size: int = BATCH_SIZE) -> None:
+        self.batch_size = batch_size
+        self.wg = BatchWireGuard()
+        # Interfaces reconcile from executor threads, one socket between them
+        self.lock = Lock()
+
+    def set_device(
+        self,
+        ifname: str,
+        privkey: str,
+        port: Optional[int] = None,
+    ) -> None:
+        with self.lock:
+            start = time.perf_counter()
+            self.wg.set(ifname, listen_port=port, private_key=privkey)
+            WG_SECONDS.observe(
+                time.perf_counter() - start, 'netlink', 'set_device')
+
+    def set_peers(self, ifname: str, peers: Iterable[WGPeer]) -> None:
+        nlpeers = [peer_to_netlink(peer) for peer in peers]
+        for i in range(0, len(nlpeers), self.batch_size):
+            batch = PeerBatch(nlpeers[i:i + self.batch_size])
+            self.logger.debug('set %s %d peers', ifname, len(batch))
+            with self.lock:
+                start = time.perf_counter()
+                self.wg.set(ifname, peer=batch)
+                WG_SECONDS.observe(
+                    time.perf_counter() - start, 'netlink', 'set_peers')
+
+    def dump(self, ifname: str) -> WGDevice:
+        device = WGDevice()
+        with self.lock:
+            start = time.perf_counter()
+            msgs = self.wg.info(ifname)
+            WG_SECONDS.observe(time.perf_counter() - start, 'netlink', 'dump')
+        # Large peer tables are split across several messages
+        for msg in msgs:
+            pubkey = msg.get_attr('WGDEVICE_A_PUBLIC_KEY')
+            if pubkey is not None:
+                device.pubkey = self._key(pubkey)
+            port = msg.get_attr('WGDEVICE_A_LISTEN_PORT')
+            if port is not None:
+                device.listen_port = port
+            fwmark = msg.get_attr('WGDEVICE_A_FWMARK')
+            if fwmark:
+                device.fwmark = fwmark
+            for nlpeer in msg.get_attr('WGDEVICE_A_PEERS') or []:
+                peer = self.parse_peer(nlpeer)
+                device.peers[peer.pubkey] = peer
+        return device
+
+    @staticmethod
+    def _key(value: Any) -> str:
+        if isinstance(value, bytes):
+            return value.decode('ascii')
+        return str(value)
+
+    @classmethod
+    def parse_peer(Cls, nlpeer: Any) -> WGPeer:
+        psk = nlpeer.get_attr('WGPEER_A_PRESHARED_KEY')
+        if psk is not None:
+            psk = Cls._key(psk)
+            # An all zero key means no psk
+            if psk == 'A' * 43 + '=':
+                psk = None
+        endpoint = nlpeer.get_attr('WGPEER_A_ENDPOINT')
+        handshake = nlpeer.get_attr('WGPEER_A_LAST_HANDSHAKE_TIME')
+        keepalive = nlpeer.get_attr('WGPEER_A_PERSISTENT_KEEPALIVE_INTERVAL')
+        return WGPeer(
+            pubkey=Cls._key(nlpeer.get_attr('WGPEER_A_PUBLIC_KEY')),
+            psk=psk,
+            endpoint=(
+                (ipaddress.ip_address(endpoint['addr']), endpoint['port'])
+                if endpoint is not None and endpoint['port']
+                else None
+            ),
+            allowed_ips=tuple(
+                ipaddress.ip_network(allowed['addr'])
+                for allowed in nlpeer.get_attr('WGPEER_A_ALLOWEDIPS') or []
+            ),
+            keepalive=keepalive or None,
+            latest_handshake=handshake['tv_sec'] if handshake else 0,
+        )
+
+    def close(self) -> None:
+        self.wg.close()
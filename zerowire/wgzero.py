@@ -1,26 +1,61 @@
 from __future__ import annotations
 from typing import (
+    Any,
+    Callable,
     List,
     Dict,
+    Optional,
+    Set,
+    Tuple,
+    TYPE_CHECKING,
 )
 import os
+import time
+import dataclasses
+import functools
 import base64
+import asyncio
+import hashlib
+import logging
 import ipaddress
-from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from zeroconf import ServiceBrowser, Zeroconf, ServiceInfo, ServiceListener
-from pyroute2 import IPRoute
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
 
-from .config import IfaceConfig, MACHINE_ID, HOSTNAME
-from .wg import WGProc
-from .types import TAddress, TIfaceAddress
+from .config import IfaceConfig, ServiceConfig, HOSTNAME, machine_id
+from .auth import ServiceVerifier, TProperties, legacy_digest, sign, verify
+from .wg import WGBackend, WGPeer
+from .reconciler import ADOPT_GRACE, PeerReconciler
+from .discovery import DiscoveryPipeline
+from .peers import CONFIRM_GRACE, PEER_TTL, PeerEntry, PeerTable
+from .peercache import PeerCache
+from .probe import Prober
+from .netmon import IPRoutePool, LinkMonitor
+from .types import TAddress, TEndpoint
 from .dns import LocalDNSServer, InterfaceDNSServer
+from .metrics import PEERS, SERVICES
 from .classlogger import ClassLogger
 
+if TYPE_CHECKING:
+    from pyroute2 import IPRoute
+
 
 WG_TYPE = "_wireguard._udp.local."
+# Re-probe multi-homed peers this often, and only move to an endpoint that is
+# clearly faster than the current one.
+PROBE_INTERVAL = 60
+PROBE_HYSTERESIS = 0.8
+# Settings WGInterface.reload applies in place, keeping peers and DNS; a
+# change to any other setting (addr, psk) takes a new interface. Of those the
+# device settings need WireGuard reconfigured and the service re-announced.
+RELOADABLE = frozenset({
+    'services', 'peer_ttl', 'max_peers', 'port', 'privkey', 'pubkey'})
+DEVICE_SETTINGS = frozenset({'port', 'privkey', 'pubkey'})
+# What WGZeroconf.rebind found: links, ignored links and, when the carrier
+# addresses changed, the binding to them
+TRebind = Tuple[Dict[int, str], Set[int], Optional['Binding']]
+# Records a second of each per announcement log event, for mDNS storms
+SERVICE_LOG_RATE = 5
 
 
 class WGServiceInfo(ServiceInfo, ClassLogger):
@@ -34,39 +69,34 @@ class WGServiceInfo(ServiceInfo, ClassLogger):
         addresses: List[bytes],
         hostname: str,
         config: IfaceConfig,
+        probe_port: Optional[int] = None,
+        compat: bool = True,
     ) -> WGServiceInfo:
+        '''A signed announcement of `config`. With `compat` it also carries
+        the legacy `auth` digest, for peers that predate the HMAC.'''
         salt = base64.b64encode(os.urandom(32))
 
         dnshost = f'{machineid}.{WG_TYPE}'
-        addr = config.addr.ip.compressed.encode('utf-8')
         port = config.port
-        hostnameenc = hostname.encode('utf-8')
-        pubkey = config.pubkey.encode('utf-8')
-        psk = config.psk.encode('utf-8')
-        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-        digest.update(dnshost.encode('utf-8'))
-        digest.update(str(port).encode('utf-8'))
-        # print(addresses)
-        # for address in addresses:
-        #     digest.update(address)
-        digest.update(addr)
-        digest.update(hostnameenc)
-        digest.update(pubkey)
-        digest.update(salt)
-        digest.update(psk)
-        auth = base64.b64encode(digest.finalize())
+        properties: TProperties = {
+            b'addr': config.addr.ip.compressed.encode('utf-8'),
+            b'hostname': hostname.encode('utf-8'),
+            b'pubkey': config.pubkey.encode('utf-8'),
+            b'salt': salt,
+        }
+        if probe_port is not None:
+            properties[b'probe'] = str(probe_port).encode('utf-8')
+        auth = sign(dnshost, port, properties, config.psk)
+        properties[b'hmac'] = auth
+        if compat:
+            properties[b'auth'] = legacy_digest(
+                dnshost, port, properties, config.psk)
         obj = Cls(
             WG_TYPE,
             dnshost,
             port=port,
             addresses=addresses,
-            properties={
-                'addr': addr,
-                'hostname': hostnameenc,
-                'pubkey': pubkey,
-                'salt': salt,
-                'auth': auth,
-            }
+            properties=properties,
         )
         obj._setLoggerName(machineid)
         obj.logger.debug('dnshost %s', dnshost)
@@ -75,189 +105,615 @@ class WGServiceInfo(ServiceInfo, ClassLogger):
         return obj
 
     @staticmethod
-    def authenticate(info: ServiceInfo, psk: str) -> bool:
-        props: Dict[bytes, bytes] = info.properties
-        addr = props.get(b'addr', b'')
-        hostname = props.get(b'hostname', b'')
-        pubkey = props.get(b'pubkey', b'')
-        salt = props.get(b'salt', b'')
-        auth = props.get(b'auth', b'')
-        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-
-        digest.update(info.name.encode('utf-8'))
-        digest.update(str(info.port).encode('utf-8'))
-        # print(info.addresses)
-        # for address in info.addresses:
-        #     digest.update(address)
-        digest.update(addr)
-        digest.update(hostname)
-        digest.update(pubkey)
-        digest.update(salt)
-        digest.update(psk.encode('utf-8'))
-        res = base64.b64encode(digest.finalize())
-        return res == auth
-
-
-class WGZeroconf(ClassLogger):
-    def __init__(self, ifname: str, wg_iface: WGInterface):
-        self._setLoggerName(ifname)
-        self.ifname = ifname
-        self.ifindex: int = IPRoute().link_lookup(ifname=ifname)[0]
-        self.wg_iface = wg_iface
-        self.addresses = self.get_addrs()
+    def authenticate(info: ServiceInfo, psk: str, compat: bool = True) -> bool:
+        return verify(info, psk, compat)
+
+
+@dataclasses.dataclass
+class Binding:
+    '''A Zeroconf bound to carrier addresses, with its services announced
+    and, if browsing, its browser.'''
+    zeroconf: Zeroconf
+    addresses: List[TAddress]
+    services: Dict[str, WGServiceInfo]
+    browser: Optional[ServiceBrowser] = None
+
+
+class WGZeroconf(ServiceListener, ClassLogger):
+    '''The one Zeroconf engine of the process.
+
+    Binds every carrier link once, browses WG_TYPE once and resolves each
+    announcement once, then offers the result to the listener of every
+    WireGuard interface; the one whose psk authenticates it takes it.
+
+    Link and address changes are followed over netlink. Zeroconf cannot add
+    or drop sockets on a live instance, so when the carrier addresses change
+    the instance is swapped for one bound to the new set and every service is
+    re-announced with it; listeners, peers and the resolve pipeline stay.
+
+    Zeroconf blocks, registering a service waits out its announcements and
+    closing sends goodbyes, so every call that changes it runs on `executor`,
+    one at a time in order, and the loop only swaps references.
+
+    With `compat` services also carry, and listeners also accept, the legacy
+    digest of releases before the HMAC.'''
+    listeners: Dict[str, WGServiceListener]
+    services: Dict[str, WGServiceInfo]
+    links: Dict[int, str]
+    ignored: Set[int]
+
+    def __init__(self, compat: bool = True) -> None:
+        self.compat = compat
+        with IPRoutePool.get() as ip:
+            self.links, self.ignored, self.addresses = self.scan(ip)
+        self._setLoggerName(','.join(self.links.values()))
         self.zeroconf = Zeroconf([addr.compressed for addr in self.addresses])
-        self.listener = WGServiceListener(self)
-        self.browser = ServiceBrowser(self.zeroconf, WG_TYPE, self.listener)
+        self.listeners = {}
+        self.services = {}
+        self.pipeline = DiscoveryPipeline(
+            self.zeroconf, WG_TYPE, self.handle_info)
+        self.browser: Optional[ServiceBrowser] = None
+        self.monitor = LinkMonitor(self.links_changed)
+        self.loop = asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(
+            1, thread_name_prefix='zerowire-zeroconf')
+        self.__rebinding: Optional[asyncio.Future[TRebind]] = None
+        self.__rescan = False
+
+    @staticmethod
+    def is_carrier(name: str) -> bool:
+        return name != 'lo' and not name.startswith('wg')
+
+    @classmethod
+    def scan(
+        Cls,
+        ip: IPRoute,
+    ) -> Tuple[Dict[int, str], Set[int], List[TAddress]]:
+        links: Dict[int, str] = {}
+        ignored: Set[int] = set()
+        for link in ip.get_links():
+            name = link.get_attr('IFLA_IFNAME')
+            if Cls.is_carrier(name):
+                links[link['index']] = name
+            else:
+                ignored.add(link['index'])
+        addresses = [
+            ipaddress.ip_address(addr.get_attr('IFA_ADDRESS'))
+            for name in links.values()
+            for addr in ip.get_addr(label=name)
+        ]
+        return links, ignored, addresses
 
-        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-        digest.update(MACHINE_ID.encode('utf-8'))
-        digest.update(ifname.encode('utf-8'))
-        self.hostname = digest.finalize()[:16].hex()
+    def new_service(
+        self,
+        wg_iface: WGInterface,
+        addresses: Optional[List[TAddress]] = None,
+    ) -> WGServiceInfo:
+        if addresses is None:
+            addresses = self.addresses
+        digest = hashlib.sha256(machine_id().encode('utf-8'))
+        digest.update(wg_iface.ifname.encode('utf-8'))
+        hostname = digest.digest()[:16].hex()
 
-        self.service: WGServiceInfo = WGServiceInfo.new(
-            self.hostname,
-            addresses=[addr.packed for addr in self.addresses],
+        return WGServiceInfo.new(
+            hostname,
+            addresses=[addr.packed for addr in addresses],
             hostname=HOSTNAME,
             config=wg_iface.config,
+            probe_port=wg_iface.prober.port,
+            compat=self.compat,
         )
-        self.zeroconf.register_service(self.service)
 
-    def get_addrs(
+    def add_interface(self, wg_iface: WGInterface) -> WGServiceListener:
+        listener = WGServiceListener(self, wg_iface)
+        self.listeners[wg_iface.ifname] = listener
+        service = self.new_service(wg_iface)
+        self.services[wg_iface.ifname] = service
+        self.submit(self.zeroconf.register_service, service)
+        return listener
+
+    def reregister(self, wg_iface: WGInterface) -> None:
+        '''Announce the interface afresh after its config changed.'''
+        old = self.services.get(wg_iface.ifname)
+        if old is not None:
+            self.submit(self.zeroconf.unregister_service, old)
+        service = self.new_service(wg_iface)
+        self.services[wg_iface.ifname] = service
+        self.submit(self.zeroconf.register_service, service)
+
+    def remove_interface(self, wg_iface: WGInterface) -> None:
+        self.listeners.pop(wg_iface.ifname, None)
+        service = self.services.pop(wg_iface.ifname, None)
+        if service is not None:
+            self.submit(self.zeroconf.unregister_service, service)
+
+    def submit(self, call: Callable[..., None], *args: Any) -> None:
+        '''Run a blocking Zeroconf call on the executor, after every call
+        submitted before it.'''
+        self.executor.submit(call, *args).add_done_callback(self.__done)
+
+    def __done(self, future: Future[None]) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            self.logger.error('Zeroconf call failed %s', future.exception())
+
+    def links_changed(self, indexes: Set[int]) -> None:
+        if indexes <= self.ignored:
+            return
+        self.logger.debug('Links changed %r', indexes)
+        if self.__rebinding is not None:
+            self.__rescan = True
+            return
+        ifaces = [listener.wg_iface for listener in self.listeners.values()]
+        self.__rebinding = self.loop.run_in_executor(
+            self.executor, self.rebind, ifaces, self.browser is not None)
+        self.__rebinding.add_done_callback(
+            functools.partial(self.__rebound, dict(self.services)))
+
+    def __rebound(
+        self,
+        services: Dict[str, WGServiceInfo],
+        future: asyncio.Future[TRebind],
+    ) -> None:
+        self.__rebinding = None
+        if future.cancelled():
+            pass
+        elif future.exception() is not None:
+            self.logger.error('Rebind failed %s', future.exception())
+        else:
+            self.swap(services, *future.result())
+        if self.__rescan:
+            self.__rescan = False
+            self.links_changed({0})
+
+    def rebind(self, ifaces: List[WGInterface], browse: bool) -> TRebind:
+        '''Scan the links and, when the carrier addresses changed, bind a new
+        Zeroconf, announce the services of `ifaces` and start browsing on it.
+        Runs on the executor and changes nothing, swap takes the result on
+        the loop.'''
+        with IPRoutePool.get() as ip:
+            links, ignored, addresses = self.scan(ip)
+        if set(addresses) == set(self.addresses):
+            return links, ignored, None
+        if not addresses:
+            self.logger.warning('No carrier addresses, keeping old bindings')
+            return links, ignored, None
+        self.logger.info('Rebinding to %s', addresses)
+        binding = Binding(
+            Zeroconf([addr.compressed for addr in addresses]), addresses, {})
+        for wg_iface in ifaces:
+            service = self.new_service(wg_iface, addresses)
+            binding.services[wg_iface.ifname] = service
+            binding.zeroconf.register_service(service)
+        if browse:
+            binding.browser = ServiceBrowser(binding.zeroconf, WG_TYPE, self)
+        return links, ignored, binding
+
+    def swap(
         self,
-    ) -> List[TAddress]:
-        with IPRoute() as ip:
-            return [
-                ipaddress.ip_address(addr.get_attr('IFA_ADDRESS'))
-                for addr in ip.get_addr(label=self.ifname)
-            ]
+        services: Dict[str, WGServiceInfo],
+        links: Dict[int, str],
+        ignored: Set[int],
+        binding: Optional[Binding],
+    ) -> None:
+        '''Take on what rebind found. `services` are those announced when the
+        rebind started, an interface added, removed or re-announced since
+        is put right on the new Zeroconf; the old one is closed on the
+        executor.'''
+        self.links, self.ignored = links, ignored
+        if binding is None:
+            return
+        old, old_browser = self.zeroconf, self.browser
+        self.addresses = binding.addresses
+        self.zeroconf = self.pipeline.zeroconf = binding.zeroconf
+        self.browser = binding.browser
+        stale = []
+        for ifname, service in binding.services.items():
+            if (ifname in self.listeners
+                    and self.services.get(ifname) is services.get(ifname)):
+                self.services[ifname] = service
+            else:
+                stale.append(service)
+        for ifname, listener in self.listeners.items():
+            if self.services.get(ifname) is not binding.services.get(ifname):
+                service = self.new_service(listener.wg_iface)
+                self.services[ifname] = service
+                self.submit(binding.zeroconf.register_service, service)
+        self.submit(self.retire, binding.zeroconf, stale, old, old_browser)
+
+    @staticmethod
+    def retire(
+        zeroconf: Zeroconf,
+        stale: List[WGServiceInfo],
+        old: Zeroconf,
+        old_browser: Optional[ServiceBrowser],
+    ) -> None:
+        for service in stale:
+            zeroconf.unregister_service(service)
+        if old_browser is not None:
+            old_browser.cancel()
+        old.close()
+
+    def remove_service(self, zeroconf: Zeroconf, type: str, name: str) -> None:
+        self.log_event(
+            logging.INFO, 'service_removed', rate=SERVICE_LOG_RATE,
+            service=name.split('.', 1)[0])
+        for listener in list(self.listeners.values()):
+            listener.wg_iface.loop.call_soon_threadsafe(
+                listener.remove_service, name)
+
+    def update_service(self, zeroconf: Zeroconf, type: str, name: str) -> None:
+        SERVICES.inc('discovered')
+        self.pipeline.push(name)
+
+    def add_service(self, zeroconf: Zeroconf, type: str, name: str) -> None:
+        SERVICES.inc('discovered')
+        self.pipeline.push(name)
+
+    def handle_info(self, name: str, info: Optional[ServiceInfo]) -> None:
+        if not info:
+            SERVICES.inc('missing')
+            self.log_event(
+                logging.WARNING, 'service_missing', rate=SERVICE_LOG_RATE,
+                burst=1, service=name)
+            return
+        if name in (service.name for service in self.services.values()):
+            return
+        accepted = [
+            listener
+            for listener in list(self.listeners.values())
+            if listener.handle_info(name, info)
+        ]
+        SERVICES.inc('authenticated' if accepted else 'rejected')
+        if not accepted:
+            # Another network on the link announces as often as ours
+            self.log_event(
+                logging.WARNING, 'service_rejected', rate=SERVICE_LOG_RATE,
+                burst=1, service=name)
+
+    async def start(self) -> None:
+        await self.pipeline.start()
+        # Browsing before links are followed, so every rebind browses too
+        self.browser = await self.loop.run_in_executor(
+            self.executor, ServiceBrowser, self.zeroconf, WG_TYPE, self)
+        await self.monitor.start()
 
     def close(self) -> None:
+        '''Blocks until every queued Zeroconf call is done and the goodbyes
+        are sent, `stop` waits for them off the loop.'''
+        self.monitor.close()
+        self.pipeline.close()
+        self.shutdown()
+
+    async def stop(self) -> None:
+        self.monitor.close()
+        self.pipeline.close()
+        await self.loop.run_in_executor(None, self.shutdown)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=True)
         self.zeroconf.close()
 
 
+def link_index(ifname: str) -> int:
+    with IPRoutePool.get() as ip:
+        index: int = ip.link_lookup(ifname=ifname)[0]
+    return index
+
+
 class WGInterface(ClassLogger):
-    def __init__(self, ifname: str, config: IfaceConfig, dns: LocalDNSServer):
+    def __init__(
+        self,
+        ifname: str,
+        config: IfaceConfig,
+        dns: LocalDNSServer,
+        backend: WGBackend,
+        prober: Prober,
+        zeroconf: WGZeroconf,
+        peer_cache: Optional[PeerCache] = None,
+        ifindex: Optional[int] = None,
+    ):
+        '''Looks up `ifindex` if not given, which blocks, so on the loop it
+        has to come from link_index in an executor.'''
         self._setLoggerName(ifname)
         self.ifname = ifname
-        self.ifindex: int = IPRoute().link_lookup(ifname=ifname)[0]
+        self.backend = backend
+        self.prober = prober
+        self.reconciler = PeerReconciler(ifname, backend, adopt=ADOPT_GRACE)
+        self.peers = PeerTable(config.peer_ttl, config.max_peers)
+        self.ifindex = link_index(ifname) if ifindex is None else ifindex
         self.global_dns = dns
         self.config = config
+        self.peer_cache = peer_cache
+        self.loop = asyncio.get_event_loop()
+        self.__gc: Optional[asyncio.Task[None]] = None
+        self.__probe: Optional[asyncio.Task[None]] = None
         self.dns = InterfaceDNSServer(HOSTNAME, self.config.addr)
         if config.services:
             for service in config.services:
                 self.dns.add_service(service)
-            self.logger.info('Services %r', self.dns.get_all_records())
-
-        self.zeroconfs = [
-            WGZeroconf(name, self)
-            for name in (
-                link.get_attr('IFLA_IFNAME')
-                for link in IPRoute().get_links()
-            )
-            if name != 'lo' and not name.startswith('wg')
-        ]
+            self.logger.info('Serving %d services', len(config.services))
 
-        dns.add_to_resolved(self)
+        self.zeroconf = zeroconf
+        self.listener = zeroconf.add_interface(self)
 
     async def start(self) -> None:
         await self.dns.start()
+        if self.peer_cache is not None:
+            self.warm_start(
+                self.peer_cache.entries(self.ifname, self.config.psk))
+            self.peer_cache.track(self.ifname, self.config.psk, self.peers)
+        await self.reconciler.start()
+        self.__gc = self.loop.create_task(self.__run_gc())
+        self.__probe = self.loop.create_task(self.__run_probe())
+
+    def can_reload(self, config: IfaceConfig) -> bool:
+        return self.config.changed(config) <= RELOADABLE
+
+    async def reload(self, config: IfaceConfig) -> None:
+        '''Take on a new config, see can_reload, changing only what
+        differs.'''
+        old = self.config
+        changed = old.changed(config)
+        if config.port is None:
+            config.port = old.port
+        if changed & DEVICE_SETTINGS:
+            await self.loop.run_in_executor(
+                None, config.configure, self.backend)
+        if 'services' in changed:
+            self.reload_services(old.services or [], config.services or [])
+        self.peers.ttl = (
+            PEER_TTL if config.peer_ttl is None else config.peer_ttl)
+        self.peers.max_peers = config.max_peers
+        self.config = config
+        self.listener.pubkey = config.pubkey
+        if changed & DEVICE_SETTINGS:
+            self.zeroconf.reregister(self)
+        if changed:
+            self.logger.info('Reloaded %s', ', '.join(sorted(changed)))
+
+    def reload_services(
+        self,
+        old: List[ServiceConfig],
+        new: List[ServiceConfig],
+    ) -> None:
+        old_services = {(s.type, s.name): s for s in old}
+        new_services = {(s.type, s.name): s for s in new}
+        for key, service in old_services.items():
+            if new_services.get(key) != service:
+                self.dns.remove_service(service)
+        for key, service in new_services.items():
+            if old_services.get(key) != service:
+                self.dns.add_service(service)
 
     def close(self) -> None:
-        for wg_zero in self.zeroconfs:
-            wg_zero.close()
+        self.zeroconf.remove_interface(self)
+        self.reconciler.close()
+        self.dns.close()
+        if self.__gc is not None:
+            self.__gc.cancel()
+        if self.__probe is not None:
+            self.__probe.cancel()
+
+    def wg_peer(self, entry: PeerEntry) -> WGPeer:
+        return WGPeer(
+            pubkey=entry.pubkey,
+            psk=self.config.psk,
+            endpoint=entry.endpoint,
+            keepalive=5,
+            # Apparently we cannot add the same addr to multiple peers,
+            # so no prefix broadcast address here
+            allowed_ips=(ipaddress.ip_network(entry.internal_addr),),
+        )
+
+    def warm_start(self, entries: List[PeerEntry]) -> None:
+        '''Program the peers remembered from the last run before mDNS finds
+        them again, each has CONFIRM_GRACE to be seen.'''
+        now = time.time()
+        restored = 0
+        for entry in sorted(entries, key=lambda entry: entry.last_active):
+            if (entry.internal_addr not in self.config.prefix
+                    or entry.internal_addr == self.config.addr.ip
+                    or entry.pubkey == self.config.pubkey
+                    or self.peers.is_expired(entry, now)):
+                continue
+            entry.confirm_by = now + CONFIRM_GRACE
+            self.listener.peers[entry.pubkey] = entry.endpoint[0]
+            self.add_peer(entry, self.wg_peer(entry))
+            restored += 1
+        if restored:
+            self.logger.info('Restored %d cached peers', restored)
+
+    def peers_changed(self) -> None:
+        if self.peer_cache is not None:
+            self.peer_cache.changed()
 
+    def touch_peer(self, entry: PeerEntry) -> None:
+        '''Insert or refresh the entry of a peer, dropping the DNS record of
+        a name or address it no longer has and the peers evicted for it.'''
+        old = self.peers.get(entry.pubkey)
+        if old is not None and (old.hostname, old.internal_addr) != (
+                entry.hostname, entry.internal_addr):
+            self.global_dns.del_addr_record(old.hostname, old.internal_addr)
+        for evicted in self.peers.touch(entry):
+            self.logger.info('Evicting peer %s', evicted.hostname)
+            self.drop_peer(evicted)
 
-class WGServiceListener(ServiceListener, ClassLogger):
-    peers: Dict[str, TIfaceAddress]
+    def add_peer(self, entry: PeerEntry, peer: WGPeer) -> None:
+        self.touch_peer(entry)
+        self.reconciler.set_peer(peer)
+        self.global_dns.add_addr_record(entry.hostname, entry.internal_addr)
+        PEERS.inc(self.ifname, 'added')
+        self.peers_changed()
 
-    def __init__(self, wg_zero: WGZeroconf):
+    def drop_peer(self, entry: PeerEntry) -> None:
+        self.peers.remove(entry.pubkey)
+        self.reconciler.remove_peer(entry.pubkey)
+        self.global_dns.del_addr_record(entry.hostname, entry.internal_addr)
+        self.listener.peers.pop(entry.pubkey, None)
+        PEERS.inc(self.ifname, 'removed')
+        self.peers_changed()
+
+    def collect(self, now: Optional[float] = None) -> List[PeerEntry]:
+        '''Drop peers that outlived their TTL without a handshake.'''
+        device = self.reconciler.last_dump
+        if device is not None:
+            self.peers.update_handshakes({
+                pubkey: peer.latest_handshake
+                for pubkey, peer in device.peers.items()
+            })
+        expired = self.peers.expire(now)
+        for entry in expired:
+            self.logger.info('Expiring peer %s', entry.hostname)
+            self.drop_peer(entry)
+        return expired
+
+    async def __run_gc(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.peers.ttl / 4, 30))
+            self.collect()
+
+    async def select_endpoint(
+        self,
+        entry: PeerEntry,
+    ) -> Optional[TEndpoint]:
+        '''Fastest answering carrier address of a peer, or None when there is
+        nothing to choose between or nothing answered.'''
+        if entry.probe_port is None or len(entry.candidates) < 2:
+            return None
+        ranked = await self.prober.rank(entry.candidates, entry.probe_port)
+        self.logger.debug('Ranked %s %r', entry.hostname, ranked)
+        if not ranked:
+            return None
+        rtts = {addr: rtt for rtt, addr in ranked}
+        best_rtt, best = ranked[0]
+        current = entry.endpoint[0]
+        if current in rtts and best_rtt > rtts[current] * PROBE_HYSTERESIS:
+            return entry.endpoint
+        return (best, entry.endpoint[1])
+
+    async def probe_and_add(self, entry: PeerEntry, peer: WGPeer) -> None:
+        endpoint = await self.select_endpoint(entry)
+        if endpoint is not None:
+            entry.endpoint = endpoint
+            peer = dataclasses.replace(peer, endpoint=endpoint)
+        self.add_peer(entry, peer)
+
+    async def reprobe(self) -> None:
+        entries = [
+            entry
+            for entry in self.peers.entries.values()
+            if entry.probe_port is not None and len(entry.candidates) > 1
+        ]
+        endpoints = await asyncio.gather(*(
+            self.select_endpoint(entry) for entry in entries))
+        for entry, endpoint in zip(entries, endpoints):
+            peer = self.reconciler.desired.get(entry.pubkey)
+            if endpoint is None or endpoint == entry.endpoint or not peer:
+                continue
+            self.logger.info(
+                'Moving %s to faster endpoint %s', entry.hostname, endpoint)
+            entry.endpoint = endpoint
+            self.reconciler.set_peer(
+                dataclasses.replace(peer, endpoint=endpoint))
+
+    async def __run_probe(self) -> None:
+        while True:
+            await asyncio.sleep(PROBE_INTERVAL)
+            try:
+                await self.reprobe()
+            except Exception as e:
+                self.logger.exception(e)
+
+
+class WGServiceListener(ClassLogger):
+    peers: Dict[str, TAddress]
+
+    def __init__(self, wg_zero: WGZeroconf, wg_iface: WGInterface):
         self.wg_zero = wg_zero
-        self.my_address = wg_zero.wg_iface.config.addr
-        self.my_prefix = wg_zero.wg_iface.config.prefix
-        self.pubkey = wg_zero.wg_iface.config.pubkey
-        self.psk = wg_zero.wg_iface.config.psk
+        self.wg_iface = wg_iface
+        self.my_address = wg_iface.config.addr
+        self.my_prefix = wg_iface.config.prefix
+        self.pubkey = wg_iface.config.pubkey
+        self.psk = wg_iface.config.psk
+        self.verifier = ServiceVerifier(self.psk, wg_zero.compat)
         self.peers = {}
-        self.lock = Lock()
-        self._setLoggerName(parent=self.wg_zero)
+        self._setLoggerName(parent=wg_iface)
 
-    def remove_service(self, zeroconf: Zeroconf, type: str, name: str) -> None:
-        with self.lock:
-            print("Service %s removed" % (name,))
+    def remove_service(self, name: str) -> None:
+        self.wg_iface.peers.withdraw(name)
 
-    def update_service(self, zeroconf: Zeroconf, type: str, name: str) -> None:
-        pass
+    def handle_info(self, name: str, info: ServiceInfo) -> bool:
+        '''Returns whether the service authenticated against our psk.'''
+        service = name.split('.', 1)[0]
+        self.log_event(
+            logging.DEBUG, 'service', rate=SERVICE_LOG_RATE, service=service)
+        if not self.verifier.verify(info):
+            return False
+        props: Dict[bytes, bytes] = info.properties
+        addrs: List[TAddress] = [
+            ipaddress.ip_address(addr)
+            for addr in info.addresses
+        ]
+        _internal_addr = props.get(b'addr', b'').decode('utf-8')
+        internal_addr = None
+        if _internal_addr:
+            internal_addr = ipaddress.ip_interface(_internal_addr)
+        pubkey = props.get(b'pubkey', b'').decode('utf-8')
+        hostname = props.get(b'hostname', b'').decode('utf-8')
+        unusable = functools.partial(
+            self.log_event, logging.WARNING, 'service_unusable',
+            rate=SERVICE_LOG_RATE, service=service)
+        if not internal_addr or not pubkey or not info.port:
+            unusable(reason='missing properties')
+            return True
+        if internal_addr.ip == self.my_address.ip:
+            unusable(reason='same internal address')
+            return True
+        if internal_addr.ip not in self.my_prefix:
+            unusable(reason='outside our prefix')
+            return True
+        candidates = tuple(addr for addr in addrs if not addr.is_link_local)
+        if not candidates:
+            unusable(reason='no usable carrier address')
+            return True
+        probe = props.get(b'probe', b'')
+        wg_iface = self.wg_iface
+        known = wg_iface.peers.get(pubkey)
+        unchanged = (
+            known is not None
+            and known.candidates == candidates
+            and known.endpoint[1] == info.port
+            and known.hostname == hostname + '.zerowire.'
+            and known.internal_addr == internal_addr.ip
+        )
+        # Until a probe says otherwise the last carrier address wins, as it
+        # did when every address was programmed in turn.
+        endpoint = (candidates[-1], info.port)
+        if known is not None and unchanged:
+            endpoint = known.endpoint
+        entry = PeerEntry(
+            pubkey=pubkey,
+            name=name,
+            hostname=hostname + '.zerowire.',
+            internal_addr=internal_addr.ip,
+            endpoint=endpoint,
+            last_seen=time.time(),
+            candidates=candidates,
+            probe_port=int(probe) if probe.isdigit() else None,
+        )
+        if unchanged:
+            wg_iface.touch_peer(entry)
+            wg_iface.peers_changed()
+            return True
 
-    def add_service(self, zeroconf: Zeroconf, type: str, name: str) -> None:
-        logger = self.logger.getChild(name.split('.', 2)[0])
-        with self.lock:
-            info = zeroconf.get_service_info(type, name)
-            logger.debug(
-                'WGServiceListener add_service %s', type)
-            if not info:
-                logger.warn('Missing info')
-                return
-            if not WGServiceInfo.authenticate(info, self.psk):
-                logger.warn('Failed to authenticate remote with psk hash')
-                return
-            props: Dict[bytes, bytes] = info.properties
-            addrs: List[TIfaceAddress] = [
-                ipaddress.ip_address(addr)
-                for addr in info.addresses
-            ]
-            _internal_addr = props.get(b'addr', b'').decode('utf-8')
-            internal_addr = None
-            if _internal_addr:
-                internal_addr = ipaddress.ip_interface(_internal_addr)
-            pubkey = props.get(b'pubkey', b'').decode('utf-8')
-            hostname = props.get(b'hostname', b'').decode('utf-8')
-            if not internal_addr or not pubkey:
-                logger.warn('Service does not have requisite properties')
-                return
-            if internal_addr.ip == self.my_address.ip:
-                logger.warn('Service has same internal ip address')
-                return
-            if internal_addr.ip not in self.my_prefix:
-                logger.warn('Service is not a subnet of our prefix')
-                return
-            logger.info(
-                'Found remote. name "%s" pubkey "%s" addrs %s port %d',
-                name,
-                pubkey,
-                addrs,
-                info.port,
-            )
-            if pubkey in self.peers:
-                return
-            # if self.peers.get(pubkey, None) == : return
-            # if pubkey in self.iface.wg.get_interface(IFACE).peers: return
-            for addr in addrs:
-                addr = ipaddress.ip_address(addr)
-                if addr.is_link_local:
-                    continue
-                endpoint = addr.compressed
-                if addr.version == 6:
-                    endpoint = f'[{endpoint}]'
-                endpoint = f'{endpoint}:{info.port}'
-
-                (WGProc('set', self.wg_zero.wg_iface.ifname)
-                    .args([
-                        'peer', pubkey,
-                        'preshared-key', '/dev/stdin',
-                        'endpoint', endpoint,
-                        'persistent-keepalive', '5',
-                        'allowed-ips',
-                        ','.join([
-                            internal_addr.ip.compressed,
-                            # Apparently we cannot add the same addr to
-                            # multiple peers
-                            # self.my_prefix.broadcast_address.compressed,
-                        ])
-                    ])
-                    .input(self.psk)
-                    .run())
-
-                self.peers[pubkey] = addr
-                zw_hostname = hostname + '.zerowire.'
-                self.wg_zero.wg_iface.global_dns.add_addr_record(
-                    zw_hostname,
-                    internal_addr.ip)
+        self.log_event(
+            logging.INFO, 'peer_found', service=service, pubkey=pubkey,
+            addrs=','.join(addr.compressed for addr in addrs), port=info.port)
+
+        peer = wg_iface.wg_peer(entry)
+        self.peers[pubkey] = endpoint[0]
+        if entry.probe_port is None or len(candidates) < 2:
+            wg_iface.add_peer(entry, peer)
+        else:
+            wg_iface.loop.create_task(wg_iface.probe_and_add(entry, peer))
+        return True